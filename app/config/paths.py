@@ -11,13 +11,111 @@ Cấu hình đường dẫn:
    - VOICE_API_URL: URL của voice service (mặc định: http://localhost:5003)
    - VIDEO_API_URL: URL của video service (mặc định: http://localhost:5001)
    - XTTS_API_URL: URL của XTTS service (mặc định: http://localhost:8020)
+   - VOICE_API_URLS: Danh sách URL voice service, phân cách bằng dấu phẩy (mặc định: VOICE_API_URL)
+   - XTTS_API_URLS: Danh sách URL XTTS, phân cách bằng dấu phẩy (mặc định: XTTS_API_URL)
+   - XTTS_MAX_CONCURRENCY: Số request tối đa cùng lúc trên một XTTS server (mặc định: 1)
+   - VOICE_MAX_CONCURRENCY: Số request tối đa cùng lúc trên một voice service, 0 là không giới hạn (mặc định: 0)
+   - ENDPOINT_HEALTH_INTERVAL: Chu kỳ (giây) kiểm tra lại endpoint bị lỗi (mặc định: 15)
+   - ENDPOINT_FAILURE_THRESHOLD: Số lỗi liên tiếp trước khi mở circuit breaker, loại endpoint (mặc định: 3)
+   - ENDPOINT_PROBE_TIMEOUT: Timeout (giây) của health probe tới endpoint đang lỗi (mặc định: 3)
+   - VIDEO_API_URLS: Danh sách render node, phân cách bằng dấu phẩy, mỗi node có thể
+     kèm giới hạn render đồng thời riêng dạng URL#N (mặc định: VIDEO_API_URL)
+   - VIDEO_NODE_CONCURRENCY: Số render đồng thời mặc định trên một node (mặc định: 1)
+   Request được gửi tới endpoint có ít request đang chờ nhất.
+   - ENDPOINT_ADAPTIVE_CONCURRENCY: Tự điều chỉnh số request đồng thời của mỗi endpoint theo AIMD:
+     tăng dần khi request thành công, giảm mạnh khi timeout/lỗi 5xx (mặc định: true)
+   - ENDPOINT_MIN_CONCURRENCY / ENDPOINT_INITIAL_CONCURRENCY: Giới hạn nhỏ nhất / ban đầu; mặc định endpoint
+     bắt đầu từ giới hạn trên (giới hạn riêng URL#N hoặc ENDPOINT_MAX_CONCURRENCY) và AIMD giảm dần khi
+     gặp lỗi/chậm (mặc định: 1 / giới hạn trên)
+   - ENDPOINT_MAX_CONCURRENCY: Giới hạn trên cho endpoint không cấu hình giới hạn riêng (mặc định: 8)
+   - ENDPOINT_DECREASE_FACTOR: Hệ số nhân giới hạn khi gặp lỗi (mặc định: 0.5)
+   - VOICE_LATENCY_TARGET / VIDEO_LATENCY_TARGET: Thời gian (giây) tối đa của một lần tổng hợp
+     giọng nói / một render được coi là bình thường, vượt quá thì giảm nhẹ giới hạn; 0 là tắt (mặc định: 0)
    - APP_API_URL: URL của main app (mặc định: http://localhost:8000)
 
+3. Scheduler (có thể thay đổi qua biến môi trường):
+   - VOICE_WORKERS: Số worker tổng hợp giọng nói chạy song song (mặc định: số XTTS server)
+   - VIDEO_WORKERS: Số worker render video chạy song song (mặc định: tổng giới hạn của các render node)
+   - JOB_LEASE_SECONDS: Thời hạn lease của job, worker phải heartbeat trước khi hết hạn (mặc định: 120)
+   - JOB_POLL_INTERVAL: Chu kỳ (giây) kiểm tra job mới trong database (mặc định: 5)
+   - VOICE_QUEUE_SIZE / VIDEO_QUEUE_SIZE: Số job tối đa chờ trong hàng đợi voice/video của
+     một process (mặc định: 2 lần số worker tương ứng)
+   - JOB_PAUSE_SECONDS: Khi service downstream không khả dụng, job được tạm dừng và trả về hàng đợi,
+     sau số giây này mới được claim lại (mặc định: 60)
+   - JOB_MAX_ATTEMPTS: Số lần thử tối đa của một job khi service downstream liên tục lỗi (mặc định: 5)
+   - JOB_WRITE_BEHIND: Gom các cập nhật checkpoint/hoàn thành/lỗi của mọi job đang chạy vào một
+     transaction chung thay vì commit riêng từng cập nhật; claim, heartbeat, release vẫn commit ngay (mặc định: true)
+   - JOB_FLUSH_INTERVAL: Chu kỳ (giây) ghi các cập nhật đang chờ xuống database (mặc định: 0.2)
+   - JOB_FLUSH_MAX_PENDING: Ghi ngay khi số job có cập nhật đang chờ đạt giá trị này (mặc định: 500)
+   - ADMISSION_MAX_BACKLOG: Số job chưa kết thúc tối đa trong hệ thống, vượt quá thì API trả về 429
+     và watcher để file lại trong thư mục; 0 là không giới hạn (mặc định: 1000)
+   - ADMISSION_RETRY_AFTER: Giá trị header Retry-After (giây) khi trả về 429 (mặc định: 30)
+   - ADMISSION_CHECK_INTERVAL: Chu kỳ (giây) đưa các file đang chờ vào hàng đợi (mặc định: 10)
+   - BULK_MAX_SCRIPTS: Số script tối đa trong một request /process_scripts (mặc định: 1000)
+
+4. Voice cache:
+   - VOICE_CACHE_MAX_MB: Dung lượng tối đa của cache audio/SRT (mặc định: 10240)
+
+5. Tổng hợp giọng nói theo chunk (có thể ghi đè trong cấu hình channel):
+   - VOICE_CHUNKED_SYNTHESIS: Bật chế độ chia script và tổng hợp song song (mặc định: false)
+   - VOICE_CHUNK_MAX_CHARS: Số ký tự tối đa của một chunk (mặc định: 3000)
+   - VOICE_CHUNK_RETRIES: Số lần thử lại một chunk bị lỗi (mặc định: 2)
+
+6. Theo dõi render (có thể thay đổi qua biến môi trường):
+   - RENDER_POLL_MIN_INTERVAL / RENDER_POLL_MAX_INTERVAL: Khoảng cách (giây) nhỏ nhất/lớn nhất
+     giữa hai lần kiểm tra trạng thái một render (mặc định: 5 / 60)
+   - RENDER_EXPECTED_SECONDS: Thời gian render dự kiến khi video service không trả về tiến độ (mặc định: 600)
+   - RENDER_TIMEOUT_SECONDS: Thời gian tối đa của một render (mặc định: 1800)
+   - RENDER_POLL_CONCURRENCY: Số request kiểm tra trạng thái gửi cùng lúc (mặc định: 20)
+   - RENDER_CALLBACKS: Gửi kèm callback_url (APP_API_URL/task_callback/...) khi submit render
+     để video service báo kết quả ngay khi xong (mặc định: true)
+   - RENDER_CALLBACK_POLL_INTERVAL: Khi đã nhận được callback, chỉ kiểm tra trạng thái dự phòng
+     sau ít nhất số giây này (mặc định: 120)
+
+7. HTTP client dùng chung cho các service downstream:
+   - HTTP_MAX_CONNECTIONS_PER_HOST: Số kết nối tối đa tới một host (mặc định: 100)
+   - HTTP_MAX_KEEPALIVE_PER_HOST: Số kết nối keep-alive giữ lại cho một host (mặc định: 20)
+   - HTTP_KEEPALIVE_EXPIRY: Thời gian (giây) giữ kết nối rảnh (mặc định: 30)
+   - HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT: Timeout (giây) khi kết nối / đọc dữ liệu (mặc định: 5 / 30)
+   - HTTP2: Dùng HTTP/2 nếu đã cài package h2 (mặc định: false)
+
+8. Chống nhận trùng file script:
+   - INGEST_DEDUP_TTL_HOURS: Thời gian (giờ) một file đã nhận được ghi nhớ trong bảng ingested_files,
+     file cùng đường dẫn và nội dung xuất hiện lại trong thời gian này sẽ không tạo job mới (mặc định: 72)
+   - INGEST_CACHE_SIZE: Số file đã nhận được giữ trong cache bộ nhớ phía trước database (mặc định: 10000)
+
+9. Watcher thư mục scripts:
+   - WATCH_STABLE_SECONDS: File mới chỉ được đưa vào hàng đợi khi kích thước và mtime không đổi
+     trong số giây này, hoặc ngay khi file được đóng sau khi ghi / được đổi tên vào thư mục (mặc định: 2)
+   - WATCH_CHECK_INTERVAL: Chu kỳ (giây) kiểm tra các file đang được ghi (mặc định: 0.5)
+   - WATCH_POLLING: Quét định kỳ thư mục scripts thay vì dùng event của hệ điều hành, dùng khi
+     thư mục nằm trên ổ mạng (SMB/NFS) không hỗ trợ inotify (mặc định: false)
+   - WATCH_POLL_INTERVAL: Chu kỳ (giây) quét thư mục scripts ở chế độ polling (mặc định: 10)
+   - WATCH_FULL_RESCAN_SECONDS: Chu kỳ (giây) liệt kê lại mọi thư mục channel kể cả khi mtime
+     không đổi, phòng trường hợp ổ mạng không cập nhật mtime thư mục (mặc định: 600)
+   - WATCH_INCLUDE: Các glob (phân cách bằng dấu phẩy, so với đường dẫn channel/file) của file
+     script được nhận (mặc định: *.txt)
+   - WATCH_EXCLUDE: Các glob của file/thư mục bị bỏ qua (mặc định: thư mục processed/, error/,
+     completed/, file ẩn, file tạm *.tmp/*.part/*.crdownload, file error_*)
+   - WATCH_BATCH_SIZE: Số file tối đa được watcher độc lập (scripts_watcher/file_watcher.py) ghi
+     vào database trong một transaction (mặc định: 500)
+   - WATCH_BATCH_SECONDS: Thời gian (giây) tối đa một file chờ trong buffer của watcher độc lập
+     trước khi được ghi vào database (mặc định: 1)
+
+10. SQLite (chỉ áp dụng khi DATABASE_URL là sqlite):
+   - SQLITE_WAL: Dùng WAL journal, cho phép đọc song song với ghi giữa nhiều process (mặc định: true)
+   - SQLITE_BUSY_TIMEOUT_MS: Thời gian (ms) chờ khi database đang bị process khác khóa (mặc định: 15000)
+   - SQLITE_SYNCHRONOUS: Mức fsync, NORMAL là an toàn với WAL và nhanh hơn FULL (mặc định: NORMAL)
+   - SQLITE_MMAP_SIZE_MB: Dung lượng database được đọc qua memory-map (mặc định: 256)
+   - SQLITE_CHECKPOINT_INTERVAL: Chu kỳ (giây) checkpoint WAL vào file database, 0 là tắt (mặc định: 300)
+   - SQLITE_CHECKPOINT_MODE: Chế độ checkpoint: PASSIVE, FULL, RESTART hoặc TRUNCATE (mặc định: TRUNCATE)
+
 Cấu trúc thư mục:
 WF_ROOT/
 ├── WF/                      # Thư mục chính của ứng dụng
 │   ├── scripts/            # Chứa các script theo channel
 │   │   └── {channel}/     # Thư mục channel
+│   │       ├── inbox/     # Scripts gửi trực tiếp qua API
 │   │       ├── error/     # Scripts bị lỗi
 │   │       ├── processed/ # Scripts đã xử lý
 │   │       └── completed/ # Scripts hoàn thành
@@ -28,7 +126,8 @@ WF_ROOT/
 │   │   ├── overlay1/     # Overlay cố định theo channel
 │   │   ├── overlay2/     # Overlay ngẫu nhiên theo channel
 │   │   ├── final/        # Video hoàn chỉnh
-│   │   └── voice/        # File giọng nói
+│   │   ├── voice/        # File giọng nói
+│   │   └── cache/voice/  # Cache audio/SRT theo nội dung script
 │   └── config/           # Cấu hình
 │       └── channels/     # Cấu hình riêng cho từng channel
 └── Pandrator/            # Thư mục Pandrator
@@ -64,6 +163,7 @@ OVERLAY1_DIR = os.path.join(ASSETS_DIR, 'overlay1')
 OVERLAY2_DIR = os.path.join(ASSETS_DIR, 'overlay2')
 FINAL_DIR = os.path.join(ASSETS_DIR, 'final')
 VOICE_DIR = os.path.join(ASSETS_DIR, 'voice')
+VOICE_CACHE_DIR = os.path.join(ASSETS_DIR, 'cache', 'voice')
 
 # Templates directory
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
@@ -85,6 +185,10 @@ def get_channel_completed_dir(channel_name):
     """Lấy đường dẫn thư mục chứa scripts đã hoàn thành của channel"""
     return os.path.join(get_channel_dir(channel_name), 'completed')
 
+def get_channel_inbox_dir(channel_name):
+    """Lấy đường dẫn thư mục chứa scripts được gửi trực tiếp qua API (watcher không theo dõi)"""
+    return os.path.join(get_channel_dir(channel_name), 'inbox')
+
 def get_channel_overlay1_dir(channel_name):
     """Lấy đường dẫn thư mục chứa overlay cố định của channel"""
     return os.path.join(OVERLAY1_DIR, channel_name)
@@ -124,6 +228,104 @@ VIDEO_API_URL = os.getenv('VIDEO_API_URL', 'http://localhost:5001')
 XTTS_API_URL = os.getenv('XTTS_API_URL', 'http://localhost:8020')
 APP_API_URL = os.getenv('APP_API_URL', 'http://localhost:8000')
 
+def _parse_urls(value):
+    """Tách danh sách URL phân cách bằng dấu phẩy"""
+    return [url.strip() for url in value.split(',') if url.strip()]
+
+VOICE_API_URLS = _parse_urls(os.getenv('VOICE_API_URLS', VOICE_API_URL))
+XTTS_API_URLS = _parse_urls(os.getenv('XTTS_API_URLS', XTTS_API_URL))
+XTTS_MAX_CONCURRENCY = int(os.getenv('XTTS_MAX_CONCURRENCY', '1'))
+VOICE_MAX_CONCURRENCY = int(os.getenv('VOICE_MAX_CONCURRENCY', '0')) or None
+ENDPOINT_ADAPTIVE_CONCURRENCY = os.getenv('ENDPOINT_ADAPTIVE_CONCURRENCY', 'true').lower() in ('1', 'true', 'yes')
+ENDPOINT_MIN_CONCURRENCY = int(os.getenv('ENDPOINT_MIN_CONCURRENCY', '1'))
+ENDPOINT_INITIAL_CONCURRENCY = int(os.getenv('ENDPOINT_INITIAL_CONCURRENCY', '0')) or None
+ENDPOINT_MAX_CONCURRENCY = int(os.getenv('ENDPOINT_MAX_CONCURRENCY', '8'))
+ENDPOINT_DECREASE_FACTOR = float(os.getenv('ENDPOINT_DECREASE_FACTOR', '0.5'))
+VOICE_LATENCY_TARGET = float(os.getenv('VOICE_LATENCY_TARGET', '0')) or None
+VIDEO_LATENCY_TARGET = float(os.getenv('VIDEO_LATENCY_TARGET', '0')) or None
+ENDPOINT_HEALTH_INTERVAL = float(os.getenv('ENDPOINT_HEALTH_INTERVAL', '15'))
+ENDPOINT_FAILURE_THRESHOLD = int(os.getenv('ENDPOINT_FAILURE_THRESHOLD', '3'))
+ENDPOINT_PROBE_TIMEOUT = float(os.getenv('ENDPOINT_PROBE_TIMEOUT', '3'))
+VIDEO_NODE_CONCURRENCY = int(os.getenv('VIDEO_NODE_CONCURRENCY', '1'))
+
+def _parse_nodes(value, default_capacity):
+    """Tách danh sách node dạng URL#N thành các cặp (URL, N)"""
+    nodes = []
+    for item in _parse_urls(value):
+        url, _, capacity = item.partition('#')
+        nodes.append((url.strip(), int(capacity) if capacity else default_capacity))
+    return nodes
+
+VIDEO_API_NODES = _parse_nodes(os.getenv('VIDEO_API_URLS', VIDEO_API_URL), VIDEO_NODE_CONCURRENCY)
+
+# Scheduler
+VOICE_WORKERS = int(os.getenv('VOICE_WORKERS', str(max(1, len(XTTS_API_URLS)))))
+VIDEO_WORKERS = int(os.getenv('VIDEO_WORKERS', str(max(1, sum(cap for _, cap in VIDEO_API_NODES)))))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '120'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5'))
+JOB_PAUSE_SECONDS = int(os.getenv('JOB_PAUSE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_WRITE_BEHIND = os.getenv('JOB_WRITE_BEHIND', 'true').lower() in ('1', 'true', 'yes')
+JOB_FLUSH_INTERVAL = float(os.getenv('JOB_FLUSH_INTERVAL', '0.2'))
+JOB_FLUSH_MAX_PENDING = int(os.getenv('JOB_FLUSH_MAX_PENDING', '500'))
+VOICE_QUEUE_SIZE = int(os.getenv('VOICE_QUEUE_SIZE', str(2 * VOICE_WORKERS)))
+VIDEO_QUEUE_SIZE = int(os.getenv('VIDEO_QUEUE_SIZE', str(2 * VIDEO_WORKERS)))
+ADMISSION_MAX_BACKLOG = int(os.getenv('ADMISSION_MAX_BACKLOG', '1000'))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '30'))
+ADMISSION_CHECK_INTERVAL = float(os.getenv('ADMISSION_CHECK_INTERVAL', '10'))
+BULK_MAX_SCRIPTS = int(os.getenv('BULK_MAX_SCRIPTS', '1000'))
+
+# Voice cache
+VOICE_CACHE_MAX_BYTES = int(os.getenv('VOICE_CACHE_MAX_MB', '10240')) * 1024 * 1024
+
+# Tổng hợp giọng nói theo chunk
+VOICE_CHUNKED_SYNTHESIS = os.getenv('VOICE_CHUNKED_SYNTHESIS', 'false').lower() in ('1', 'true', 'yes')
+VOICE_CHUNK_MAX_CHARS = int(os.getenv('VOICE_CHUNK_MAX_CHARS', '3000'))
+VOICE_CHUNK_RETRIES = int(os.getenv('VOICE_CHUNK_RETRIES', '2'))
+
+# Theo dõi render
+RENDER_POLL_MIN_INTERVAL = float(os.getenv('RENDER_POLL_MIN_INTERVAL', '5'))
+RENDER_POLL_MAX_INTERVAL = float(os.getenv('RENDER_POLL_MAX_INTERVAL', '60'))
+RENDER_EXPECTED_SECONDS = float(os.getenv('RENDER_EXPECTED_SECONDS', '600'))
+RENDER_TIMEOUT_SECONDS = float(os.getenv('RENDER_TIMEOUT_SECONDS', '1800'))
+RENDER_POLL_CONCURRENCY = int(os.getenv('RENDER_POLL_CONCURRENCY', '20'))
+RENDER_CALLBACKS = os.getenv('RENDER_CALLBACKS', 'true').lower() in ('1', 'true', 'yes')
+RENDER_CALLBACK_POLL_INTERVAL = float(os.getenv('RENDER_CALLBACK_POLL_INTERVAL', '120'))
+
+# HTTP client dùng chung
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', '100'))
+HTTP_MAX_KEEPALIVE_PER_HOST = int(os.getenv('HTTP_MAX_KEEPALIVE_PER_HOST', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP2_ENABLED = os.getenv('HTTP2', 'false').lower() in ('1', 'true', 'yes')
+
+# Chống nhận trùng file script
+INGEST_DEDUP_TTL_HOURS = float(os.getenv('INGEST_DEDUP_TTL_HOURS', '72'))
+INGEST_CACHE_SIZE = int(os.getenv('INGEST_CACHE_SIZE', '10000'))
+
+# Watcher thư mục scripts
+WATCH_STABLE_SECONDS = float(os.getenv('WATCH_STABLE_SECONDS', '2'))
+WATCH_CHECK_INTERVAL = float(os.getenv('WATCH_CHECK_INTERVAL', '0.5'))
+WATCH_POLLING = os.getenv('WATCH_POLLING', 'false').lower() in ('1', 'true', 'yes')
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', '10'))
+WATCH_FULL_RESCAN_SECONDS = float(os.getenv('WATCH_FULL_RESCAN_SECONDS', '600'))
+WATCH_INCLUDE = _parse_urls(os.getenv('WATCH_INCLUDE', '*.txt'))
+WATCH_EXCLUDE = _parse_urls(os.getenv(
+    'WATCH_EXCLUDE',
+    '*/processed/*,*/error/*,*/completed/*,.*,*/.*,*.tmp,*.part,*.crdownload,*/error_*'
+))
+WATCH_BATCH_SIZE = int(os.getenv('WATCH_BATCH_SIZE', '500'))
+WATCH_BATCH_SECONDS = float(os.getenv('WATCH_BATCH_SECONDS', '1'))
+
+# SQLite
+SQLITE_WAL = os.getenv('SQLITE_WAL', 'true').lower() in ('1', 'true', 'yes')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '15000'))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE_MB', '256')) * 1024 * 1024
+SQLITE_CHECKPOINT_INTERVAL = float(os.getenv('SQLITE_CHECKPOINT_INTERVAL', '300'))
+SQLITE_CHECKPOINT_MODE = os.getenv('SQLITE_CHECKPOINT_MODE', 'TRUNCATE').upper()
+
 def ensure_base_directories():
     """Tạo tất cả các thư mục cơ bản nếu chưa tồn tại"""
     dirs = [
@@ -1,19 +1,152 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import os
+import asyncio
+import logging
+from typing import Optional
 from dotenv import load_dotenv
+from .config.paths import (
+    SQLITE_WAL,
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_MMAP_SIZE,
+    SQLITE_CHECKPOINT_INTERVAL,
+    SQLITE_CHECKPOINT_MODE,
+)
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Driver async tương ứng với từng loại database
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+def _async_database_url(url: str) -> str:
+    """Đổi URL database sang driver async (sqlite:///... -> sqlite+aiosqlite:///...)"""
+    scheme, sep, rest = url.partition('://')
+    dialect = scheme.split('+')[0]
+    return f"{ASYNC_DRIVERS.get(dialect, scheme)}{sep}{rest}"
+
+# Engine async dùng trong event loop: commit không chặn các job và request khác.
+# Engine đồng bộ ở trên chỉ dùng trong thread riêng (watcher, admission) và khi khởi động
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_database_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Cấu hình mỗi kết nối SQLite: WAL cho phép API, scheduler và watcher ở
+    process khác đọc trong khi một process đang ghi; busy_timeout chờ thay vì
+    lỗi "database is locked"; synchronous=NORMAL chỉ fsync khi checkpoint.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        if SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    finally:
+        cursor.close()
+
+for _engine in (engine, async_engine.sync_engine):
+    if _engine.dialect.name == 'sqlite':
+        event.listen(_engine, 'connect', _set_sqlite_pragmas)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    """Session async cho mỗi request, đóng khi request kết thúc"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def add_missing_columns(metadata):
+    """
+    Thêm các cột mới của model vào bảng đã tồn tại.
+    create_all không sửa bảng cũ nên cần bước này khi model có thêm cột.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def add_missing_indexes(metadata):
+    """
+    Tạo các index của model còn thiếu trên bảng đã tồn tại
+    (create_all chỉ tạo index khi tạo bảng mới).
+    """
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Tạo index {index.name} trên bảng {table.name}")
+                index.create(bind=engine)
+
+class WalCheckpointer:
+    """
+    Checkpoint WAL định kỳ. SQLite tự checkpoint khi WAL đủ lớn nhưng không
+    thu nhỏ file WAL, và checkpoint bị bỏ dở nếu luôn có kết nối đang đọc;
+    checkpoint theo lịch (mặc định TRUNCATE) giữ file WAL nhỏ.
+    """
+
+    def __init__(self, interval: float = SQLITE_CHECKPOINT_INTERVAL, mode: str = SQLITE_CHECKPOINT_MODE):
+        self.interval = interval
+        self.mode = mode
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0 and SQLITE_WAL and engine.dialect.name == 'sqlite'
+
+    def checkpoint(self):
+        """Trả về (busy, số trang trong WAL, số trang đã checkpoint)"""
+        with engine.connect() as conn:
+            return tuple(conn.execute(text(f"PRAGMA wal_checkpoint({self.mode})")).one())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                busy, log_pages, checkpointed = await asyncio.to_thread(self.checkpoint)
+                if busy:
+                    logger.warning(f"Checkpoint WAL chưa hoàn tất ({checkpointed}/{log_pages} trang), database đang bận")
+            except Exception as e:
+                logger.error(f"Lỗi khi checkpoint WAL: {e}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+wal_checkpointer = WalCheckpointer()
@@ -1,25 +1,36 @@
 import os
 import shutil
+import asyncio
 from fastapi import FastAPI, Request, BackgroundTasks, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import logging
 import time
 from datetime import datetime
-from .database import get_db, engine
+from .database import get_async_db, engine, async_engine, add_missing_columns, add_missing_indexes, wal_checkpointer
 from .models.script import Base, Script, ScriptStatus
-from .services.voice_service import VoiceService
-from .services.video_service import VideoService
+from .models.ingested_file import IngestedFile  # noqa: F401 (tạo bảng ingested_files)
 from .services.watcher_service import WatcherService
+from .services.voice_cache import voice_cache
+from .services.ingest_index import ingest_index
+from .utils.http_client import http_client
+from .routes import file_routes
 from .utils.logging_config import setup_logging, LoggerAdapter
-from .tasks import process_script_file
+from .tasks import (
+    process_script_file,
+    process_new_channel,
+    scheduler,
+    admission,
+    enqueue_backlog,
+    setup_channel_directories,
+    voice_service,
+    video_service
+)
 from .config.paths import (
     SCRIPTS_DIR,
     get_channel_error_dir,
     get_channel_completed_dir,
-    get_channel_processed_dir,
-    VOICE_API_URL,
-    VIDEO_API_URL
+    get_channel_processed_dir
 )
 
 # Setup logging
@@ -27,10 +38,10 @@ logger = LoggerAdapter(setup_logging(os.getenv("LOG_LEVEL", "DEBUG")), {})
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
+add_missing_columns(Base.metadata)
+add_missing_indexes(Base.metadata)
 
-# Khởi tạo các service
-voice_service = VoiceService(voice_api_url=VOICE_API_URL)
-video_service = VideoService(video_api_url=VIDEO_API_URL)
+# Khởi tạo các service (voice/video service dùng chung với scheduler trong tasks)
 watcher_service = WatcherService()
 
 app = FastAPI(
@@ -50,6 +61,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Endpoint nhận script qua API và callback từ video service
+app.include_router(file_routes.router)
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     """Log request and response details"""
@@ -78,134 +92,21 @@ async def log_requests(request: Request, call_next):
     )
     return response
 
-async def process_pending_script(script: Script, db: Session):
-    """
-    Xử lý một script đang pending
-    """
-    try:
-        logger.info(f"Bắt đầu xử lý script: {script.file_path}")
-        
-        # Cập nhật trạng thái
-        script.status = ScriptStatus.processing
-        script.started_at = datetime.now()
-        db.commit()
-
-        # Bước 1: Xử lý Voice
-        try:
-            voice_result = await voice_service.process_voice(
-                file_path=script.file_path,
-                channel_name=script.channel_name
-            )
-            script.audio_path = voice_result['audio_path']
-            script.srt_path = voice_result['srt_path']
-            db.commit()
-            
-        except Exception as voice_error:
-            logger.error(f"Lỗi xử lý voice: {voice_error}")
-            await handle_error(script, "voice_processing", str(voice_error), db)
-            return
-
-        # Bước 2: Xử lý Video
-        try:
-            video_result = await video_service.process_video(
-                audio_path=script.audio_path,
-                srt_path=script.srt_path,
-                channel_name=script.channel_name
-            )
-            script.video_path = video_result['video_path']
-            
-        except Exception as video_error:
-            logger.error(f"Lỗi xử lý video: {video_error}")
-            await handle_error(script, "video_processing", str(video_error), db)
-            return
-
-        # Xử lý thành công
-        await handle_success(script, db)
-
-    except Exception as e:
-        logger.error(f"Lỗi không mong đợi: {e}")
-        await handle_error(script, "unexpected", str(e), db)
-
-async def handle_error(script: Script, error_stage: str, error_message: str, db: Session):
-    """
-    Xử lý khi có lỗi
-    """
-    try:
-        # Cập nhật database
-        script.status = ScriptStatus.failed
-        script.error_stage = error_stage
-        script.error_message = error_message
-        script.completed_at = datetime.now()
-        db.commit()
-
-        # Tạo thư mục error
-        error_dir = get_channel_error_dir(script.channel_name)
-        os.makedirs(error_dir, exist_ok=True)
-
-        # Di chuyển file gốc vào thư mục error
-        error_file = os.path.join(error_dir, f"{os.path.basename(script.file_path)}")
-        shutil.move(script.file_path, error_file)
-
-        # Ghi log lỗi
-        error_log = os.path.join(error_dir, f"{os.path.basename(script.file_path)}.error.log")
-        with open(error_log, 'w', encoding='utf-8') as f:
-            f.write(f"Error Stage: {error_stage}\n")
-            f.write(f"Error Message: {error_message}\n")
-            f.write(f"Timestamp: {datetime.now()}\n")
-            if script.audio_path:
-                f.write(f"Audio Path: {script.audio_path}\n")
-            if script.srt_path:
-                f.write(f"SRT Path: {script.srt_path}\n")
-
-        logger.info(f"Đã xử lý lỗi cho script {script.file_path}")
-
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý error handling: {e}")
-
-async def handle_success(script: Script, db: Session):
-    """
-    Xử lý khi thành công
-    """
-    try:
-        # Cập nhật database
-        script.status = ScriptStatus.completed
-        script.completed_at = datetime.now()
-        db.commit()
-
-        # Di chuyển file kịch bản vào thư mục processed
-        processed_dir = get_channel_processed_dir(script.channel_name)
-        script_file_path = script.file_path  # Cập nhật đường dẫn file kịch bản từ script
-        try:
-            shutil.move(script_file_path, processed_dir)
-            logger.info(f"File kịch bản đã được di chuyển vào thư mục processed: {script_file_path}")
-        except Exception as e:
-            logger.error(f"Không thể di chuyển file kịch bản vào thư mục processed: {str(e)}")
-
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý success handling: {e}")
-        await handle_error(script, "success_handling", str(e), db)
-
 @app.get("/process_pending")
-async def process_pending_scripts(
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
-):
+async def process_pending_scripts(limit: int = 1):
     """
-    Endpoint để xử lý các script đang pending
+    Endpoint để claim và xử lý các script đang pending.
+    Claim là atomic nên nhiều process/host có thể gọi đồng thời mà không xử lý trùng.
     """
     try:
-        # Lấy một script pending
-        pending_script = db.query(Script).filter(
-            Script.status == ScriptStatus.pending
-        ).first()
-
-        if pending_script:
-            # Thêm vào background task
-            background_tasks.add_task(process_pending_script, pending_script, db)
+        claimed = await scheduler.drain_once(limit)
+        if claimed:
             return {
                 "status": "processing",
-                "script_id": pending_script.id,
-                "file_path": pending_script.file_path
+                "scripts": [
+                    {"script_id": row["id"], "file_path": row["file_path"]}
+                    for row in claimed
+                ]
             }
         else:
             return {"status": "no_pending_scripts"}
@@ -215,11 +116,11 @@ async def process_pending_scripts(
         return {"status": "error", "message": str(e)}
 
 @app.get("/scripts/{script_id}")
-async def get_script_status(script_id: int, db: Session = Depends(get_db)):
+async def get_script_status(script_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Lấy thông tin của một script
     """
-    script = db.query(Script).filter(Script.id == script_id).first()
+    script = await db.get(Script, script_id)
     if not script:
         return {"status": "not_found"}
     
@@ -230,14 +131,39 @@ async def get_script_status(script_id: int, db: Session = Depends(get_db)):
         "channel_name": script.channel_name,
         "audio_path": script.audio_path,
         "srt_path": script.srt_path,
+        "video_task_id": script.video_task_id,
+        "video_node_url": script.video_node_url,
         "video_path": script.video_path,
-        "error_stage": script.error_stage,
         "error_message": script.error_message,
+        "attempts": script.attempts,
+        "lease_owner": script.lease_owner,
+        "lease_expires_at": script.lease_expires_at,
         "created_at": script.created_at,
-        "started_at": script.started_at,
-        "completed_at": script.completed_at
+        "updated_at": script.updated_at
     }
 
+@app.get("/scheduler/stats")
+async def get_scheduler_stats():
+    """
+    Thống kê hàng đợi và worker pool của scheduler
+    """
+    admission_stats = await asyncio.to_thread(admission.stats)
+    return {**scheduler.stats(), "admission": admission_stats, "ingest": ingest_index.stats()}
+
+@app.get("/endpoints/stats")
+async def get_endpoint_stats():
+    """
+    Trạng thái và tải của các endpoint downstream
+    """
+    return {**voice_service.stats(), 'video': video_service.stats(), 'http': http_client.stats()}
+
+@app.get("/voice_cache/stats")
+async def get_voice_cache_stats():
+    """
+    Thống kê hit/miss và dung lượng của voice cache
+    """
+    return voice_cache.stats()
+
 async def process_file(file_path: str, channel_name: str):
     """
     Xử lý file script
@@ -275,52 +201,61 @@ async def process_file(file_path: str, channel_name: str):
         shutil.move(file_path, os.path.join(error_dir, os.path.basename(file_path)))
         logger.error(f"File lỗi đã được di chuyển tới: {os.path.join(error_dir, os.path.basename(file_path))}")
 
+def _log_backlog_result(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Lỗi khi đưa các file tồn đọng vào hàng đợi: {task.exception()}")
+
 @app.on_event("startup")
 async def startup_event():
     """Khởi động các watcher khi app bắt đầu"""
+    # Khởi động scheduler trước để watcher có thể đưa job vào hàng đợi
+    voice_service.start()
+    video_service.start()
+    await scheduler.start()
+    admission.start()
+    wal_checkpointer.start()
+
     # Khởi động watcher cho thư mục scripts
     scripts_dir = SCRIPTS_DIR
     os.makedirs(scripts_dir, exist_ok=True)
     
-    # Lấy danh sách các channel hiện có
-    channels = [d for d in os.listdir(scripts_dir) 
-               if os.path.isdir(os.path.join(scripts_dir, d))]
-    
     # Nếu chưa có channel nào, tạo channel mặc định C1
-    if not channels:
-        channel_name = "C1"
-        setup_channel_directories(channel_name)
-        channels = [channel_name]
+    with os.scandir(scripts_dir) as entries:
+        if not any(entry.is_dir() for entry in entries):
+            setup_channel_directories("C1")
     
-    # Khởi động watcher và xử lý các file có sẵn cho mỗi channel
-    for channel in channels:
-        channel_dir = os.path.join(scripts_dir, channel)
-        
-        # Xử lý các file .txt có sẵn trong thư mục
-        for file_name in os.listdir(channel_dir):
-            if file_name.endswith('.txt') and not file_name.startswith('error_'):
-                file_path = os.path.join(channel_dir, file_name)
-                if os.path.isfile(file_path):
-                    logger.info(f"Xử lý file có sẵn: {file_path}")
-                    try:
-                        await process_script_file(file_path)
-                    except Exception as e:
-                        logger.error(f"Lỗi khi xử lý file có sẵn {file_path}: {str(e)}")
-                
-        # Khởi động watcher cho channel
-        watcher_service.start_watching(
-            directory=channel_dir,
-            process_callback=process_script_file,
-            channel_name=channel
-        )
+    # Một observer duy nhất cho mọi channel, channel mới được phát hiện khi app đang chạy
+    watcher_service.start(
+        scripts_dir,
+        process_callback=process_script_file,
+        channel_callback=process_new_channel
+    )
+    channels = sorted(watcher_service.channels)
+
+    # Các file có sẵn được liệt kê và đưa vào hàng đợi ở background,
+    # scheduler sẽ xử lý chúng theo số worker đã cấu hình.
+    # Giữ tham chiếu tới task để task không bị thu hồi khi đang chạy
+    app.state.backlog_task = asyncio.create_task(enqueue_backlog(channels))
+    app.state.backlog_task.add_done_callback(_log_backlog_result)
         
     logger.info(f"Đã khởi động watcher cho các channel: {channels}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Dừng tất cả các watcher khi app dừng"""
-    watcher_service.stop_all()
-    logger.info("Đã dừng tất cả các watcher")
+    watcher_service.stop()
+    logger.info("Đã dừng watcher")
+    backlog_task = getattr(app.state, 'backlog_task', None)
+    if backlog_task is not None:
+        backlog_task.cancel()
+        await asyncio.gather(backlog_task, return_exceptions=True)
+    await admission.stop()
+    await scheduler.stop()
+    await voice_service.stop()
+    await video_service.stop()
+    await http_client.aclose()
+    await wal_checkpointer.stop()
+    await async_engine.dispose()
 
 if __name__ == "__main__":
     import uvicorn
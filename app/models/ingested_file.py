@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index, UniqueConstraint
+from datetime import datetime
+from .script import Base
+
+class IngestedFile(Base):
+    """File script đã được đưa vào hàng đợi, dùng để chống tạo job trùng"""
+    __tablename__ = "ingested_files"
+    __table_args__ = (
+        UniqueConstraint('content_hash', 'file_path', name='uq_ingested_files_hash_path'),
+        Index('ix_ingested_files_path', 'file_path'),
+        Index('ix_ingested_files_last_seen', 'last_seen_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    file_path = Column(String, nullable=False)
+    mtime = Column(Float, nullable=True)
+    size = Column(Integer, nullable=True)
+    first_seen_at = Column(DateTime, default=datetime.utcnow)
+    last_seen_at = Column(DateTime, default=datetime.utcnow)
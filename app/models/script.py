@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Enum as SQLEnum, DateTime
+from sqlalchemy import Column, Integer, String, Enum as SQLEnum, DateTime, Index
 from sqlalchemy.orm import declarative_base
 import enum
 from datetime import datetime
@@ -7,6 +7,7 @@ Base = declarative_base()
 
 class ScriptStatus(str, enum.Enum):
     PENDING = "PENDING"
+    PROCESSING = "PROCESSING"
     VOICE_DONE = "VOICE_DONE"
     COMPLETED = "COMPLETED"
     ERROR = "ERROR"
@@ -15,6 +16,15 @@ class ScriptStatus(str, enum.Enum):
 
 class Script(Base):
     __tablename__ = "scripts"
+    __table_args__ = (
+        # claim / đếm backlog (status IN các trạng thái chưa kết thúc) và danh sách
+        # script theo trạng thái; index SQLite luôn chứa id nên không cần index riêng
+        Index('ix_scripts_status_created', 'status', 'created_at'),
+        # Kiểm tra file đã có job chưa kết thúc khi enqueue
+        Index('ix_scripts_file_path_status', 'file_path', 'status'),
+        # Danh sách script theo channel / trạng thái
+        Index('ix_scripts_channel_status_created', 'channel_name', 'status', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     file_name = Column(String, nullable=False)
@@ -23,8 +33,20 @@ class Script(Base):
     status = Column(SQLEnum(ScriptStatus), default=ScriptStatus.PENDING)
     error_message = Column(String, nullable=True)
     audio_path = Column(String, nullable=True)
+    srt_path = Column(String, nullable=True)
     video_path = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     voice_task_id = Column(String, nullable=True)
     video_task_id = Column(String, nullable=True)
+    # Render node đã nhận video_task_id, task id chỉ có nghĩa trên node đó
+    video_node_url = Column(String, nullable=True)
+    video_submitted_at = Column(DateTime, nullable=True)
+    # Thông tin render đang chạy, dùng để theo dõi tiếp sau khi khởi động lại
+    video_output_name = Column(String, nullable=True)
+    overlay2_name = Column(String, nullable=True)
+    callback_url = Column(String, nullable=True)
+    # Lease của worker đang xử lý job (xem services/job_queue.py)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
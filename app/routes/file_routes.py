@@ -1,9 +1,15 @@
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import Dict
-from ..database import get_db
-from ..models.script import Script, ScriptStatus
-from ..tasks import process_script_task
+import os
+import uuid
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Tuple
+from ..database import get_async_db
+from ..models.script import Script
+from ..tasks import admission, render_reconciler
+from ..services.admission import BacklogFull
+from ..utils.logging_config import logger
+from ..config.paths import BULK_MAX_SCRIPTS, get_channel_dir, get_channel_inbox_dir
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -14,93 +20,195 @@ class ScriptRequest(BaseModel):
     callback_url: str = None
     callback_id: str = None
 
-    class Config:scripts/
+    class Config:
         from_attributes = True
 
 @router.post("/process_script")
-async def process_script(
-    script_data: ScriptRequest,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
-):
+async def process_script(script_data: ScriptRequest):
     """
     Endpoint để xử lý script file
     """
     try:
-        # Tạo task ID
-        task_id = f"task_{script_data.callback_id}" if script_data.callback_id else None
-
-        # Tạo script record trong database
-        script = Script(
-            file_path=script_data.file_path,
-            channel_name=script_data.channel_name,
-            status=ScriptStatus.pending
+        # Thêm script vào hàng đợi nếu backlog còn chỗ, scheduler sẽ xử lý
+        # (truy cập database trong thread riêng để không chặn event loop)
+        script_id = await asyncio.to_thread(
+            admission.try_admit,
+            script_data.file_path,
+            script_data.channel_name,
+            callback_url=script_data.callback_url
         )
-        db.add(script)
-        db.commit()
-        db.refresh(script)
-
-        # Thêm task vào background
-        background_tasks.add_task(
-            process_script_task,
-            task_id=task_id,
-            file_path=script_data.file_path,
-            channel_name=script_data.channel_name,
-            callback_url=script_data.callback_url,
-            callback_id=script_data.callback_id,
-            db=db
+    except BacklogFull:
+        raise HTTPException(
+            status_code=429,
+            detail="Backlog is full, retry later",
+            headers={"Retry-After": str(admission.retry_after)}
         )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return {
-            "task_id": task_id,
-            "script_id": script.id,
-            "status": "processing"
-        }
+    if script_id is None:
+        # File đã được nhận trước đó (watcher khác hoặc request trùng)
+        return {"task_id": None, "script_id": None, "status": "duplicate"}
+    return {
+        "task_id": f"script_{script_id}",
+        "script_id": script_id,
+        "status": "queued"
+    }
+
+class BulkScriptItem(BaseModel):
+    """Một script trong request bulk: đường dẫn file có sẵn (file_path) hoặc nội dung (text)"""
+    file_path: str = None
+    text: str = None
+    file_name: str = None
+    channel_name: str = None
+    callback_url: str = None
+
+class BulkScriptRequest(BaseModel):
+    scripts: List[BulkScriptItem]
+    # Giá trị mặc định cho các script không chỉ định riêng
+    channel_name: str = None
+    callback_url: str = None
+
+def _valid_name(name: str) -> bool:
+    return bool(name) and os.path.basename(name) == name and not name.startswith('.')
+
+def _prepare_bulk(request: BulkScriptRequest) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Kiểm tra các script của request bulk, trả về (items, errors).
+    Script dạng text được gán đường dẫn trong thư mục inbox của channel (chưa ghi file).
+    """
+    items, errors, paths = [], [], set()
+    for index, script in enumerate(request.scripts):
+        channel_name = script.channel_name or request.channel_name
+        if (script.file_path is None) == (script.text is None):
+            error = "Exactly one of file_path or text is required"
+        elif not channel_name or not _valid_name(channel_name):
+            error = "Invalid channel_name"
+        elif script.file_path is not None and not os.path.isfile(script.file_path):
+            error = "File not found"
+        elif script.text is not None and not script.text.strip():
+            error = "Empty script text"
+        elif script.text is not None and not os.path.isdir(get_channel_dir(channel_name)):
+            error = "Channel not found"
+        elif script.file_name is not None and not _valid_name(script.file_name):
+            error = "Invalid file_name"
+        else:
+            error = None
+        if error is None:
+            file_path = script.file_path
+            if file_path is None:
+                inbox_dir = get_channel_inbox_dir(channel_name)
+                name, ext = os.path.splitext(script.file_name or f"script_{uuid.uuid4().hex[:12]}.txt")
+                file_path = os.path.join(inbox_dir, name + (ext or '.txt'))
+                if os.path.exists(file_path) or file_path in paths:
+                    file_path = os.path.join(inbox_dir, f"{name}_{uuid.uuid4().hex[:8]}{ext or '.txt'}")
+            if file_path in paths:
+                error = "Duplicate file_path in request"
+            else:
+                paths.add(file_path)
+                items.append({
+                    'file_path': file_path,
+                    'channel_name': channel_name,
+                    'callback_url': script.callback_url or request.callback_url,
+                    'text': script.text,
+                })
+        if error is not None:
+            errors.append({"index": index, "error": error})
+    return items, errors
+
+def _submit_bulk(items: List[Dict]) -> List[Dict]:
+    """
+    Ghi các script dạng text vào inbox rồi đưa cả lô vào hàng đợi trong một transaction.
+    Nếu lô không được nhận (backlog đầy, lỗi database) thì xóa các file vừa ghi.
+    """
+    written = []
+    try:
+        for item in items:
+            if item['text'] is not None:
+                os.makedirs(os.path.dirname(item['file_path']), exist_ok=True)
+                with open(item['file_path'], 'x', encoding='utf-8') as f:
+                    f.write(item['text'])
+                written.append(item['file_path'])
+        return admission.try_admit_many([
+            {key: item[key] for key in ('file_path', 'channel_name', 'callback_url')}
+            for item in items
+        ])
+    except Exception:
+        for file_path in written:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        raise
+
+@router.post("/process_scripts")
+async def process_scripts(request: BulkScriptRequest):
+    """
+    Endpoint nhận nhiều script trong một request.
+    Mỗi script là đường dẫn file có sẵn hoặc nội dung (được ghi vào thư mục inbox
+    của channel). Cả lô được kiểm tra trước, rồi được thêm bằng một câu INSERT
+    nhiều dòng trong một transaction: hoặc tất cả được nhận, hoặc không script nào.
+    """
+    if not request.scripts:
+        raise HTTPException(status_code=422, detail="No scripts")
+    if len(request.scripts) > BULK_MAX_SCRIPTS:
+        raise HTTPException(status_code=413, detail=f"Too many scripts (max {BULK_MAX_SCRIPTS})")
+
+    items, errors = await asyncio.to_thread(_prepare_bulk, request)
+    if errors:
+        raise HTTPException(status_code=422, detail={"errors": errors})
 
+    try:
+        results = await asyncio.to_thread(_submit_bulk, items)
+    except BacklogFull:
+        raise HTTPException(
+            status_code=429,
+            detail="Backlog is full, retry later",
+            headers={"Retry-After": str(admission.retry_after)}
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    scripts = [
+        {
+            "index": index,
+            "task_id": f"script_{result['script_id']}" if result['script_id'] is not None else None,
+            **result,
+        }
+        for index, result in enumerate(results)
+    ]
+    queued = sum(1 for script in scripts if script["status"] == "queued")
+    logger.info(f"Nhận {len(scripts)} script qua /process_scripts, {queued} job mới")
+    return {"count": len(scripts), "queued": queued, "scripts": scripts}
+
 @router.get("/task_status/{script_id}")
-async def get_script_status(script_id: int, db: Session = Depends(get_db)):
+async def get_task_status(script_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Lấy trạng thái của script
     """
-    script = db.query(Script).filter(Script.id == script_id).first()
+    script = await db.get(Script, script_id)
     if not script:
         raise HTTPException(status_code=404, detail="Script not found")
-    
+
     return {
         "script_id": script.id,
         "status": script.status,
-        "error": script.error if script.error else None,
+        "error": script.error_message if script.error_message else None,
         "created_at": script.created_at,
         "updated_at": script.updated_at
     }
 
 @router.post("/task_callback/{callback_id}")
-async def task_callback(callback_id: str, payload: Dict, db: Session = Depends(get_db)):
+async def task_callback(callback_id: str, payload: Dict = None):
     """
-    Callback endpoint để nhận kết quả xử lý
+    Callback endpoint để video service báo kết quả render.
+    callback_id có dạng script_{id}. Callback chỉ đánh thức render_reconciler,
+    trạng thái render luôn được xác nhận lại với video service.
     """
-    try:
-        # Tìm script record dựa trên callback_id
-        script = db.query(Script).filter(Script.callback_id == callback_id).first()
-        if script:
-            # Cập nhật trạng thái
-            script.status = ScriptStatus.completed if payload.get('status') == 'completed' else ScriptStatus.failed
-            if payload.get('error'):
-                script.error = payload.get('error')
-            
-            # Lưu các đường dẫn file
-            if payload.get('audio_path'):
-                script.audio_path = payload.get('audio_path')
-            if payload.get('srt_path'):
-                script.srt_path = payload.get('srt_path')
-            if payload.get('video_path'):
-                script.video_path = payload.get('video_path')
-            
-            db.commit()
-            
-        return {"status": "success"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    prefix, _, script_id = callback_id.rpartition('_')
+    if prefix != 'script' or not script_id.isdigit():
+        raise HTTPException(status_code=404, detail="Unknown callback id")
+
+    tracked = render_reconciler.notify(int(script_id), payload or {})
+    logger.info(f"Nhận callback cho {callback_id} (đang theo dõi: {tracked}): {payload}")
+    return {"status": "success", "tracked": tracked}
@@ -0,0 +1,190 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func, select
+from .job_queue import ACTIVE_STATUSES
+from ..models.script import Script
+from ..config.paths import (
+    ADMISSION_MAX_BACKLOG,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_CHECK_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BacklogFull(Exception):
+    """Backlog đã đạt giới hạn, client cần thử lại sau retry_after giây"""
+
+
+class AdmissionController:
+    """
+    Giới hạn lượng công việc được đưa vào hệ thống.
+
+    Backlog là số job chưa kết thúc trong bảng scripts. Khi backlog đạt
+    max_backlog, API nhận script trả về 429 kèm Retry-After, còn file do
+    watcher/quét khởi động phát hiện được để nguyên trong thư mục channel và
+    ghi vào danh sách chờ; danh sách này được đưa dần vào hàng đợi khi
+    backlog giảm xuống. max_backlog <= 0 là không giới hạn.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        max_backlog: int = ADMISSION_MAX_BACKLOG,
+        retry_after: int = ADMISSION_RETRY_AFTER,
+        check_interval: float = ADMISSION_CHECK_INTERVAL,
+        cache_seconds: float = 1.0,
+    ):
+        self.scheduler = scheduler
+        self.max_backlog = max_backlog
+        self.retry_after = retry_after
+        self.check_interval = check_interval
+        self.cache_seconds = cache_seconds
+        self._lock = threading.Lock()
+        self._backlog = 0
+        self._backlog_at = 0.0
+        # file_path -> channel_name, theo thứ tự phát hiện
+        self._deferred: "OrderedDict[str, str]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"admitted": 0, "deferred": 0, "rejected": 0}
+
+    @property
+    def limited(self) -> bool:
+        return self.max_backlog > 0
+
+    def _count_backlog(self) -> int:
+        with self.scheduler.job_queue.session_factory() as db:
+            return db.execute(
+                select(func.count(Script.id)).where(Script.status.in_(ACTIVE_STATUSES))
+            ).scalar() or 0
+
+    def backlog(self) -> int:
+        """Số job chưa kết thúc, được cache trong cache_seconds để tránh query liên tục"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._backlog_at < self.cache_seconds:
+                return self._backlog
+        count = self._count_backlog()
+        with self._lock:
+            self._backlog, self._backlog_at = count, now
+        return count
+
+    def available(self) -> int:
+        """Số job còn có thể nhận thêm"""
+        if not self.limited:
+            return 1 << 30
+        return max(0, self.max_backlog - self.backlog())
+
+    def _note_admitted(self, count: int):
+        with self._lock:
+            self._backlog += count
+            self._counters["admitted"] += count
+
+    def try_admit(self, file_path: str, channel_name: str, callback_url: str = None) -> Optional[int]:
+        """
+        Đưa script vào hàng đợi nếu còn chỗ, trả về id job hoặc None nếu file đã được nhận trước đó.
+        Raise BacklogFull nếu backlog đã đầy.
+        """
+        if self.available() <= 0:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise BacklogFull()
+        job_id = self.scheduler.enqueue(file_path, channel_name, callback_url=callback_url)
+        if job_id is not None:
+            self._note_admitted(1)
+        return job_id
+
+    def try_admit_many(self, items: List[Dict]) -> List[Dict]:
+        """
+        Đưa cả lô script vào hàng đợi trong một transaction, trả về kết quả từng script
+        (JobQueue.enqueue_batch). Raise BacklogFull nếu backlog không đủ chỗ cho cả lô.
+        """
+        if self.available() < len(items):
+            with self._lock:
+                self._counters["rejected"] += len(items)
+            raise BacklogFull()
+        results = self.scheduler.enqueue_batch(items)
+        self._note_admitted(sum(1 for result in results if result['status'] == 'queued'))
+        return results
+
+    def admit_or_defer(self, file_path: str, channel_name: str) -> bool:
+        """Dùng cho file phát hiện trong thư mục: nếu backlog đầy thì để file lại và thử sau"""
+        if self.available() > 0:
+            if self.scheduler.enqueue(file_path, channel_name) is not None:
+                self._note_admitted(1)
+            return True
+        self.defer([{'file_path': file_path, 'channel_name': channel_name}])
+        return False
+
+    def admit_many(self, items: List[Dict]) -> Tuple[int, int]:
+        """
+        Đưa nhiều file vào hàng đợi trong giới hạn backlog, phần còn lại vào danh sách chờ.
+        Trả về (số job được thêm, số file phải chờ).
+        """
+        free = self.available()
+        admitted = self.scheduler.enqueue_many(items[:free])
+        self._note_admitted(admitted)
+        deferred = items[free:]
+        self.defer(deferred)
+        return admitted, len(deferred)
+
+    def defer(self, items: List[Dict]):
+        if not items:
+            return
+        with self._lock:
+            for item in items:
+                self._deferred[item['file_path']] = item['channel_name']
+            self._counters["deferred"] += len(items)
+        logger.info(f"Backlog đã đầy, {len(items)} file được để lại trong thư mục và sẽ xử lý sau")
+
+    def _admit_deferred(self) -> int:
+        free = self.available()
+        if free <= 0:
+            return 0
+        with self._lock:
+            batch = []
+            while self._deferred and len(batch) < free:
+                file_path, channel_name = self._deferred.popitem(last=False)
+                batch.append({'file_path': file_path, 'channel_name': channel_name})
+        # File có thể đã bị xóa/di chuyển trong lúc chờ
+        batch = [item for item in batch if os.path.exists(item['file_path'])]
+        admitted = self.scheduler.enqueue_many(batch)
+        self._note_admitted(admitted)
+        return admitted
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if not self._deferred:
+                continue
+            try:
+                admitted = await asyncio.to_thread(self._admit_deferred)
+                if admitted:
+                    logger.info(f"Đã đưa {admitted} file đang chờ vào hàng đợi, còn {len(self._deferred)} file")
+            except Exception as e:
+                logger.error(f"Lỗi khi đưa file đang chờ vào hàng đợi: {e}")
+
+    def start(self):
+        """Khởi động vòng lặp đưa file đang chờ vào hàng đợi"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        """Backlog hiện tại và số file đang chờ"""
+        return {
+            "max_backlog": self.max_backlog,
+            "backlog": self.backlog(),
+            "waiting_files": len(self._deferred),
+            **self._counters,
+        }
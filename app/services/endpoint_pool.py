@@ -0,0 +1,333 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
+import httpx
+from ..utils.http_client import http_client
+from ..config.paths import (
+    ENDPOINT_HEALTH_INTERVAL,
+    ENDPOINT_FAILURE_THRESHOLD,
+    ENDPOINT_ADAPTIVE_CONCURRENCY,
+    ENDPOINT_MIN_CONCURRENCY,
+    ENDPOINT_INITIAL_CONCURRENCY,
+    ENDPOINT_MAX_CONCURRENCY,
+    ENDPOINT_DECREASE_FACTOR,
+    ENDPOINT_PROBE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Số lần thay đổi giới hạn gần nhất được giữ lại để theo dõi
+LIMIT_HISTORY = 20
+# Hệ số giảm khi request chậm hơn latency_target (nhẹ hơn khi lỗi)
+SLOW_DECREASE_FACTOR = 0.9
+
+# Trạng thái circuit breaker của endpoint
+CIRCUIT_CLOSED = "closed"        # Hoạt động bình thường
+CIRCUIT_OPEN = "open"            # Bị loại khỏi vòng quay, chỉ nhận health probe
+CIRCUIT_HALF_OPEN = "half_open"  # Probe thành công, cho một request thử
+
+
+class CircuitOpenError(Exception):
+    """Tất cả endpoint trong pool đang mở circuit breaker (service downstream đang lỗi)"""
+
+
+def is_downstream_unavailable(error: BaseException) -> bool:
+    """Lỗi do service downstream không khả dụng (không phải lỗi của chính job)"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (CircuitOpenError, httpx.TransportError))
+
+
+class Endpoint:
+    """
+    Một server downstream trong pool.
+
+    Nếu adaptive, số request đồng thời (limit) được điều chỉnh theo AIMD:
+    mỗi request thành công khi endpoint đang chạy hết giới hạn cộng thêm
+    1/limit (tức +1 sau mỗi "vòng" request), mỗi timeout/lỗi 5xx nhân limit
+    với decrease_factor. max_outstanding là trần của limit; limit bắt đầu từ
+    trần (hoặc initial_limit nếu nhỏ hơn) để endpoint chạy hết công suất đã
+    cấu hình ngay từ đầu, AIMD chỉ giảm khi endpoint lỗi/chậm.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        max_outstanding: Optional[int] = None,
+        adaptive: bool = ENDPOINT_ADAPTIVE_CONCURRENCY,
+        min_limit: int = ENDPOINT_MIN_CONCURRENCY,
+        initial_limit: Optional[int] = ENDPOINT_INITIAL_CONCURRENCY,
+        decrease_factor: float = ENDPOINT_DECREASE_FACTOR,
+    ):
+        self.url = url.rstrip('/')
+        self.max_outstanding = max_outstanding
+        self.adaptive = adaptive
+        self.decrease_factor = decrease_factor
+        if adaptive:
+            self.max_limit = max_outstanding or ENDPOINT_MAX_CONCURRENCY
+            self.min_limit = max(1, min(min_limit, self.max_limit))
+            initial = self.max_limit if initial_limit is None else initial_limit
+            self.limit: Optional[float] = float(min(max(initial, self.min_limit), self.max_limit))
+        else:
+            self.max_limit = self.min_limit = max_outstanding
+            self.limit = float(max_outstanding) if max_outstanding else None
+        self.limit_history = deque(maxlen=LIMIT_HISTORY)
+        self.outstanding = 0
+        self.state = CIRCUIT_CLOSED
+        # Đã có request thử đang chạy ở trạng thái half-open. Không dùng outstanding
+        # vì các request gửi trước khi circuit mở (render dài) vẫn có thể đang chạy
+        self.probe_in_flight = False
+        self.opened_at: Optional[datetime] = None
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.state != CIRCUIT_OPEN
+
+    def has_capacity(self) -> bool:
+        if self.state == CIRCUIT_OPEN:
+            return False
+        if self.state == CIRCUIT_HALF_OPEN:
+            # Chỉ cho một request thử tại một thời điểm
+            return not self.probe_in_flight
+        return self.limit is None or self.outstanding < int(self.limit)
+
+    def _set_limit(self, limit: float, reason: str):
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(limit) != int(self.limit):
+            self.limit_history.append({
+                'at': datetime.utcnow().isoformat(timespec='seconds'),
+                'from': int(self.limit),
+                'to': int(limit),
+                'reason': reason,
+            })
+            logger.info(f"Endpoint {self.url}: giới hạn đồng thời {int(self.limit)} -> {int(limit)} ({reason})")
+        self.limit = limit
+
+    def record_result(self, error: Optional[Exception], latency: Optional[float], latency_target: Optional[float]):
+        """Điều chỉnh limit theo kết quả của một request (gọi trước khi giảm outstanding)"""
+        if not self.adaptive:
+            return
+        if error is not None:
+            self._set_limit(self.limit * self.decrease_factor, f"lỗi: {type(error).__name__}")
+        elif latency_target and latency is not None and latency > latency_target:
+            self._set_limit(self.limit * SLOW_DECREASE_FACTOR, f"chậm: {latency:.1f}s > {latency_target}s")
+        elif self.outstanding >= int(self.limit):
+            # Chỉ tăng khi endpoint thực sự chạy hết giới hạn hiện tại
+            self._set_limit(self.limit + 1 / self.limit, "request thành công khi đang đầy tải")
+
+    def stats(self) -> Dict:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'circuit': self.state,
+            'opened_at': self.opened_at.isoformat(timespec='seconds') if self.opened_at else None,
+            'outstanding': self.outstanding,
+            'probe_in_flight': self.probe_in_flight,
+            'max_outstanding': self.max_outstanding,
+            'limit': int(self.limit) if self.limit is not None else None,
+            'adaptive': self.adaptive,
+            'limit_history': list(self.limit_history),
+            'total_requests': self.total_requests,
+            'total_failures': self.total_failures,
+            'last_error': self.last_error,
+        }
+
+
+class EndpointPool:
+    """
+    Pool các endpoint cùng loại (voice, XTTS...) với cân bằng tải.
+
+    Mỗi request được gửi tới endpoint khỏe có ít request đang chờ nhất.
+    Mỗi endpoint có một circuit breaker: lỗi kết nối/5xx liên tiếp
+    `failure_threshold` lần thì mở (open), endpoint bị loại khỏi vòng quay.
+    Health check chạy nền probe endpoint đang mở với timeout ngắn, probe
+    thành công chuyển sang half-open để chạy một request thử; request thử
+    thành công thì đóng lại (closed), lỗi thì mở lại.
+
+    Nếu các endpoint đều đang bận, acquire() chờ tới khi có. Nếu tất cả
+    circuit đều mở, acquire() raise CircuitOpenError ngay để job được tạm
+    dừng thay vì chờ hoặc bị đánh lỗi.
+
+    `urls` là danh sách URL hoặc cặp (URL, giới hạn request đồng thời riêng).
+    Giới hạn của mỗi endpoint được điều chỉnh theo AIMD (xem Endpoint),
+    latency_target là thời gian xử lý tối đa được coi là bình thường.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        urls: List[Union[str, Tuple[str, int]]],
+        max_outstanding: Optional[int] = None,
+        health_interval: float = ENDPOINT_HEALTH_INTERVAL,
+        failure_threshold: int = ENDPOINT_FAILURE_THRESHOLD,
+        latency_target: Optional[float] = None,
+        probe_timeout: float = ENDPOINT_PROBE_TIMEOUT,
+    ):
+        if not urls:
+            raise ValueError(f"Pool {name} cần ít nhất một endpoint")
+        self.name = name
+        self.endpoints = [
+            Endpoint(*item) if isinstance(item, tuple) else Endpoint(item, max_outstanding)
+            for item in urls
+        ]
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.latency_target = latency_target
+        self.probe_timeout = probe_timeout
+        self._available: Optional[asyncio.Condition] = None
+        self._health_task: Optional[asyncio.Task] = None
+
+    @property
+    def urls(self) -> List[str]:
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def _condition(self) -> asyncio.Condition:
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+
+    @property
+    def all_open(self) -> bool:
+        """Tất cả endpoint đều đang mở circuit"""
+        return all(e.state == CIRCUIT_OPEN for e in self.endpoints)
+
+    def _pick(self) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.has_capacity()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: (e.outstanding, e.total_requests))
+
+    async def acquire(self) -> Endpoint:
+        """
+        Chọn endpoint có ít request đang chờ nhất, chờ nếu chưa có endpoint khả dụng.
+        Raise CircuitOpenError nếu tất cả endpoint đang mở circuit.
+        """
+        condition = self._condition()
+        async with condition:
+            while True:
+                if self.all_open:
+                    raise CircuitOpenError(f"Tất cả {self.name} endpoint đang lỗi: {self.urls}")
+                endpoint = self._pick()
+                if endpoint is not None:
+                    break
+                await condition.wait()
+            if endpoint.state == CIRCUIT_HALF_OPEN:
+                endpoint.probe_in_flight = True
+            endpoint.outstanding += 1
+            endpoint.total_requests += 1
+            return endpoint
+
+    def get(self, url: str) -> Optional[Endpoint]:
+        """Tìm endpoint theo URL"""
+        url = url.rstrip('/')
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        return None
+
+    async def attach(self, url: str) -> Optional[Endpoint]:
+        """
+        Tính một request đã được gửi từ trước (ví dụ render đang chạy khi app
+        khởi động lại) vào tải của endpoint, kể cả khi vượt giới hạn
+        """
+        endpoint = self.get(url)
+        if endpoint is not None:
+            async with self._condition():
+                endpoint.outstanding += 1
+        return endpoint
+
+    async def release(self, endpoint: Endpoint, error: Optional[Exception] = None,
+                      latency: Optional[float] = None):
+        """
+        Trả endpoint về pool. `error` là lỗi kết nối/server (không phải lỗi
+        nghiệp vụ), dùng để quyết định loại endpoint khỏi vòng quay và giảm
+        giới hạn đồng thời. `latency` là thời gian xử lý request (giây).
+        """
+        condition = self._condition()
+        async with condition:
+            endpoint.record_result(error, latency, self.latency_target)
+            endpoint.outstanding -= 1
+            # Kết quả của bất kỳ request nào ở trạng thái half-open đều quyết định
+            # đóng/mở lại circuit, sau đó không còn request thử nào cần chờ
+            endpoint.probe_in_flight = False
+            if error is None:
+                endpoint.consecutive_failures = 0
+                if endpoint.state == CIRCUIT_HALF_OPEN:
+                    endpoint.state = CIRCUIT_CLOSED
+                    endpoint.opened_at = None
+                    logger.info(f"Đóng circuit {self.name} endpoint {endpoint.url}, đưa trở lại vòng quay")
+            else:
+                endpoint.total_failures += 1
+                endpoint.consecutive_failures += 1
+                endpoint.last_error = str(error)
+                if (endpoint.state == CIRCUIT_HALF_OPEN
+                        or (endpoint.state == CIRCUIT_CLOSED
+                            and endpoint.consecutive_failures >= self.failure_threshold)):
+                    endpoint.state = CIRCUIT_OPEN
+                    endpoint.opened_at = datetime.utcnow()
+                    logger.warning(f"Mở circuit {self.name} endpoint {endpoint.url}, loại khỏi vòng quay: {error}")
+            condition.notify_all()
+
+    @asynccontextmanager
+    async def lease(self):
+        """Giữ một endpoint trong suốt thời gian xử lý request"""
+        endpoint = await self.acquire()
+        error = None
+        start = time.monotonic()
+        try:
+            yield endpoint
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            error = e
+            raise
+        finally:
+            await self.release(endpoint, error, time.monotonic() - start)
+
+    async def _half_open(self, endpoint: Endpoint):
+        condition = self._condition()
+        async with condition:
+            if endpoint.state == CIRCUIT_OPEN:
+                endpoint.state = CIRCUIT_HALF_OPEN
+                endpoint.probe_in_flight = False
+            condition.notify_all()
+        logger.info(f"{self.name} endpoint {endpoint.url} đã phản hồi, chuyển circuit sang half-open")
+
+    async def _probe(self, endpoint: Endpoint) -> bool:
+        try:
+            response = await http_client.get(
+                endpoint.url, read_timeout=self.probe_timeout, total_timeout=self.probe_timeout
+            )
+            return response.status_code < 500
+        except httpx.HTTPError:
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            opened = [e for e in self.endpoints if e.state == CIRCUIT_OPEN]
+            results = await asyncio.gather(*(self._probe(e) for e in opened))
+            for endpoint, ok in zip(opened, results):
+                if ok:
+                    await self._half_open(endpoint)
+
+    def start(self):
+        """Khởi động health check chạy nền"""
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+    def stats(self) -> List[Dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
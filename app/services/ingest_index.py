@@ -0,0 +1,159 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+from ..models.ingested_file import IngestedFile
+from ..config.paths import INGEST_DEDUP_TTL_HOURS, INGEST_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Chu kỳ (giây) xóa các bản ghi đã hết hạn
+EVICT_INTERVAL = 3600
+
+
+class FileFingerprint:
+    """Đường dẫn, mtime, kích thước và (khi cần) hash nội dung của một file"""
+
+    def __init__(self, file_path: str, mtime: float, size: int):
+        self.file_path = file_path
+        self.mtime = mtime
+        self.size = size
+        self._content_hash: Optional[str] = None
+
+    @property
+    def key(self):
+        return (self.file_path, self.mtime, self.size)
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            digest = hashlib.sha256()
+            with open(self.file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+
+class IngestIndex:
+    """
+    Chỉ mục bền vững các file đã được đưa vào hàng đợi (bảng ingested_files).
+
+    Một file được coi là trùng nếu cùng đường dẫn và cùng nội dung (sha256)
+    với một file đã nhận trong INGEST_DEDUP_TTL_HOURS giờ gần nhất. Đường dẫn
+    + mtime + kích thước được kiểm tra trước, nên event lặp lại của cùng một
+    file không cần đọc lại nội dung. Phía trước database là một cache LRU
+    trong bộ nhớ có kích thước cố định. Bản ghi được ghi trong cùng
+    transaction với job, nên mỗi file chỉ tạo đúng một job kể cả khi nhiều
+    watcher/process cùng phát hiện file đó (unique constraint).
+    """
+
+    def __init__(self, ttl_hours: float = INGEST_DEDUP_TTL_HOURS, cache_size: int = INGEST_CACHE_SIZE):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, bool]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_evict = 0.0
+
+    def fingerprint(self, file_path: str) -> Optional[FileFingerprint]:
+        """Lấy thông tin file, None nếu file không tồn tại trên máy này"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return FileFingerprint(file_path, st.st_mtime, st.st_size)
+
+    def seen(self, fp: FileFingerprint) -> bool:
+        """Kiểm tra nhanh trong cache bộ nhớ"""
+        with self._lock:
+            if fp.key in self._cache:
+                self._cache.move_to_end(fp.key)
+                return True
+        return False
+
+    def remember(self, fp: FileFingerprint):
+        with self._lock:
+            self._cache[fp.key] = True
+            self._cache.move_to_end(fp.key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def forget(self, file_path: str):
+        """Xóa file khỏi cache bộ nhớ (mọi mtime/kích thước)"""
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == file_path]:
+                del self._cache[key]
+
+    def filter_new(self, db: Session, fps: List[FileFingerprint]) -> List[FileFingerprint]:
+        """Trả về các file chưa từng được nhận (trong thời hạn TTL)"""
+        fps = [fp for fp in fps if not self.seen(fp)]
+        if not fps:
+            return []
+        cutoff = datetime.utcnow() - self.ttl
+        paths = list({fp.file_path for fp in fps})
+        rows = db.execute(
+            select(IngestedFile.file_path, IngestedFile.mtime, IngestedFile.size, IngestedFile.content_hash)
+            .where(IngestedFile.file_path.in_(paths), IngestedFile.last_seen_at >= cutoff)
+        ).all()
+        known_stats = {(r.file_path, r.mtime, r.size) for r in rows}
+        known_hashes = {(r.file_path, r.content_hash) for r in rows}
+
+        new, duplicates = [], []
+        for fp in fps:
+            # mtime/size khớp thì không cần đọc nội dung file
+            if fp.key in known_stats or (fp.file_path, fp.content_hash) in known_hashes:
+                duplicates.append(fp)
+                self.remember(fp)
+            else:
+                new.append(fp)
+        if duplicates:
+            # File được phát hiện lại: gia hạn bản ghi
+            db.execute(
+                update(IngestedFile)
+                .where(IngestedFile.file_path.in_([fp.file_path for fp in duplicates]))
+                .values(last_seen_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+        return new
+
+    def record(self, db: Session, fps: List[FileFingerprint]):
+        """Ghi các file mới vào session (commit cùng với job), kèm xóa bản ghi hết hạn"""
+        now = datetime.utcnow()
+        self._evict_expired(db, now)
+        if fps:
+            # Bản ghi hết hạn nhưng chưa bị xóa của cùng file sẽ vi phạm unique constraint
+            db.execute(
+                delete(IngestedFile).where(
+                    IngestedFile.file_path.in_([fp.file_path for fp in fps]),
+                    IngestedFile.last_seen_at < now - self.ttl,
+                )
+            )
+        for fp in fps:
+            db.add(IngestedFile(
+                content_hash=fp.content_hash,
+                file_path=fp.file_path,
+                mtime=fp.mtime,
+                size=fp.size,
+                first_seen_at=now,
+                last_seen_at=now,
+            ))
+
+    def _evict_expired(self, db: Session, now: datetime):
+        if time.monotonic() - self._last_evict < EVICT_INTERVAL:
+            return
+        self._last_evict = time.monotonic()
+        result = db.execute(delete(IngestedFile).where(IngestedFile.last_seen_at < now - self.ttl))
+        if result.rowcount:
+            logger.info(f"Đã xóa {result.rowcount} bản ghi ingested_files hết hạn")
+
+    def stats(self) -> Dict[str, int]:
+        return {'cached': len(self._cache), 'cache_size': self.cache_size}
+
+
+ingest_index = IngestIndex()
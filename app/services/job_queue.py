@@ -0,0 +1,404 @@
+import os
+import socket
+import uuid
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import case, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from ..database import SessionLocal, AsyncSessionLocal
+from ..models.script import Script, ScriptStatus
+from ..models.ingested_file import IngestedFile
+from .ingest_index import FileFingerprint, ingest_index
+from .write_buffer import JobWriteBuffer
+from ..config.paths import JOB_LEASE_SECONDS, JOB_WRITE_BEHIND
+
+logger = logging.getLogger(__name__)
+
+# lease_owner của job đang tạm dừng, job được claim lại khi lease_expires_at hết hạn
+PAUSED_OWNER = "paused"
+
+# Các trạng thái job đã kết thúc, không bao giờ được claim lại
+TERMINAL_STATUSES = (
+    ScriptStatus.COMPLETED,
+    ScriptStatus.ERROR,
+    ScriptStatus.ERROR_VOICE,
+    ScriptStatus.ERROR_VIDEO,
+)
+# Các trạng thái còn lại. Điều kiện IN dùng được index theo status, NOT IN thì không
+ACTIVE_STATUSES = tuple(status for status in ScriptStatus if status not in TERMINAL_STATUSES)
+
+# Trả lại lần claim vừa tính vào attempts (không dùng max() hai tham số, chỉ SQLite hỗ trợ)
+_UNCOUNT_ATTEMPT = case((Script.attempts > 0, Script.attempts - 1), else_=0)
+
+
+class JobQueue:
+    """
+    Hàng đợi job bền vững dựa trên bảng scripts.
+
+    - claim() đánh dấu nhiều job cùng lúc bằng một câu UPDATE ... RETURNING,
+      điều kiện WHERE được kiểm tra lại nên hai worker không thể lấy cùng một job.
+    - Job chưa kết thúc giữ nguyên checkpoint của stage cuối cùng đã hoàn thành
+      (VOICE_DONE, audio_path, video_task_id...), worker claim lại sẽ chạy tiếp
+      từ checkpoint đó.
+    - Mỗi job được claim có lease; worker phải heartbeat() để gia hạn.
+      Job có lease hết hạn (worker bị crash) sẽ được claim lại.
+    - Mọi thao tác cập nhật trạng thái đều kiểm tra lease_owner, worker đã mất
+      lease sẽ không ghi đè kết quả của worker khác.
+    - claim, heartbeat và các thao tác cập nhật job là coroutine dùng session
+      async riêng cho mỗi lần gọi, không chặn event loop. enqueue/enqueue_many
+      đồng bộ, dùng từ thread (watcher, admission).
+    - Khi write-behind được bật (start()), checkpoint/complete/fail được gom
+      vào JobWriteBuffer và ghi theo lô; claim, heartbeat, release, postpone
+      luôn commit ngay và ghi kèm cập nhật đang chờ của job đó.
+    """
+
+    def __init__(self, session_factory=SessionLocal, lease_seconds: int = JOB_LEASE_SECONDS,
+                 async_session_factory=AsyncSessionLocal, write_behind: bool = JOB_WRITE_BEHIND):
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.write_behind = write_behind
+        self.write_buffer = JobWriteBuffer(async_session_factory)
+
+    def start(self):
+        """Bật write-behind trên event loop hiện tại"""
+        if self.write_behind:
+            self.write_buffer.start()
+
+    async def stop(self):
+        """Ghi nốt các cập nhật đang chờ"""
+        await self.write_buffer.stop()
+
+    def _lease_deadline(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def _claimable(self, now: datetime, statuses=ACTIVE_STATUSES):
+        return (
+            Script.status.in_(statuses)
+            & or_(
+                Script.lease_owner.is_(None),
+                Script.lease_expires_at.is_(None),
+                Script.lease_expires_at < now,
+            )
+        )
+
+    def enqueue(self, file_path: str, channel_name: str, callback_url: str = None) -> Optional[int]:
+        """
+        Thêm script vào hàng đợi, trả về id của job.
+        Nếu file đã có job chưa kết thúc thì trả về id của job đó.
+        Trả về None nếu file đã được nhận trước đó (ingest_index).
+        """
+        fp = ingest_index.fingerprint(file_path)
+        with self.session_factory() as db:
+            existing = db.execute(
+                select(Script.id).where(
+                    Script.file_path == file_path,
+                    Script.status.in_(ACTIVE_STATUSES),
+                )
+            ).scalar()
+            if existing is not None:
+                return existing
+
+            if fp is not None and ingest_index.seen(fp):
+                logger.info(f"Bỏ qua file đã được nhận trước đó: {file_path}")
+                return None
+            if fp is not None:
+                if not ingest_index.filter_new(db, [fp]):
+                    db.commit()
+                    logger.info(f"Bỏ qua file đã được nhận trước đó: {file_path}")
+                    return None
+                ingest_index.record(db, [fp])
+
+            script = Script(
+                file_name=os.path.basename(file_path),
+                file_path=file_path,
+                channel_name=channel_name,
+                status=ScriptStatus.PENDING,
+                callback_url=callback_url,
+                attempts=0,
+            )
+            db.add(script)
+            try:
+                db.commit()
+            except IntegrityError:
+                # Watcher/process khác vừa nhận cùng file
+                db.rollback()
+                if fp is not None:
+                    ingest_index.remember(fp)
+                logger.info(f"Bỏ qua file đã được nhận bởi watcher khác: {file_path}")
+                return None
+            if fp is not None:
+                ingest_index.remember(fp)
+            logger.info(f"Đã thêm job {script.id} vào hàng đợi: {file_path}")
+            return script.id
+
+    def enqueue_many(self, items: List[Dict]) -> int:
+        """
+        Thêm nhiều script vào hàng đợi trong một transaction.
+        Mỗi item là dict có file_path, channel_name (và callback_url nếu có).
+        Bỏ qua các file đã có job chưa kết thúc hoặc đã được nhận trước đó.
+        Trả về số job được thêm.
+        """
+        return sum(1 for result in self.enqueue_batch(items) if result['status'] == 'queued')
+
+    def enqueue_batch(self, items: List[Dict]) -> List[Dict]:
+        """
+        Thêm nhiều script vào hàng đợi bằng một câu INSERT nhiều dòng (RETURNING id)
+        trong một transaction. Mỗi item là dict có file_path, channel_name (và callback_url nếu có).
+        Trả về kết quả theo thứ tự của items, mỗi kết quả là dict có file_path, script_id và status:
+        - "queued": job mới được thêm;
+        - "active": file đã có job chưa kết thúc, script_id là id của job đó;
+        - "duplicate": file đã được nhận trước đó (ingest_index), script_id là None.
+        """
+        if not items:
+            return []
+        fingerprints = {}
+        for item in items:
+            fp = ingest_index.fingerprint(item['file_path'])
+            if fp is not None:
+                fingerprints[item['file_path']] = fp
+        try:
+            return self._insert_batch(items, fingerprints)
+        except IntegrityError:
+            # Một số file vừa được nhận bởi watcher/process khác,
+            # lần thử lại sẽ thấy các file đó trong ingested_files/scripts
+            logger.info("Một số file vừa được nhận bởi watcher khác, thêm lại lô")
+            return self._insert_batch(items, fingerprints)
+
+    def _insert_batch(self, items: List[Dict], fingerprints: Dict[str, FileFingerprint]) -> List[Dict]:
+        with self.session_factory() as db:
+            paths = [item['file_path'] for item in items]
+            active = dict(db.execute(
+                select(Script.file_path, Script.id).where(
+                    Script.file_path.in_(paths),
+                    Script.status.in_(ACTIVE_STATUSES),
+                )
+            ).all())
+            new_fps = {
+                fp.file_path: fp
+                for fp in ingest_index.filter_new(
+                    db, [fp for path, fp in fingerprints.items() if path not in active]
+                )
+            }
+            now = datetime.utcnow()
+            results, rows, recorded = [], [], []
+            for item in items:
+                path = item['file_path']
+                if path in active:
+                    # script_id là None nếu job được thêm bởi item trước đó trong cùng lô
+                    results.append({'file_path': path, 'script_id': active[path], 'status': 'active'})
+                    continue
+                if path in fingerprints:
+                    if path not in new_fps:
+                        results.append({'file_path': path, 'script_id': None, 'status': 'duplicate'})
+                        continue
+                    recorded.append(new_fps.pop(path))
+                active[path] = None
+                results.append({'file_path': path, 'script_id': None, 'status': 'queued'})
+                rows.append({
+                    'file_name': os.path.basename(path),
+                    'file_path': path,
+                    'channel_name': item['channel_name'],
+                    'callback_url': item.get('callback_url'),
+                    'status': ScriptStatus.PENDING,
+                    'attempts': 0,
+                    'created_at': now,
+                    'updated_at': now,
+                })
+            if rows:
+                ingest_index.record(db, recorded)
+                inserted = db.execute(insert(Script).returning(Script.file_path, Script.id), rows).all()
+                ids = dict(inserted)
+                for result in results:
+                    if result['script_id'] is None and result['status'] != 'duplicate':
+                        result['script_id'] = ids[result['file_path']]
+            db.commit()
+        for fp in recorded:
+            ingest_index.remember(fp)
+        if rows:
+            logger.info(f"Đã thêm {len(rows)} job vào hàng đợi")
+        return results
+
+    async def claim(self, limit: int = 1, statuses=ACTIVE_STATUSES) -> List[Dict]:
+        """
+        Claim tối đa `limit` job (chỉ các job có trạng thái thuộc `statuses`) trong một lần round-trip.
+        Trả về danh sách dict với thông tin của các job đã claim.
+        """
+        if limit <= 0:
+            return []
+        now = datetime.utcnow()
+        candidates = (
+            select(Script.id)
+            .where(self._claimable(now, statuses))
+            .order_by(Script.id)
+            .limit(limit)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(Script)
+            .where(Script.id.in_(candidates), self._claimable(now, statuses))
+            .values(
+                # Job mới chuyển sang PROCESSING, job đang dở giữ nguyên checkpoint
+                status=case(
+                    (Script.status == ScriptStatus.PENDING, ScriptStatus.PROCESSING.name),
+                    else_=Script.status,
+                ),
+                lease_owner=self.worker_id,
+                lease_expires_at=self._lease_deadline(),
+                attempts=func.coalesce(Script.attempts, 0) + 1,
+                updated_at=now,
+            )
+            .returning(
+                Script.id,
+                Script.file_path,
+                Script.channel_name,
+                Script.callback_url,
+                Script.attempts,
+                Script.status,
+                Script.audio_path,
+                Script.srt_path,
+                Script.video_task_id,
+                Script.video_node_url,
+                Script.video_submitted_at,
+                Script.video_output_name,
+                Script.overlay2_name,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        async with self.async_session_factory() as db:
+            rows = [dict(row._mapping) for row in await db.execute(stmt)]
+            await db.commit()
+        if rows:
+            logger.info(f"Worker {self.worker_id} đã claim {len(rows)} job: {[r['id'] for r in rows]}")
+        return rows
+
+    async def heartbeat(self, job_ids: List[int]) -> List[int]:
+        """
+        Gia hạn lease cho các job đang xử lý bằng một câu UPDATE.
+        Trả về danh sách job mà worker này vẫn còn giữ lease.
+        """
+        if not job_ids:
+            return []
+        stmt = (
+            update(Script)
+            .where(Script.id.in_(job_ids), Script.lease_owner == self.worker_id)
+            .values(lease_expires_at=self._lease_deadline())
+            .returning(Script.id)
+            .execution_options(synchronize_session=False)
+        )
+        async with self.async_session_factory() as db:
+            owned = [row.id for row in await db.execute(stmt)]
+            await db.commit()
+        lost = set(job_ids) - set(owned)
+        if lost:
+            logger.warning(f"Worker {self.worker_id} đã mất lease của các job: {sorted(lost)}")
+        return owned
+
+    async def update(self, job_id: int, **fields) -> bool:
+        """Cập nhật các trường của job nếu worker này còn giữ lease (commit ngay)"""
+        # Cập nhật đang chờ trong buffer được ghi cùng, cập nhật này ghi đè lên
+        buffered, waiters = await self.write_buffer.take(job_id)
+        fields = {**buffered, **fields}
+        fields.setdefault('updated_at', datetime.utcnow())
+        stmt = (
+            update(Script)
+            .where(Script.id == job_id, Script.lease_owner == self.worker_id)
+            .values(**fields)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            async with self.async_session_factory() as db:
+                result = await db.execute(stmt)
+                await db.commit()
+        except Exception as e:
+            for future in waiters:
+                future.set_exception(e)
+            raise
+        for future in waiters:
+            future.set_result(result.rowcount == 1)
+        return result.rowcount == 1
+
+    async def update_later(self, job_id: int, wait: bool = False, **fields) -> bool:
+        """
+        Cập nhật job qua write-behind buffer. wait=True chờ tới khi lô chứa
+        cập nhật được commit và trả về kết quả như update(); wait=False trả về
+        ngay. Nếu write-behind không chạy thì ghi ngay như update().
+        """
+        if not self.write_buffer.running:
+            return await self.update(job_id, **fields)
+        fields.setdefault('updated_at', datetime.utcnow())
+        future = self.write_buffer.put(job_id, self.worker_id, fields, wait=wait)
+        return await future if wait else True
+
+    async def checkpoint(self, job_id: int, **fields) -> bool:
+        """Lưu kết quả của một stage, job vẫn giữ lease (ghi theo lô, không chờ)"""
+        return await self.update_later(job_id, **fields)
+
+    async def complete(self, job_id: int, **fields) -> bool:
+        """Đánh dấu job hoàn thành và trả lease (chờ lô chứa cập nhật được commit)"""
+        return await self.update_later(
+            job_id,
+            wait=True,
+            status=ScriptStatus.COMPLETED,
+            lease_owner=None,
+            lease_expires_at=None,
+            **fields,
+        )
+
+    async def fail(self, job_id: int, status: ScriptStatus, error_message: str) -> bool:
+        """
+        Đánh dấu job lỗi và trả lease (chờ lô chứa cập nhật được commit).
+        File của job được xóa khỏi ingest_index: file được chuyển lại từ error/
+        vào thư mục channel để chạy lại không bị coi là trùng.
+        """
+        ok = await self.update_later(
+            job_id,
+            wait=True,
+            status=status,
+            error_message=error_message,
+            lease_owner=None,
+            lease_expires_at=None,
+        )
+        if ok:
+            await self._forget_ingested(job_id)
+        return ok
+
+    async def _forget_ingested(self, job_id: int):
+        async with self.async_session_factory() as db:
+            file_path = (await db.execute(select(Script.file_path).where(Script.id == job_id))).scalar()
+            if file_path is None:
+                return
+            await db.execute(delete(IngestedFile).where(IngestedFile.file_path == file_path))
+            await db.commit()
+        ingest_index.forget(file_path)
+
+    async def release(self, job_id: int, status: Optional[ScriptStatus] = ScriptStatus.PENDING,
+                      count_attempt: bool = True) -> bool:
+        """
+        Trả lease để job có thể được claim lại, status=None là giữ nguyên trạng thái hiện tại.
+        Nếu count_attempt=False, lần claim này không được tính vào attempts.
+        """
+        fields = {'lease_owner': None, 'lease_expires_at': None}
+        if status is not None:
+            fields['status'] = status
+        if not count_attempt:
+            fields['attempts'] = _UNCOUNT_ATTEMPT
+        return await self.update(job_id, **fields)
+
+    async def postpone(self, job_id: int, delay_seconds: float, status: Optional[ScriptStatus] = None,
+                       count_attempt: bool = True) -> bool:
+        """
+        Tạm dừng job: trả lease nhưng job chỉ được claim lại sau delay_seconds.
+        Nếu count_attempt=False, lần claim này không được tính vào attempts.
+        """
+        fields = {
+            'lease_owner': PAUSED_OWNER,
+            'lease_expires_at': datetime.utcnow() + timedelta(seconds=delay_seconds),
+        }
+        if status is not None:
+            fields['status'] = status
+        if not count_attempt:
+            fields['attempts'] = _UNCOUNT_ATTEMPT
+        return await self.update(job_id, **fields)
@@ -0,0 +1,254 @@
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from .scheduler_service import ScriptJob
+from .video_service import interpret_render_status, RENDER_RUNNING, RENDER_DONE, RENDER_FAILED
+from ..config.paths import (
+    RENDER_POLL_MIN_INTERVAL,
+    RENDER_POLL_MAX_INTERVAL,
+    RENDER_EXPECTED_SECONDS,
+    RENDER_TIMEOUT_SECONDS,
+    RENDER_POLL_CONCURRENCY,
+    RENDER_CALLBACKS,
+    RENDER_CALLBACK_POLL_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _Render:
+    """Một render đang chạy trên video service"""
+
+    def __init__(self, job: ScriptJob, submitted_at: datetime):
+        self.job = job
+        self.task_id = job.result['video_task_id']
+        self.node_url = job.result.get('video_node_url')
+        self.submitted_at = submitted_at
+        self.progress: Optional[float] = None
+        self.polls = 0
+        self.errors = 0
+        # Lỗi của lần kiểm tra gần nhất (kết nối/server), None nếu kiểm tra thành công
+        self.last_error: Optional[Exception] = None
+        self.due = 0.0
+
+    def elapsed(self) -> float:
+        return (datetime.utcnow() - self.submitted_at).total_seconds()
+
+
+class RenderReconciler:
+    """
+    Một vòng lặp duy nhất theo dõi tất cả render đang chạy.
+
+    Video worker chỉ submit render rồi giao job cho reconciler. Mỗi render có
+    thời điểm kiểm tra tiếp theo trong một heap; vòng lặp ngủ tới render đến
+    hạn sớm nhất, kiểm tra trạng thái các render đến hạn rồi xếp lịch lại.
+    Khoảng cách giữa các lần kiểm tra được tính từ tiến độ (progress) hoặc
+    thời gian render dự kiến, nên render còn lâu mới xong gần như không tốn
+    request nào. Render kết thúc được chuyển cho complete_handler/fail_handler.
+
+    Video service có thể báo kết quả qua callback (notify()). Callback chỉ
+    làm render được kiểm tra lại ngay, kết quả luôn được xác nhận bằng
+    /api/process/status nên callback giả mạo không thể hoàn tất job. Sau khi
+    đã nhận được callback, polling chỉ còn là dự phòng với chu kỳ dài.
+    """
+
+    def __init__(
+        self,
+        video_service,
+        complete_handler: Callable[[ScriptJob], Awaitable[bool]],
+        fail_handler: Callable[[ScriptJob, Exception], Awaitable[None]],
+        min_interval: float = RENDER_POLL_MIN_INTERVAL,
+        max_interval: float = RENDER_POLL_MAX_INTERVAL,
+        expected_seconds: float = RENDER_EXPECTED_SECONDS,
+        timeout_seconds: float = RENDER_TIMEOUT_SECONDS,
+        concurrency: int = RENDER_POLL_CONCURRENCY,
+        callbacks: bool = RENDER_CALLBACKS,
+        callback_poll_interval: float = RENDER_CALLBACK_POLL_INTERVAL,
+    ):
+        self.video_service = video_service
+        self.complete_handler = complete_handler
+        self.fail_handler = fail_handler
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.expected_seconds = expected_seconds
+        self.timeout_seconds = timeout_seconds
+        self.concurrency = max(1, concurrency)
+        self.callbacks = callbacks
+        self.callback_poll_interval = callback_poll_interval
+        # Chỉ giảm tần suất polling khi video service thực sự gửi callback
+        self._callback_seen = False
+        # Callback tới trước khi render được track
+        self._early_callbacks = set()
+        # Được scheduler gán, gọi khi job kết thúc (thành công hay lỗi)
+        self.on_finished: Optional[Callable[[ScriptJob, bool], None]] = None
+        self._renders: Dict[int, _Render] = {}
+        self._heap: List[Tuple[float, int]] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._finishing = set()
+        self._counters = {"polls": 0, "poll_errors": 0, "callbacks": 0, "completed": 0, "failed": 0}
+
+    def start(self):
+        """Khởi động vòng lặp theo dõi trên event loop hiện tại"""
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        tasks = list(self._finishing)
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def track(self, job: ScriptJob, submitted_at: Optional[datetime] = None):
+        """Bắt đầu theo dõi render của job (job.result phải có video_task_id)"""
+        render = _Render(job, submitted_at or datetime.utcnow())
+        self._renders[job.script_id] = render
+        job.stage = "rendering"
+        early = job.script_id in self._early_callbacks
+        self._early_callbacks.discard(job.script_id)
+        self._schedule(render, 0 if early else self.min_interval)
+        logger.info(f"Theo dõi render {render.task_id} của job {job.task_id}")
+
+    def notify(self, script_id: int, payload: Optional[Dict] = None) -> bool:
+        """
+        Nhận callback từ video service. Trả về True nếu render đang được
+        process này theo dõi.
+        """
+        self._counters["callbacks"] += 1
+        self._callback_seen = True
+        render = self._renders.get(script_id)
+        if render is None:
+            # Có thể là render của process khác, chỉ giữ một số lượng giới hạn
+            if len(self._early_callbacks) >= 1000:
+                self._early_callbacks.clear()
+            self._early_callbacks.add(script_id)
+            return False
+        _, progress, _ = interpret_render_status(payload)
+        if progress is not None:
+            render.progress = progress
+        self._schedule(render, 0)
+        return True
+
+    def _schedule(self, render: _Render, delay: float):
+        # Mỗi render chỉ có một lịch kiểm tra hợp lệ, các mục cũ trong heap bị bỏ qua
+        render.due = time.monotonic() + delay
+        heapq.heappush(self._heap, (render.due, render.job.script_id))
+        if self._wake is not None:
+            self._wake.set()
+
+    def _next_interval(self, render: _Render) -> float:
+        if render.errors:
+            # Lỗi khi gọi video service: lùi dần
+            interval = self.min_interval * (2 ** min(render.errors, 6))
+        else:
+            elapsed = render.elapsed()
+            if render.progress:
+                remaining = elapsed * (1 - render.progress) / render.progress
+            else:
+                remaining = self.expected_seconds - elapsed
+            # Kiểm tra lại sau khoảng 1/4 thời gian còn lại
+            interval = remaining / 4
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if self.callbacks and self._callback_seen:
+            # Callback sẽ báo khi render xong, polling chỉ để bắt callback bị mất
+            interval = max(interval, self.callback_poll_interval)
+        return interval
+
+    async def _loop(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def poll(render: _Render):
+            async with semaphore:
+                await self._poll(render)
+
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, script_id = heapq.heappop(self._heap)
+                render = self._renders.get(script_id)
+                if render is not None and render.due == deadline:
+                    due.append(render)
+            if due:
+                await asyncio.gather(*(poll(render) for render in due))
+                continue
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, render: _Render):
+        render.polls += 1
+        self._counters["polls"] += 1
+        try:
+            data = await self.video_service.check_status(render.task_id, render.node_url)
+            if data is None:
+                raise RuntimeError("video service không trả về trạng thái")
+        except Exception as e:
+            render.errors += 1
+            render.last_error = e
+            self._counters["poll_errors"] += 1
+            logger.warning(f"Không kiểm tra được render {render.task_id} (lần {render.errors}): {e}")
+            state, error = RENDER_RUNNING, None
+        else:
+            render.errors = 0
+            render.last_error = None
+            state, progress, error = interpret_render_status(data)
+            if progress is not None:
+                render.progress = progress
+
+        # Chỉ render quá hạn hoặc node không trả lời mới là lỗi của node;
+        # render thất bại do nội dung job (overlay hỏng...) không ảnh hưởng node
+        node_error = None
+        if state == RENDER_RUNNING and render.elapsed() > self.timeout_seconds:
+            state = RENDER_FAILED
+            error = f"Render {render.task_id} quá {self.timeout_seconds}s chưa hoàn thành"
+            node_error = render.last_error or asyncio.TimeoutError(error)
+
+        if state == RENDER_RUNNING:
+            self._schedule(render, self._next_interval(render))
+            return
+
+        self._renders.pop(render.job.script_id, None)
+        task = asyncio.create_task(self._finish(render, state == RENDER_DONE, error, node_error))
+        self._finishing.add(task)
+        task.add_done_callback(self._finishing.discard)
+
+    async def _finish(self, render: _Render, done: bool, error: Optional[str],
+                      node_error: Optional[Exception] = None):
+        job = render.job
+        ok = False
+        try:
+            # Render quá hạn/node không trả lời làm giảm số render đồng thời của node
+            await self.video_service.release_render(render.node_url, node_error, render.elapsed())
+            if done:
+                logger.info(f"Render {render.task_id} hoàn thành sau {render.elapsed():.0f}s, {render.polls} lần kiểm tra")
+                ok = await self.complete_handler(job)
+            else:
+                logger.error(f"Render {render.task_id} thất bại: {error}")
+                await self.fail_handler(job, RuntimeError(error))
+        except Exception as e:
+            logger.error(f"Lỗi khi hoàn tất render {render.task_id} của job {job.task_id}: {e}")
+        finally:
+            self._counters["completed" if ok else "failed"] += 1
+            if self.on_finished is not None:
+                self.on_finished(job, ok)
+
+    def stats(self) -> Dict[str, int]:
+        """Thống kê các render đang theo dõi"""
+        next_due = min((render.due for render in self._renders.values()), default=None)
+        return {
+            "rendering": len(self._renders),
+            "next_poll_in": round(max(0.0, next_due - time.monotonic()), 1) if next_due else None,
+            **self._counters,
+        }
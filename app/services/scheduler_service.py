@@ -0,0 +1,329 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+from .job_queue import ACTIVE_STATUSES, JobQueue
+from ..models.script import ScriptStatus
+from ..config.paths import (
+    VOICE_WORKERS, VIDEO_WORKERS, JOB_POLL_INTERVAL, VOICE_QUEUE_SIZE, VIDEO_QUEUE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# Job chưa xong voice, được claim theo chỗ trống của hàng đợi voice
+VOICE_STATUSES = tuple(status for status in ACTIVE_STATUSES if status != ScriptStatus.VOICE_DONE)
+
+
+class JobPaused(Exception):
+    """Stage handler đã tạm dừng job và trả về hàng đợi (service downstream không khả dụng)"""
+
+
+class ScriptJob:
+    """Trạng thái của một script khi đi qua các stage của pipeline"""
+
+    def __init__(self, task_id: str, file_path: str, channel_name: str,
+                 callback_url: str = None, script_id: int = None, attempts: int = 0):
+        self.task_id = task_id
+        self.script_id = script_id
+        self.attempts = attempts
+        self.file_path = file_path
+        self.channel_name = channel_name
+        self.callback_url = callback_url
+        self.stage = "queued"
+        # Kết quả của từng stage, được các stage handler điền vào
+        self.result: Dict[str, str] = {}
+
+    def __repr__(self):
+        return f"<ScriptJob {self.task_id} stage={self.stage}>"
+
+
+StageHandler = Callable[[ScriptJob], Awaitable[bool]]
+
+
+class JobScheduler:
+    """
+    Scheduler chạy pipeline theo stage với hai worker pool riêng biệt.
+
+    Voice và video có queue và số worker riêng, nên script N+1 có thể
+    tổng hợp giọng nói trong khi script N đang render. Throughput bị giới hạn
+    bởi stage chậm nhất thay vì tổng thời gian của cả hai stage.
+
+    Job được lấy từ JobQueue (bảng scripts) theo lô bằng claim, lease của
+    tất cả job đang xử lý được gia hạn bằng một heartbeat chung. Job đã có
+    checkpoint VOICE_DONE được đưa thẳng vào hàng đợi video.
+
+    Mỗi stage handler trả về True nếu job được chuyển tiếp sang stage sau,
+    False nếu job đã kết thúc (lỗi đã được handler xử lý), hoặc raise
+    JobPaused nếu job đã được trả về hàng đợi để chạy lại sau.
+
+    Hàng đợi của mỗi stage có kích thước giới hạn: feeder chỉ claim khi hàng
+    đợi voice còn chỗ, voice worker chờ khi hàng đợi video đầy, nên job dư
+    thừa nằm lại trong database thay vì dồn lên voice/video service.
+
+    Nếu có reconciler, video worker chỉ submit render rồi giao job cho
+    reconciler theo dõi tới khi render kết thúc, worker được giải phóng ngay.
+    """
+
+    def __init__(
+        self,
+        voice_handler: StageHandler,
+        video_handler: StageHandler,
+        job_queue: JobQueue,
+        voice_workers: int = VOICE_WORKERS,
+        video_workers: int = VIDEO_WORKERS,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        reconciler=None,
+        voice_queue_size: int = VOICE_QUEUE_SIZE,
+        video_queue_size: int = VIDEO_QUEUE_SIZE,
+    ):
+        self.voice_handler = voice_handler
+        self.video_handler = video_handler
+        self.job_queue = job_queue
+        self.voice_workers = max(1, voice_workers)
+        self.video_workers = max(1, video_workers)
+        self.poll_interval = poll_interval
+        self.reconciler = reconciler
+        self.voice_queue_size = max(1, voice_queue_size)
+        self.video_queue_size = max(1, video_queue_size)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._voice_queue: Optional[asyncio.Queue] = None
+        self._video_queue: Optional[asyncio.Queue] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._inflight: Dict[int, ScriptJob] = {}
+        self._active = {"voice": 0, "video": 0}
+        self._counters = {"claimed": 0, "resumed": 0, "completed": 0, "failed": 0, "paused": 0}
+
+    async def start(self):
+        """Khởi động các worker pool, feeder và heartbeat trên event loop hiện tại"""
+        if self._workers:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._voice_queue = asyncio.Queue(maxsize=self.voice_queue_size)
+        self._video_queue = asyncio.Queue(maxsize=self.video_queue_size)
+        self._wake = asyncio.Event()
+        self.job_queue.start()
+        for i in range(self.voice_workers):
+            self._workers.append(asyncio.create_task(self._voice_worker(i)))
+        for i in range(self.video_workers):
+            self._workers.append(asyncio.create_task(self._video_worker(i)))
+        self._workers.append(asyncio.create_task(self._feeder()))
+        self._workers.append(asyncio.create_task(self._heartbeat()))
+        if self.reconciler is not None:
+            self.reconciler.on_finished = self._finish
+            self.reconciler.start()
+        logger.info(
+            f"Scheduler {self.job_queue.worker_id} đã khởi động với {self.voice_workers} voice worker "
+            f"và {self.video_workers} video worker"
+        )
+
+    async def stop(self):
+        """Dừng tất cả worker"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.reconciler is not None:
+            await self.reconciler.stop()
+        await self.job_queue.stop()
+        logger.info("Scheduler đã dừng")
+
+    def wake(self):
+        """
+        Báo cho feeder kiểm tra job mới ngay lập tức.
+
+        An toàn khi gọi từ thread khác (ví dụ thread của watchdog observer).
+        """
+        if self._loop is None:
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._wake.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def enqueue(self, file_path: str, channel_name: str, callback_url: str = None) -> Optional[int]:
+        """Thêm script vào hàng đợi bền vững và đánh thức feeder, None nếu file đã được nhận"""
+        job_id = self.job_queue.enqueue(file_path, channel_name, callback_url=callback_url)
+        if job_id is not None:
+            self.wake()
+        return job_id
+
+    def enqueue_many(self, items: List[Dict]) -> int:
+        """Thêm nhiều script vào hàng đợi bền vững trong một transaction"""
+        count = self.job_queue.enqueue_many(items)
+        if count:
+            self.wake()
+        return count
+
+    def enqueue_batch(self, items: List[Dict]) -> List[Dict]:
+        """Thêm nhiều script vào hàng đợi bền vững trong một transaction, trả về kết quả từng script"""
+        results = self.job_queue.enqueue_batch(items)
+        if any(result['status'] == 'queued' for result in results):
+            self.wake()
+        return results
+
+    async def drain_once(self, limit: int) -> List[Dict]:
+        """
+        Claim ngay tối đa `limit` job (trong giới hạn hàng đợi) và đưa vào
+        hàng đợi voice, job đã xong voice được đưa thẳng vào hàng đợi video.
+        Trả về các job đã được nhận.
+        """
+        # Job đã xong voice được claim riêng theo chỗ trống của hàng đợi video,
+        # để job không bị claim rồi trả lại liên tục khi video đang tồn đọng
+        voice_limit = min(limit, self._voice_capacity())
+        rows = await self.job_queue.claim(voice_limit, statuses=VOICE_STATUSES)
+        video_limit = min(limit - len(rows), self._video_capacity())
+        rows += await self.job_queue.claim(video_limit, statuses=(ScriptStatus.VOICE_DONE,))
+        return [row for row in rows if await self._dispatch(row)]
+
+    def _voice_capacity(self) -> int:
+        return max(0, self.voice_queue_size - self._voice_queue.qsize())
+
+    def _video_capacity(self) -> int:
+        return max(0, self.video_queue_size - self._video_queue.qsize())
+
+    def _claim_capacity(self) -> int:
+        # Chỉ claim số job mà các hàng đợi còn chứa được,
+        # phần còn lại để các worker/host khác claim
+        return self._voice_capacity() + self._video_capacity()
+
+    async def _dispatch(self, row: Dict) -> bool:
+        job = ScriptJob(
+            task_id=f"script_{row['id']}",
+            file_path=row['file_path'],
+            channel_name=row['channel_name'],
+            callback_url=row.get('callback_url'),
+            script_id=row['id'],
+            attempts=row.get('attempts') or 0,
+        )
+        # Nạp lại checkpoint của các stage đã hoàn thành
+        for key in ('audio_path', 'srt_path', 'video_task_id', 'video_node_url',
+                    'video_submitted_at', 'video_output_name', 'overlay2_name'):
+            if row.get(key):
+                job.result[key] = row[key]
+        resume = (row.get('status') == ScriptStatus.VOICE_DONE
+                  and os.path.exists(job.result.get('audio_path', ''))
+                  and os.path.exists(job.result.get('srt_path', '')))
+        queue = self._video_queue if resume else self._voice_queue
+        if queue.full():
+            # Hàng đợi đã đầy: trả job về database, giữ nguyên checkpoint,
+            # job chưa được xử lý nên lần claim này không tính vào attempts
+            await self.job_queue.release(job.script_id, status=None, count_attempt=False)
+            return False
+
+        self._inflight[job.script_id] = job
+        self._counters["claimed"] += 1
+        if resume:
+            logger.info(f"Tiếp tục job {job.task_id} từ stage video")
+            self._counters["resumed"] += 1
+            job.stage = "queued_video"
+        queue.put_nowait(job)
+        return True
+
+    def _finish(self, job: ScriptJob, done: bool):
+        job.stage = "done" if done else "failed"
+        self._inflight.pop(job.script_id, None)
+        self._counters["completed" if done else "failed"] += 1
+
+    def _pause(self, job: ScriptJob, reason: JobPaused):
+        logger.warning(f"Tạm dừng job {job.task_id} ở stage {job.stage}: {reason}")
+        job.stage = "paused"
+        self._inflight.pop(job.script_id, None)
+        self._counters["paused"] += 1
+
+    async def _feeder(self):
+        while True:
+            self._wake.clear()
+            try:
+                await self.drain_once(self._claim_capacity())
+            except Exception as e:
+                logger.error(f"Lỗi khi claim job từ hàng đợi: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _heartbeat(self):
+        interval = max(1.0, self.job_queue.lease_seconds / 3)
+        while True:
+            await asyncio.sleep(interval)
+            if not self._inflight:
+                continue
+            try:
+                await self.job_queue.heartbeat(list(self._inflight))
+            except Exception as e:
+                logger.error(f"Lỗi khi gia hạn lease: {e}")
+
+    async def _voice_worker(self, index: int):
+        while True:
+            job = await self._voice_queue.get()
+            self._active["voice"] += 1
+            job.stage = "voice"
+            paused = None
+            try:
+                forward = await self.voice_handler(job)
+            except JobPaused as e:
+                paused, forward = e, False
+            except Exception as e:
+                logger.error(f"Voice worker {index} gặp lỗi với job {job.task_id}: {e}")
+                forward = False
+            finally:
+                self._active["voice"] -= 1
+                self._voice_queue.task_done()
+                self._wake.set()
+            if paused is not None:
+                self._pause(job, paused)
+            elif forward:
+                job.stage = "queued_video"
+                # Chờ khi hàng đợi video đầy (backpressure lên stage voice)
+                await self._video_queue.put(job)
+            else:
+                self._finish(job, False)
+
+    async def _video_worker(self, index: int):
+        while True:
+            job = await self._video_queue.get()
+            self._active["video"] += 1
+            job.stage = "video"
+            paused = None
+            try:
+                done = await self.video_handler(job)
+            except JobPaused as e:
+                paused, done = e, False
+            except Exception as e:
+                logger.error(f"Video worker {index} gặp lỗi với job {job.task_id}: {e}")
+                done = False
+            finally:
+                self._active["video"] -= 1
+                self._video_queue.task_done()
+            if paused is not None:
+                self._pause(job, paused)
+            elif done and self.reconciler is not None:
+                # Render đã được submit, reconciler sẽ kết thúc job
+                self.reconciler.track(job, job.result.get('video_submitted_at'))
+            else:
+                self._finish(job, done)
+
+    def stats(self) -> Dict[str, int]:
+        """Thống kê hàng đợi và worker"""
+        stats = {
+            "worker_id": self.job_queue.worker_id,
+            "voice_workers": self.voice_workers,
+            "video_workers": self.video_workers,
+            "voice_queued": self._voice_queue.qsize() if self._voice_queue else 0,
+            "video_queued": self._video_queue.qsize() if self._video_queue else 0,
+            "voice_queue_size": self.voice_queue_size,
+            "video_queue_size": self.video_queue_size,
+            "voice_active": self._active["voice"],
+            "video_active": self._active["video"],
+            "inflight": len(self._inflight),
+            **self._counters,
+        }
+        if self.reconciler is not None:
+            stats["render"] = self.reconciler.stats()
+        stats["writes"] = self.job_queue.write_buffer.stats()
+        return stats
@@ -6,7 +6,7 @@ import asyncio
 import logging
 import json
 import uuid
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from ..utils.logging_config import setup_logging, CustomLoggerAdapter
 from ..config.paths import (
     get_channel_overlay1_dir,
@@ -14,18 +14,89 @@ from ..config.paths import (
     get_channel_final_dir,
     get_video_service_temp_path,
     get_channel_config_path,
-    VIDEO_API_URL
+    VIDEO_API_NODES,
+    VIDEO_LATENCY_TARGET
 )
+from .endpoint_pool import EndpointPool
+from ..utils.http_client import http_client
 
 # Khởi tạo logger
 logger = setup_logging()
 video_logger = CustomLoggerAdapter(logger, {'service': 'video_service'})
 
+RENDER_RUNNING = "running"
+RENDER_DONE = "done"
+RENDER_FAILED = "failed"
+
+DONE_STATES = {'completed', 'complete', 'done', 'success', 'succeeded', 'finished'}
+FAILED_STATES = {'error', 'failed', 'failure', 'cancelled', 'canceled', 'aborted'}
+
+
+def interpret_render_status(data: Optional[Dict]) -> Tuple[str, Optional[float], Optional[str]]:
+    """
+    Đọc phản hồi /api/process/status của video service.
+    Trả về (trạng thái, tiến độ 0..1 nếu có, thông báo lỗi nếu có).
+    """
+    if not data:
+        return RENDER_RUNNING, None, None
+    state = str(data.get('status') or data.get('state') or '').strip().lower()
+
+    progress = None
+    try:
+        progress = float(data.get('progress'))
+        # Video service có thể trả về phần trăm (0..100)
+        if progress > 1:
+            progress /= 100
+        progress = min(max(progress, 0.0), 1.0)
+    except (TypeError, ValueError):
+        pass
+
+    if state in FAILED_STATES:
+        return RENDER_FAILED, progress, str(data.get('error') or data.get('message') or state)
+    if state in DONE_STATES or (not state and progress == 1.0):
+        return RENDER_DONE, 1.0, None
+    return RENDER_RUNNING, progress, None
+
+
 class VideoService:
-    def __init__(self, video_api_url: str = None):
-        self.video_api_url = video_api_url or VIDEO_API_URL
+    def __init__(self, video_api_url: str = None, video_nodes: list = None):
+        # Pool các render node, mỗi node có giới hạn số render đồng thời riêng.
+        # Slot của node được giữ từ lúc submit tới khi render kết thúc.
+        if video_api_url:
+            video_nodes = [(video_api_url, VIDEO_API_NODES[0][1])]
+        self.node_pool = EndpointPool('video', video_nodes or VIDEO_API_NODES, latency_target=VIDEO_LATENCY_TARGET)
+        self.video_api_url = self.node_pool.urls[0]
         self.logger = video_logger
 
+    def start(self):
+        """Khởi động health check cho các render node"""
+        self.node_pool.start()
+
+    async def stop(self):
+        await self.node_pool.stop()
+
+    def stats(self):
+        """Trạng thái và số render đang chạy của các render node"""
+        return self.node_pool.stats()
+
+    def _node_url(self, node_url: Optional[str]) -> str:
+        # Task tạo trước khi có render farm không lưu node, mặc định là node đầu tiên
+        return (node_url or self.video_api_url).rstrip('/')
+
+    async def attach_render(self, node_url: Optional[str]):
+        """Giữ lại slot cho một render đã submit từ trước (khi job được tiếp tục)"""
+        await self.node_pool.attach(self._node_url(node_url))
+
+    async def release_render(self, node_url: Optional[str], error: Optional[Exception] = None,
+                             duration: Optional[float] = None):
+        """
+        Trả slot của node sau khi render kết thúc. error/duration được dùng để
+        điều chỉnh số render đồng thời của node.
+        """
+        node = self.node_pool.get(self._node_url(node_url))
+        if node is not None:
+            await self.node_pool.release(node, error, duration)
+
     def _get_random_overlay2(self, channel_name: str) -> tuple[str, str]:
         """
         Lấy ngẫu nhiên một file overlay2 từ thư mục tương ứng
@@ -84,106 +155,162 @@ class VideoService:
                 }
             }
 
+    async def submit_render(self, audio_path: str, srt_path: str, channel_name: str,
+                            callback_url: str = None) -> Dict[str, str]:
+        """
+        Gửi yêu cầu render tới render node đang rảnh nhất, trả về ngay sau khi có task_id.
+        Kết quả gồm task_id, node_url, output_name và overlay2_name để có thể theo dõi
+        và hoàn tất render sau này (kể cả sau khi app khởi động lại).
+
+        Slot của node vẫn được giữ sau khi hàm trả về, phải gọi release_render()
+        khi render kết thúc. Nếu có callback_url, video service sẽ gọi lại
+        URL này khi render kết thúc.
+        """
+        # Load cấu hình channel
+        channel_config = self._load_channel_config(channel_name)
+        video_settings = channel_config.get("video_settings", {})
+        preset_name = video_settings.get("preset_name", "1")
+
+        # Lấy overlay1 cố định theo channel
+        overlay1_path = os.path.join(get_channel_overlay1_dir(channel_name), 'overlay1.png')
+        if not os.path.exists(overlay1_path):
+            raise ValueError(f"Không tìm thấy overlay1 cho channel {channel_name}")
+
+        # Lấy ngẫu nhiên một overlay2
+        overlay2_path, overlay2_name = self._get_random_overlay2(channel_name)
+
+        # Tạo tên cho video output
+        unique_id = str(uuid.uuid4())[:8]
+        output_name = f"video_{unique_id}.mp4"
+
+        payload = {
+            "request": "",
+            "audio_path": audio_path.replace('\\', '/'),
+            "subtitle_path": srt_path.replace('\\', '/'),
+            "overlay1_path": overlay1_path.replace('\\', '/'),
+            "overlay2_path": overlay2_path.replace('\\', '/'),
+            "preset_name": preset_name,  # Sử dụng preset từ cấu hình
+            "output_name": output_name
+        }
+        if callback_url:
+            payload["callback_url"] = callback_url
+
+        node = await self.node_pool.acquire()
+        try:
+            self.logger.debug(f"Sending request to video node {node.url} with payload: {payload}")
+            response = await http_client.post(
+                f"{node.url}/api/process/make",
+                headers={"accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"},
+                data=payload
+            )
+            response.raise_for_status()
+            task_data = response.json()
+            task_id = task_data.get('task_id')
+            if not task_id:
+                raise ValueError("Không nhận được task_id từ video service")
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            await self.node_pool.release(node, e)
+            raise
+        except Exception:
+            await self.node_pool.release(node)
+            raise
+
+        self.logger.info(f"Video processing started on {node.url} with task_id: {task_id}")
+        return {
+            'task_id': task_id,
+            'node_url': node.url,
+            'output_name': output_name,
+            'overlay2_name': overlay2_name,
+            'overlay_path': overlay2_path
+        }
+
+    async def check_status(self, task_id: str, node_url: str = None) -> Optional[Dict]:
+        """
+        Lấy trạng thái của một task render từ node đã nhận task,
+        None nếu không gọi được video service
+        """
+        response = await http_client.get(f"{self._node_url(node_url)}/api/process/status/{task_id}")
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    async def wait_render(self, task_id: str, node_url: str = None):
+        """
+        Chờ task render kết thúc (dùng khi xử lý tuần tự, không qua render_reconciler).
+        Raise nếu render lỗi hoặc quá 30 phút chưa xong.
+        """
+        max_retries = 180  # 180 lần * 10 giây = 1800 giây = 30 phút
+        retry_delay = 10   # 10 giây giữa các lần thử
+
+        for attempt in range(max_retries):
+            try:
+                state, progress, error = interpret_render_status(await self.check_status(task_id, node_url))
+            except Exception as e:
+                logger.warning(f"Lần thử {attempt + 1}/{max_retries} thất bại: {str(e)}")
+            else:
+                if state == RENDER_DONE:
+                    return
+                if state == RENDER_FAILED:
+                    raise RuntimeError(f"Render {task_id} thất bại: {error}")
+            await asyncio.sleep(retry_delay)
+
+        raise TimeoutError(f"Render {task_id} chưa hoàn thành sau {max_retries * retry_delay} giây")
+
+    async def finalize_render(self, channel_name: str, overlay2_name: str, output_name: str) -> str:
+        """
+        Di chuyển overlay2 đã sử dụng và video đã render vào thư mục final của channel
+        """
+        # Di chuyển overlay2 đã sử dụng vào thư mục final
+        move_attempts = 2
+        for attempt in range(move_attempts):
+            try:
+                self._move_overlay_to_final(channel_name, overlay2_name, output_name)
+                logger.info(f"Overlay2 đã được di chuyển thành công: {overlay2_name}")
+                break  # Thoát khỏi vòng lặp nếu di chuyển thành công
+            except Exception as e:
+                logger.warning(f"Lần thử di chuyển overlay2 {attempt + 1}/{move_attempts} thất bại: {str(e)}")
+                if attempt == move_attempts - 1:
+                    logger.error("Không thể di chuyển overlay2 sau 2 lần thử.")
+                await asyncio.sleep(3)  # Thêm thời gian chờ 3 giây giữa các lần thử
+
+        # Di chuyển video về thư mục final của channel
+        final_video_path = None
+        move_attempts = 2
+        for attempt in range(move_attempts):
+            try:
+                final_video_path = self._move_video_to_final(channel_name, output_name)
+                logger.info(f"Video đã được di chuyển thành công: {final_video_path}")
+                break  # Thoát khỏi vòng lặp nếu di chuyển thành công
+            except Exception as e:
+                logger.warning(f"Lần thử di chuyển video {attempt + 1}/{move_attempts} thất bại: {str(e)}")
+                if attempt == move_attempts - 1:
+                    logger.error("Không thể di chuyển video sau 2 lần thử.")
+                await asyncio.sleep(3)  # Thêm thời gian chờ 3 giây giữa các lần thử
+
+        if final_video_path is None:
+            raise RuntimeError(f"Không thể di chuyển video {output_name} về thư mục final")
+        return final_video_path
+
     async def process_video(self, audio_path: str, srt_path: str, channel_name: str) -> Dict[str, str]:
         """
         Xử lý video với overlay và timeout 30 phút
         """
         try:
-            # Load cấu hình channel
-            channel_config = self._load_channel_config(channel_name)
-            video_settings = channel_config.get("video_settings", {})
-            preset_name = video_settings.get("preset_name", "1")
-
-            # Lấy overlay1 cố định theo channel
-            overlay1_path = os.path.join(get_channel_overlay1_dir(channel_name), 'overlay1.png')
-            if not os.path.exists(overlay1_path):
-                raise ValueError(f"Không tìm thấy overlay1 cho channel {channel_name}")
-
-            # Lấy ngẫu nhiên một overlay2
-            overlay2_path, overlay2_name = self._get_random_overlay2(channel_name)
-            
-            # Tạo tên cho video output
-            unique_id = str(uuid.uuid4())[:8]
-            output_name = f"video_{unique_id}.mp4"
-            
-            # Gửi request xử lý video
-            async with httpx.AsyncClient(timeout=1800.0) as client:  # 30 phút timeout
-                payload = {
-                    "request": "",
-                    "audio_path": audio_path.replace('\\', '/'),
-                    "subtitle_path": srt_path.replace('\\', '/'),
-                    "overlay1_path": overlay1_path.replace('\\', '/'),
-                    "overlay2_path": overlay2_path.replace('\\', '/'),
-                    "preset_name": preset_name,  # Sử dụng preset từ cấu hình
-                    "output_name": output_name
-                }
-                
-                self.logger.debug(f"Sending request to video service with payload: {payload}")
-                
-                # Gửi request tạo video với timeout 30 phút
-                response = await client.post(
-                    f"{self.video_api_url}/api/process/make",
-                    headers={"accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"},
-                    data=payload
-                )
-                response.raise_for_status()
-                task_data = response.json()
-                task_id = task_data.get('task_id')
-                
-                if not task_id:
-                    raise ValueError("Không nhận được task_id từ video service")
-                
-                self.logger.info(f"Video processing started with task_id: {task_id}")
-                
-                # Kiểm tra trạng thái với retry trong 30 phút
-                max_retries = 180  # 180 lần * 10 giây = 1800 giây = 30 phút
-                retry_delay = 10   # 10 giây giữa các lần thử
-                
-                for attempt in range(max_retries):
-                    try:
-                        # Gửi yêu cầu kiểm tra trạng thái
-                        status_response = await client.get(f"{self.video_api_url}/api/process/status/{task_id}")
-                        
-                        if status_response.status_code == 200:
-                            # Thoát khỏi vòng lặp khi nhận được phản hồi 200 OK
-                            break  # Thoát khỏi vòng lặp
-
-                    except Exception as e:
-                        logger.warning(f"Lần thử {attempt + 1}/{max_retries} thất bại: {str(e)}")
-                        await asyncio.sleep(retry_delay)
-
-                # Di chuyển overlay2 đã sử dụng vào thư mục final
-                move_attempts = 2
-                for attempt in range(move_attempts):
-                    try:
-                        self._move_overlay_to_final(channel_name, overlay2_name, output_name)
-                        logger.info(f"Overlay2 đã được di chuyển thành công: {overlay2_name}")
-                        break  # Thoát khỏi vòng lặp nếu di chuyển thành công
-                    except Exception as e:
-                        logger.warning(f"Lần thử di chuyển overlay2 {attempt + 1}/{move_attempts} thất bại: {str(e)}")
-                        if attempt == move_attempts - 1:
-                            logger.error("Không thể di chuyển overlay2 sau 2 lần thử.")
-                        await asyncio.sleep(3)  # Thêm thời gian chờ 3 giây giữa các lần thử
-                
-                # Di chuyển video về thư mục final của channel
-                move_attempts = 2
-                for attempt in range(move_attempts):
-                    try:
-                        final_video_path = self._move_video_to_final(channel_name, output_name)
-                        logger.info(f"Video đã được di chuyển thành công: {final_video_path}")
-                        break  # Thoát khỏi vòng lặp nếu di chuyển thành công
-                    except Exception as e:
-                        logger.warning(f"Lần thử di chuyển video {attempt + 1}/{move_attempts} thất bại: {str(e)}")
-                        if attempt == move_attempts - 1:
-                            logger.error("Không thể di chuyển video sau 2 lần thử.")
-                        await asyncio.sleep(3)  # Thêm thời gian chờ 3 giây giữa các lần thử
-                
-                self.logger.info(f"Video đã được xử lý thành công: {final_video_path}")
-                return {
-                    'video_path': final_video_path,
-                    'overlay_path': overlay2_path
-                }
-                
+            render = await self.submit_render(audio_path, srt_path, channel_name)
+            try:
+                await self.wait_render(render['task_id'], render['node_url'])
+            finally:
+                await self.release_render(render['node_url'])
+            final_video_path = await self.finalize_render(
+                channel_name, render['overlay2_name'], render['output_name']
+            )
+
+            self.logger.info(f"Video đã được xử lý thành công: {final_video_path}")
+            return {
+                'video_path': final_video_path,
+                'overlay_path': render['overlay_path']
+            }
+
         except Exception as e:
             self.logger.error(f"Error in video processing: {str(e)}")
             raise
@@ -0,0 +1,160 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+from ..config.paths import VOICE_CACHE_DIR, VOICE_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Các tham số không ảnh hưởng tới audio đầu ra, không đưa vào cache key
+NON_OUTPUT_PARAMS = ('source_file', 'session_name', 'xtts_server_url')
+
+CACHE_FILES = ('final.wav', 'final.srt')
+
+
+def normalize_script_text(text: str) -> str:
+    """Chuẩn hóa nội dung script để các bản sao khác nhau về khoảng trắng có cùng key"""
+    text = unicodedata.normalize('NFC', text).replace('\r\n', '\n').replace('\r', '\n')
+    paragraphs = []
+    for block in text.split('\n\n'):
+        lines = [' '.join(line.split()) for line in block.split('\n')]
+        block = '\n'.join(line for line in lines if line)
+        if block:
+            paragraphs.append(block)
+    return '\n\n'.join(paragraphs)
+
+
+class VoiceCache:
+    """
+    Cache audio/SRT của cả script, đánh địa chỉ theo nội dung.
+
+    Key là sha256 của nội dung script đã chuẩn hóa cộng với các tham số giọng
+    nói có hiệu lực (speaker_voice, temperature, speed, top_k..., cả chế độ
+    tổng hợp theo chunk vì audio/SRT được ghép khác nhau). Mỗi entry
+    là một thư mục chứa final.wav và final.srt. Khi tổng dung lượng vượt quá
+    giới hạn, entry ít được dùng gần đây nhất sẽ bị xóa.
+    """
+
+    def __init__(self, cache_dir: str = VOICE_CACHE_DIR, max_bytes: int = VOICE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: Optional[OrderedDict] = None  # key -> size, theo thứ tự LRU
+        self._total_bytes = 0
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def make_key(self, file_path: str, params: Dict) -> str:
+        """Tạo cache key từ nội dung script và tham số giọng nói"""
+        # Script không phải UTF-8 vẫn có key (ký tự lỗi được thay thế), không làm hỏng stage voice
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            text = normalize_script_text(f.read())
+        effective = {k: v for k, v in params.items() if k not in NON_OUTPUT_PARAMS}
+        digest = hashlib.sha256()
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(json.dumps(effective, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _load_index(self):
+        """Quét thư mục cache một lần để dựng lại chỉ mục LRU theo mtime"""
+        if self._entries is not None:
+            return
+        entries = []
+        if os.path.isdir(self.cache_dir):
+            with os.scandir(self.cache_dir) as shards:
+                for shard in shards:
+                    if not shard.is_dir():
+                        continue
+                    with os.scandir(shard.path) as items:
+                        for item in items:
+                            if not item.is_dir() or item.name.endswith('.tmp'):
+                                continue
+                            size = sum(
+                                os.path.getsize(os.path.join(item.path, name))
+                                for name in CACHE_FILES
+                                if os.path.exists(os.path.join(item.path, name))
+                            )
+                            entries.append((item.stat().st_mtime, item.name, size))
+        entries.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in entries)
+        self._total_bytes = sum(self._entries.values())
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        """Trả về đường dẫn final.wav/final.srt trong cache, None nếu chưa có"""
+        entry_dir = self._entry_dir(key)
+        wav_path = os.path.join(entry_dir, 'final.wav')
+        srt_path = os.path.join(entry_dir, 'final.srt')
+        with self._lock:
+            self._load_index()
+            if key not in self._entries or not (os.path.exists(wav_path) and os.path.exists(srt_path)):
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+        try:
+            os.utime(entry_dir)  # Giữ thứ tự LRU qua các lần khởi động
+        except OSError:
+            pass
+        return {'wav_path': wav_path, 'srt_path': srt_path}
+
+    def put(self, key: str, wav_path: str, srt_path: str):
+        """Lưu một bản sao của audio/SRT vào cache"""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp"
+        try:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            for src, name in ((wav_path, 'final.wav'), (srt_path, 'final.srt')):
+                link_or_copy(src, os.path.join(tmp_dir, name))
+            size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in CACHE_FILES)
+            with self._lock:
+                self._load_index()
+                if key in self._entries:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return
+                os.replace(tmp_dir, entry_dir)
+                self._entries[key] = size
+                self._total_bytes += size
+                self._counters['stores'] += 1
+                self._evict()
+        except Exception as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.error(f"Không thể lưu voice cache {key}: {e}")
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            self._total_bytes -= size
+            self._counters['evictions'] += 1
+            logger.info(f"Đã xóa voice cache {key} ({size} bytes)")
+
+    def stats(self) -> Dict[str, int]:
+        """Thống kê hit/miss và dung lượng cache"""
+        with self._lock:
+            self._load_index()
+            return {
+                **self._counters,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def link_or_copy(src: str, dst: str):
+    """Tạo hard link nếu cùng ổ đĩa, nếu không thì copy"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+voice_cache = VoiceCache()
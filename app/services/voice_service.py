@@ -1,24 +1,61 @@
 import os
 import shutil
+import asyncio
 import httpx
 from datetime import datetime
 import json
 import uuid
 from ..utils.logging_config import logger
+from ..utils.audio_stitch import split_script, stitch_wavs, merge_srts
+from .voice_cache import voice_cache, link_or_copy
+from .endpoint_pool import EndpointPool, CircuitOpenError, is_downstream_unavailable
+from ..utils.http_client import http_client
 from ..config.paths import (
     get_pandrator_session_dir,
     get_channel_voice_dir,
     get_channel_config_path,
-    VOICE_API_URL,
+    VOICE_API_URLS,
     XTTS_API_URL,
+    XTTS_API_URLS,
+    XTTS_MAX_CONCURRENCY,
+    VOICE_MAX_CONCURRENCY,
+    VOICE_LATENCY_TARGET,
+    VOICE_CHUNKED_SYNTHESIS,
+    VOICE_CHUNK_MAX_CHARS,
+    VOICE_CHUNK_RETRIES,
     CONFIG_DIR
 )
 
+def _read_script(file_path: str) -> str:
+    """Đọc script, ký tự không phải UTF-8 được thay thế thay vì làm lỗi job"""
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
 class VoiceService:
-    def __init__(self, voice_api_url: str = None):
-        self.api_url = voice_api_url or VOICE_API_URL
+    def __init__(self, voice_api_url: str = None, xtts_api_urls: list = None, cache=voice_cache):
+        # Pool các voice service (Pandrator API) và XTTS server, mỗi request
+        # được gửi tới endpoint có ít request đang chờ nhất
+        # Số request đồng thời trên mỗi endpoint tự điều chỉnh (AIMD) trong giới hạn cấu hình
+        self.voice_pool = EndpointPool('voice', [voice_api_url] if voice_api_url else VOICE_API_URLS,
+                                       max_outstanding=VOICE_MAX_CONCURRENCY, latency_target=VOICE_LATENCY_TARGET)
+        self.xtts_pool = EndpointPool('xtts', xtts_api_urls or XTTS_API_URLS,
+                                      max_outstanding=XTTS_MAX_CONCURRENCY, latency_target=VOICE_LATENCY_TARGET)
+        self.cache = cache
         self.logger = logger.getChild('voice_service')
 
+    def start(self):
+        """Khởi động health check cho các endpoint pool"""
+        self.voice_pool.start()
+        self.xtts_pool.start()
+
+    async def stop(self):
+        await self.voice_pool.stop()
+        await self.xtts_pool.stop()
+
+    def stats(self):
+        """Trạng thái của các endpoint voice và XTTS"""
+        return {'voice': self.voice_pool.stats(), 'xtts': self.xtts_pool.stats()}
+
     async def process_voice(self, file_path: str, channel_name: str):
         """
         Xử lý voice với timeout 30 phút
@@ -57,59 +94,194 @@ class VoiceService:
                 "paragraph_silence": voice_config.get('paragraph_silence', 200)
             }
             
-            self.logger.debug(f"Sending request to voice service with payload: {payload}")
-            
-            # Gọi API với timeout 30 phút
-            async with httpx.AsyncClient(timeout=1800.0) as client:
-                response = await client.post(
-                    f'{self.api_url}/process_with_pandrator',
-                    json=payload
-                )
-                
-                if response.status_code != 200:
-                    raise Exception(f"Voice API error: {response.text}")
-                
-                # Đường dẫn cố định của Pandrator
-                base_dir = get_pandrator_session_dir(session_name)
-                
-                # Kiểm tra file tồn tại
-                wav_path = os.path.join(base_dir, 'final.wav')
-                srt_path = os.path.join(base_dir, 'final.srt')
-                
-                if not os.path.exists(wav_path) or not os.path.exists(srt_path):
-                    raise Exception("Voice files not generated")
-
-                # Đường dẫn assets của channel
-                channel_assets_dir = get_channel_voice_dir(channel_name)
-                os.makedirs(channel_assets_dir, exist_ok=True)
+            # Đường dẫn assets của channel
+            channel_assets_dir = get_channel_voice_dir(channel_name)
+            wav_dest_path = os.path.join(channel_assets_dir, f"{session_name}.wav")
+            srt_dest_path = os.path.join(channel_assets_dir, f"{session_name}.srt")
+
+            chunked = voice_config.get('chunked_synthesis', VOICE_CHUNKED_SYNTHESIS)
+            chunk_max_chars = voice_config.get('chunk_max_chars', VOICE_CHUNK_MAX_CHARS)
 
-                # Di chuyển WAV
-                wav_filename = f"{session_name}.wav"
-                wav_dest_path = os.path.join(channel_assets_dir, wav_filename)
-                if os.path.exists(wav_path):
-                    shutil.move(wav_path, wav_dest_path)
-                else:
-                    raise Exception("File final.wav không được tạo ra")
-
-                # Di chuyển SRT
-                srt_filename = f"{session_name}.srt"
-                srt_dest_path = os.path.join(channel_assets_dir, srt_filename)
-                if os.path.exists(srt_path):
-                    shutil.move(srt_path, srt_dest_path)
-                else:
-                    raise Exception("File final.srt không được tạo ra")
-
-                self.logger.info(f"Voice processing completed successfully for {file_path}")
+            # Cùng nội dung, tham số giọng nói và chế độ tổng hợp đã được tổng hợp trước đó.
+            # Hash script, copy WAV và xóa entry cũ chạy trong thread để không chặn event loop
+            cache_key = await asyncio.to_thread(self.cache.make_key, file_path, {
+                **payload,
+                'chunked_synthesis': chunked,
+                'chunk_max_chars': chunk_max_chars if chunked else None,
+            }) if self.cache else None
+            cached = await asyncio.to_thread(self.cache.get, cache_key) if cache_key else None
+            if cached:
+                os.makedirs(channel_assets_dir, exist_ok=True)
+                await asyncio.to_thread(link_or_copy, cached['wav_path'], wav_dest_path)
+                await asyncio.to_thread(link_or_copy, cached['srt_path'], srt_dest_path)
+                self.logger.info(f"Voice cache hit for {file_path} ({cache_key})")
                 return {
                     'audio_path': wav_dest_path,
                     'srt_path': srt_dest_path,
                     'session_id': session_name
                 }
-                
+
+            # Chia script thành chunk để tổng hợp song song trên nhiều XTTS server
+            chunks = []
+            if chunked:
+                text = await asyncio.to_thread(_read_script, file_path)
+                chunks = split_script(text, chunk_max_chars)
+
+            if len(chunks) > 1:
+                wav_path, srt_path = await self._synthesize_chunked(
+                    payload, chunks, voice_config.get('chunk_retries', VOICE_CHUNK_RETRIES)
+                )
+            else:
+                wav_path, srt_path = await self._synthesize(payload)
+
+            if cache_key:
+                await asyncio.to_thread(self.cache.put, cache_key, wav_path, srt_path)
+
+            os.makedirs(channel_assets_dir, exist_ok=True)
+
+            # Di chuyển WAV và SRT (có thể là copy nếu khác ổ đĩa)
+            await asyncio.to_thread(shutil.move, wav_path, wav_dest_path)
+            await asyncio.to_thread(shutil.move, srt_path, srt_dest_path)
+
+            self.logger.info(f"Voice processing completed successfully for {file_path}")
+            return {
+                'audio_path': wav_dest_path,
+                'srt_path': srt_dest_path,
+                'session_id': session_name
+            }
+
         except Exception as e:
             self.logger.error(f"Error in voice processing: {e}")
             raise
 
+    async def _synthesize(self, payload: dict, voice_endpoint=None):
+        """
+        Gọi Pandrator tổng hợp một source file, trả về (final.wav, final.srt)
+        trong thư mục session của Pandrator. Nếu voice_endpoint được truyền vào
+        (slot đã được giữ cho cả job) thì không lấy thêm slot của voice pool.
+        """
+        if voice_endpoint is None:
+            async with self.voice_pool.lease() as voice_endpoint:
+                return await self._synthesize(payload, voice_endpoint)
+
+        async with self.xtts_pool.lease() as xtts_endpoint:
+            payload = {**payload, "xtts_server_url": xtts_endpoint.url}
+            self.logger.debug(f"Sending request to voice service {voice_endpoint.url} with payload: {payload}")
+
+            # Gọi API với timeout 30 phút
+            response = await http_client.post(
+                f'{voice_endpoint.url}/process_with_pandrator',
+                json=payload,
+                read_timeout=1800.0
+            )
+
+            if response.status_code >= 500:
+                # Lỗi phía server được tính vào sức khỏe của endpoint
+                raise httpx.HTTPStatusError(
+                    f"Voice API error: {response.text}", request=response.request, response=response
+                )
+            if response.status_code != 200:
+                raise Exception(f"Voice API error: {response.text}")
+
+        # Đường dẫn cố định của Pandrator
+        base_dir = get_pandrator_session_dir(payload['session_name'])
+
+        # Kiểm tra file tồn tại
+        wav_path = os.path.join(base_dir, 'final.wav')
+        srt_path = os.path.join(base_dir, 'final.srt')
+
+        if not os.path.exists(wav_path):
+            raise Exception("File final.wav không được tạo ra")
+        if not os.path.exists(srt_path):
+            raise Exception("File final.srt không được tạo ra")
+        return wav_path, srt_path
+
+    async def _synthesize_chunked(self, payload: dict, chunks: list, retries: int):
+        """
+        Tổng hợp các chunk song song trên các XTTS server trong pool rồi ghép
+        lại thành một WAV và một SRT. Mỗi chunk lỗi được thử lại riêng.
+        Số chunk chạy cùng lúc bị giới hạn bởi XTTS_MAX_CONCURRENCY của từng server;
+        cả job chỉ giữ một slot của voice pool.
+        """
+        session_name = payload['session_name']
+        work_dir = get_pandrator_session_dir(session_name)
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            async with self.voice_pool.lease() as voice_endpoint:
+                return await self._run_chunks(payload, chunks, retries, work_dir, voice_endpoint)
+        finally:
+            # Dọn các session tạm và file text của từng chunk, kể cả khi lỗi/bị hủy
+            for i in range(len(chunks)):
+                chunk_session = f"{session_name}_c{i:03d}"
+                shutil.rmtree(get_pandrator_session_dir(chunk_session), ignore_errors=True)
+                try:
+                    os.remove(os.path.join(work_dir, f"{chunk_session}.txt"))
+                except OSError:
+                    pass
+
+    async def _run_chunks(self, payload: dict, chunks: list, retries: int, work_dir: str, voice_endpoint):
+        session_name = payload['session_name']
+
+        async def run_chunk(index: int, text: str):
+            chunk_session = f"{session_name}_c{index:03d}"
+            chunk_file = os.path.join(work_dir, f"{chunk_session}.txt")
+            with open(chunk_file, 'w', encoding='utf-8') as f:
+                f.write(text)
+
+            last_error = None
+            for attempt in range(retries + 1):
+                try:
+                    return await self._synthesize({
+                        **payload,
+                        "source_file": chunk_file.replace('/', '\\'),
+                        "session_name": chunk_session
+                    }, voice_endpoint)
+                except CircuitOpenError:
+                    raise
+                except Exception as e:
+                    last_error = e
+                    self.logger.warning(
+                        f"Chunk {index} của {session_name} lỗi "
+                        f"(lần {attempt + 1}/{retries + 1}): {e}"
+                    )
+            if is_downstream_unavailable(last_error):
+                # Giữ nguyên loại lỗi để job được tạm dừng thay vì đánh lỗi
+                raise last_error
+            raise Exception(f"Chunk {index} của {session_name} thất bại: {last_error}")
+
+        self.logger.info(
+            f"Tổng hợp {len(chunks)} chunk song song trên {len(self.xtts_pool.endpoints)} XTTS server cho {session_name}"
+        )
+        tasks = [asyncio.create_task(run_chunk(i, text)) for i, (text, _) in enumerate(chunks)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Chờ các chunk còn lại dừng hẳn trước khi dọn file tạm
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        # Chèn paragraph_silence sau chunk kết thúc đoạn văn, appended_silence
+        # sau chunk bị cắt giữa đoạn, không chèn sau chunk cuối cùng
+        parts = []
+        for i, ((wav_path, _), (_, ends_paragraph)) in enumerate(zip(results, chunks)):
+            if i == len(chunks) - 1:
+                silence = 0
+            elif ends_paragraph:
+                silence = payload.get('paragraph_silence', 200)
+            else:
+                silence = payload.get('appended_silence', 200)
+            parts.append((wav_path, silence))
+
+        final_wav = os.path.join(work_dir, 'final.wav')
+        final_srt = os.path.join(work_dir, 'final.srt')
+        offsets = await asyncio.to_thread(stitch_wavs, parts, final_wav)
+        await asyncio.to_thread(
+            merge_srts, [(srt_path, offset) for (_, srt_path), offset in zip(results, offsets)], final_srt
+        )
+        return final_wav, final_srt
+
     def _load_channel_voice_config(self, channel_name: str):
         """Load voice config cho channel"""
         try:
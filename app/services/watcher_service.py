@@ -1,104 +1,433 @@
 import os
 import time
+import queue
 import asyncio
+import threading
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 import logging
-from typing import Callable, Dict, Any
-from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Any, Optional, Set, Tuple
+from ..utils.event_filter import EventFilter, FilteredEventHandler
+from ..config.paths import (
+    WATCH_STABLE_SECONDS,
+    WATCH_CHECK_INTERVAL,
+    WATCH_POLLING,
+    WATCH_POLL_INTERVAL,
+    WATCH_FULL_RESCAN_SECONDS,
+)
 
 logger = logging.getLogger(__name__)
 
-class ScriptFileHandler(FileSystemEventHandler):
-    def __init__(self, process_callback: Callable[[str], Any], channel_name: str):
+class _PendingFile:
+    def __init__(self, callback: Callable[[str], Any]):
+        self.callback = callback
+        self.last_event = time.monotonic()
+        self.last_stat: Optional[Tuple[int, int]] = None
+        self.ready = False
+
+class WriteDebouncer:
+    """
+    Chờ file được ghi xong mà không chặn thread của observer.
+
+    Handler chỉ ghi nhận event (touch) rồi trả về ngay. Một thread riêng kiểm
+    tra các file đang chờ mỗi check_interval giây: file được coi là ghi xong
+    khi kích thước và mtime không đổi trong stable_seconds, hoặc ngay khi
+    nhận được event đóng file sau khi ghi / đổi tên vào thư mục. File đã ổn
+    định được đưa vào hàng đợi `ready` và chuyển cho callback theo thứ tự.
+    """
+
+    def __init__(self, stable_seconds: float = WATCH_STABLE_SECONDS, check_interval: float = WATCH_CHECK_INTERVAL):
+        self.stable_seconds = stable_seconds
+        self.check_interval = check_interval
+        self.ready: "queue.Queue[Optional[Tuple[str, Callable[[str], Any]]]]" = queue.Queue()
+        self._pending: Dict[str, _PendingFile] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def touch(self, path: str, callback: Callable[[str], Any], ready: bool = False):
+        """Ghi nhận event của file (gọi từ thread observer, không chặn)"""
+        with self._lock:
+            pending = self._pending.get(path)
+            if pending is None:
+                pending = self._pending[path] = _PendingFile(callback)
+            pending.last_event = time.monotonic()
+            pending.ready = pending.ready or ready
+
+    def discard(self, path: str):
+        """Bỏ theo dõi file (file bị xóa hoặc di chuyển đi)"""
+        with self._lock:
+            self._pending.pop(path, None)
+
+    def _check(self):
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._pending.items())
+        for path, pending in items:
+            try:
+                st = os.stat(path)
+            except OSError:
+                # File đã bị xóa/di chuyển trước khi ghi xong
+                self.discard(path)
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            stable = (
+                current == pending.last_stat
+                and now - pending.last_event >= self.stable_seconds
+            )
+            pending.last_stat = current
+            if pending.ready or stable:
+                with self._lock:
+                    if self._pending.get(path) is not pending:
+                        continue
+                    del self._pending[path]
+                self.ready.put((path, pending.callback))
+
+    def _check_loop(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self._check()
+            except Exception as e:
+                logger.error(f"Lỗi khi kiểm tra file đang ghi: {str(e)}")
+
+    def _dispatch_loop(self):
+        while True:
+            item = self.ready.get()
+            if item is None:
+                return
+            path, callback = item
+            try:
+                callback(path)
+            except Exception as e:
+                logger.error(f"Lỗi khi chuyển file {path} vào hàng đợi: {str(e)}")
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._check_loop, name="watch-debouncer", daemon=True),
+            threading.Thread(target=self._dispatch_loop, name="watch-dispatcher", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        if not self._threads:
+            return
+        self._stop.set()
+        self.ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+class ScriptFileHandler(FilteredEventHandler):
+    """
+    Handler dùng chung cho toàn bộ thư mục scripts (watch đệ quy).
+
+    Thư mục con trực tiếp của scripts_dir là channel, file .txt nằm trực tiếp
+    trong thư mục channel là script. Channel mới được tạo khi app đang chạy
+    được phát hiện qua event tạo thư mục, không cần khởi động lại. Event của
+    processed/, error/, file tạm... bị event_filter loại bỏ trước khi tới on_*.
+    """
+
+    def __init__(
+        self,
+        scripts_dir: str,
+        process_callback: Callable[[str], Awaitable[Any]],
+        channel_callback: Optional[Callable[[str], Awaitable[Any]]],
+        debouncer: WriteDebouncer,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.scripts_dir = os.path.abspath(scripts_dir)
+        self.event_filter = EventFilter(self.scripts_dir)
         self.process_callback = process_callback
-        self.channel_name = channel_name
-        self.processed_files = set()
-        self.loop = asyncio.new_event_loop()
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        
-    def _run_async(self, coro):
-        """Chạy coroutine trong event loop"""
-        asyncio.set_event_loop(self.loop)
-        return self.loop.run_until_complete(coro)
-        
+        self.channel_callback = channel_callback
+        self.debouncer = debouncer
+        self.channels: Set[str] = set()
+        # Event loop chính của app: callback dùng chung HTTP client, scheduler, lock...
+        self.loop = loop
+
+    def _script_channel(self, path: str) -> Optional[str]:
+        """Tên channel nếu path là file script của một channel, ngược lại None"""
+        return self.event_filter.channel_of(path)
+
+    def _channel_dir(self, path: str) -> Optional[str]:
+        """Tên channel nếu path là thư mục channel"""
+        if not self.event_filter.match_dir(path):
+            return None
+        return self.event_filter.relative_parts(path)[0]
+
+    def add_channel(self, channel_name: str):
+        if channel_name in self.channels:
+            return
+        self.channels.add(channel_name)
+        logger.info(f"Bắt đầu theo dõi channel {channel_name}")
+        if self.channel_callback is not None:
+            self._submit(self.channel_callback, channel_name)
+
+    def track(self, path: str, ready: bool = False) -> bool:
+        """Đưa file script vào debouncer, False nếu path không phải script của channel"""
+        channel = self._script_channel(path)
+        if channel is None:
+            return False
+        self.add_channel(channel)
+        self.debouncer.touch(path, self._dispatch, ready=ready)
+        return True
+
     def on_created(self, event):
         if event.is_directory:
+            channel = self._channel_dir(event.src_path)
+            if channel is not None:
+                self.add_channel(channel)
             return
-            
-        if not event.src_path.endswith('.txt'):
+
+        logger.info(f"Phát hiện file mới: {event.src_path}")
+        # File có thể chưa được ghi xong, debouncer sẽ chờ tới khi file ổn định
+        self.track(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.track(event.src_path)
+
+    def on_closed(self, event):
+        # Chỉ có trên Linux (inotify IN_CLOSE_WRITE): file đã được ghi xong
+        if not event.is_directory:
+            self.track(event.src_path, ready=True)
+
+    def on_moved(self, event):
+        if event.is_directory:
+            # Thư mục channel được đổi tên / chuyển vào scripts_dir
+            self.channels.discard(self._channel_dir(event.src_path))
+            channel = self._channel_dir(event.dest_path)
+            if channel is not None:
+                self.add_channel(channel)
             return
-            
-        # Kiểm tra xem file đã được xử lý chưa
-        if event.src_path in self.processed_files:
+        self.debouncer.discard(event.src_path)
+        # Ghi ra file tạm rồi đổi tên: file đích đã hoàn chỉnh.
+        # File chuyển vào processed/, error/... không phải script mới
+        if self.track(event.dest_path, ready=True):
+            logger.info(f"Phát hiện file mới: {event.dest_path}")
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            channel = self._channel_dir(event.src_path)
+            if channel in self.channels:
+                self.channels.discard(channel)
+                logger.info(f"Thư mục channel {channel} đã bị xóa")
             return
-            
-        logger.info(f"Phát hiện file mới: {event.src_path}")
-        
-        # Đợi một chút để đảm bảo file đã được ghi hoàn toàn
-        time.sleep(1)
-        
+        self.debouncer.discard(event.src_path)
+
+    def _submit(self, callback: Callable[[str], Awaitable[Any]], arg: str):
+        """Chạy callback trong event loop chính (gọi từ thread observer/debouncer)"""
+        future = asyncio.run_coroutine_threadsafe(callback(arg), self.loop)
+        future.add_done_callback(lambda f: self._log_failure(f, arg))
+
+    @staticmethod
+    def _log_failure(future, arg: str):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Lỗi khi xử lý {arg}: {str(future.exception())}")
+
+    def _dispatch(self, path: str):
+        """Chuyển file đã ghi xong cho callback (gọi từ thread của debouncer)"""
         try:
-            # Đánh dấu file đã được xử lý
-            self.processed_files.add(event.src_path)
-            
-            # Chạy callback trong event loop
-            self.executor.submit(self._run_async, self.process_callback(event.src_path))
-            
+            # File trùng được loại bỏ bởi ingest_index khi đưa vào hàng đợi
+            self._submit(self.process_callback, path)
+
         except Exception as e:
-            logger.error(f"Lỗi khi xử lý file {event.src_path}: {str(e)}")
-            
-    def __del__(self):
-        """Cleanup khi handler bị hủy"""
-        self.executor.shutdown(wait=False)
-        if self.loop.is_running():
-            self.loop.stop()
-        if not self.loop.is_closed():
-            self.loop.close()
+            logger.error(f"Lỗi khi xử lý file {path}: {str(e)}")
+
+class PollingScanner:
+    """
+    Quét định kỳ thư mục scripts bằng os.scandir, dùng khi event của hệ điều
+    hành không đáng tin cậy (ổ mạng SMB/NFS).
+
+    Scanner giữ mtime và danh sách file .txt của từng thư mục channel; mỗi
+    lượt chỉ stat các thư mục channel và chỉ liệt kê lại thư mục có mtime
+    thay đổi. Các thư mục con (processed/, error/, completed/) không bao giờ
+    được liệt kê nên số file trong đó không ảnh hưởng tới chi phí mỗi lượt.
+    File mới được đưa qua cùng debouncer/callback với watcher.
+    """
+
+    def __init__(
+        self,
+        handler: ScriptFileHandler,
+        interval: float = WATCH_POLL_INTERVAL,
+        full_rescan_seconds: float = WATCH_FULL_RESCAN_SECONDS,
+    ):
+        self.handler = handler
+        self.interval = interval
+        self.full_rescan_seconds = full_rescan_seconds
+        self._dir_mtimes: Dict[str, int] = {}
+        self._files: Dict[str, Set[str]] = {}
+        self._last_full = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.passes = 0
+
+    @staticmethod
+    def _list_dir(path: str) -> Tuple[Set[str], Set[str]]:
+        """Trả về (thư mục con, file .txt) của path, dùng d_type của scandir nên không stat từng file"""
+        dirs, files = set(), set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.add(entry.name)
+                elif entry.name.endswith('.txt') and entry.is_file():
+                    files.add(entry.name)
+        return dirs, files
+
+    def _changed(self, path: str, full: bool) -> bool:
+        mtime = os.stat(path).st_mtime_ns
+        if not full and self._dir_mtimes.get(path) == mtime:
+            return False
+        self._dir_mtimes[path] = mtime
+        return True
+
+    def scan(self, prime: bool = False) -> int:
+        """
+        Một lượt quét, trả về số file mới được phát hiện.
+        prime=True chỉ ghi nhận trạng thái hiện tại (file có sẵn do enqueue_backlog xử lý).
+        """
+        root = self.handler.scripts_dir
+        full = time.monotonic() - self._last_full >= self.full_rescan_seconds
+        if full:
+            self._last_full = time.monotonic()
+
+        if self._changed(root, full):
+            dirs, _ = self._list_dir(root)
+            channels = {name for name in dirs if self.handler.event_filter.match_dir(os.path.join(root, name))}
+            for channel in channels - self.handler.channels:
+                if prime:
+                    self.handler.channels.add(channel)
+                else:
+                    self.handler.add_channel(channel)
+            for channel in self.handler.channels - channels:
+                self.handler.channels.discard(channel)
+                channel_dir = os.path.join(root, channel)
+                self._dir_mtimes.pop(channel_dir, None)
+                self._files.pop(channel_dir, None)
+
+        found = 0
+        for channel in list(self.handler.channels):
+            channel_dir = os.path.join(root, channel)
+            try:
+                if not self._changed(channel_dir, full):
+                    continue
+                _, files = self._list_dir(channel_dir)
+            except OSError:
+                continue
+            known = self._files.get(channel_dir)
+            self._files[channel_dir] = files
+            if prime or known is None:
+                continue
+            for name in files - known:
+                if self.handler.track(os.path.join(channel_dir, name)):
+                    found += 1
+        self.passes += 1
+        return found
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                found = self.scan()
+                if found:
+                    logger.info(f"Polling phát hiện {found} file mới")
+            except Exception as e:
+                logger.error(f"Lỗi khi quét thư mục scripts: {str(e)}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.scan(prime=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="watch-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
 
 class WatcherService:
-    def __init__(self):
-        self.observers: Dict[str, Observer] = {}
-        self.handlers: Dict[str, ScriptFileHandler] = {}
-        
-    def start_watching(self, directory: str, process_callback: Callable[[str], Any], channel_name: str):
+    """
+    Một observer duy nhất watch đệ quy thư mục scripts cho mọi channel, số
+    thread không phụ thuộc vào số channel. Ở chế độ polling (WATCH_POLLING),
+    PollingScanner thay thế observer.
+    """
+
+    def __init__(self, polling: bool = WATCH_POLLING):
+        self.polling = polling
+        self.observer: Optional[Observer] = None
+        self.scanner: Optional[PollingScanner] = None
+        self.handler: Optional[ScriptFileHandler] = None
+        self.debouncer = WriteDebouncer()
+
+    def start(
+        self,
+        scripts_dir: str,
+        process_callback: Callable[[str], Awaitable[Any]],
+        channel_callback: Optional[Callable[[str], Awaitable[Any]]] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
         """
-        Bắt đầu theo dõi một thư mục cho channel cụ thể
-        
+        Bắt đầu theo dõi thư mục scripts. Callback là coroutine function, được
+        chạy trong event loop chính của app (mặc định: loop đang chạy).
+
         Args:
-            directory: Đường dẫn thư mục cần theo dõi
-            process_callback: Callback được gọi khi có file mới
-            channel_name: Tên channel
+            scripts_dir: Thư mục chứa các channel
+            process_callback: Callback được gọi khi có file script mới
+            channel_callback: Callback được gọi khi phát hiện channel mới lúc app đang chạy
+            loop: Event loop chạy các callback
         """
-        if not os.path.exists(directory):
-            os.makedirs(directory, exist_ok=True)
-            
-        # Tạo handler và observer mới cho channel
-        handler = ScriptFileHandler(process_callback, channel_name)
-        observer = Observer()
-        observer.schedule(handler, directory, recursive=False)
-        
-        # Lưu handler và observer vào dictionary
-        self.handlers[channel_name] = handler
-        self.observers[channel_name] = observer
-        
-        # Khởi động observer
-        observer.start()
-        logger.info(f"Bắt đầu theo dõi thư mục {directory} cho channel {channel_name}")
-        
-    def stop_watching(self, channel_name: str):
-        """Dừng theo dõi cho một channel cụ thể"""
-        if channel_name in self.observers:
-            self.observers[channel_name].stop()
-            self.observers[channel_name].join()
-            del self.observers[channel_name]
-            
-            if channel_name in self.handlers:
-                del self.handlers[channel_name]
-                
-            logger.info(f"Đã dừng theo dõi channel {channel_name}")
-            
-    def stop_all(self):
-        """Dừng tất cả các observer"""
-        for channel_name in list(self.observers.keys()):
-            self.stop_watching(channel_name)
+        if self.handler is not None:
+            return
+        os.makedirs(scripts_dir, exist_ok=True)
+
+        self.debouncer.start()
+        self.handler = ScriptFileHandler(
+            scripts_dir,
+            process_callback,
+            channel_callback,
+            self.debouncer,
+            loop or asyncio.get_running_loop(),
+        )
+        # Các channel đã có được xử lý lúc khởi động (enqueue_backlog)
+        with os.scandir(scripts_dir) as entries:
+            self.handler.channels.update(
+                entry.name for entry in entries
+                if entry.is_dir() and self.handler.event_filter.match_dir(entry.path)
+            )
+
+        if self.polling:
+            self.scanner = PollingScanner(self.handler)
+            self.scanner.start()
+        else:
+            self.observer = Observer()
+            self.observer.schedule(self.handler, scripts_dir, recursive=True)
+            self.observer.start()
+        logger.info(
+            f"Bắt đầu theo dõi thư mục {scripts_dir} ({'polling' if self.polling else 'event'}) "
+            f"cho các channel: {sorted(self.handler.channels)}"
+        )
+
+    @property
+    def channels(self) -> Set[str]:
+        return set(self.handler.channels) if self.handler else set()
+
+    def stop(self):
+        """Dừng observer / scanner"""
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        if self.scanner is not None:
+            self.scanner.stop()
+            self.scanner = None
+        self.handler = None
+        self.debouncer.stop()
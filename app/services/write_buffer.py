@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import update
+from ..models.script import Script
+from ..config.paths import JOB_FLUSH_INTERVAL, JOB_FLUSH_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingUpdate:
+    def __init__(self, owner: str):
+        self.owner = owner
+        self.fields: Dict[str, Any] = {}
+        # Future của các lời gọi đang chờ cập nhật được commit
+        self.waiters: List[asyncio.Future] = []
+
+
+class JobWriteBuffer:
+    """
+    Write-behind cho các cập nhật trạng thái job.
+
+    Cập nhật của mọi job đang chạy được gom lại theo job (cập nhật sau ghi đè
+    trường của cập nhật trước) và ghi xuống database mỗi flush_interval giây
+    trong một transaction duy nhất, tức là một lần fsync cho cả lô. Mỗi câu
+    UPDATE vẫn kiểm tra lease_owner như JobQueue.update.
+
+    Lời gọi có thể chờ lô chứa cập nhật của nó được commit (group commit:
+    lô được ghi ngay khi lô trước xong, không chờ hết flush_interval) hoặc
+    không chờ. Cập nhật không chờ chưa được ghi sẽ mất nếu process bị crash,
+    job khi đó chạy lại từ checkpoint trước đó.
+    """
+
+    def __init__(self, session_factory, flush_interval: float = JOB_FLUSH_INTERVAL,
+                 max_pending: int = JOB_FLUSH_MAX_PENDING):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[int, _PendingUpdate] = {}
+        # Các job thuộc lô đang được ghi
+        self._flushing: Dict[int, _PendingUpdate] = {}
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"updates": 0, "flushes": 0, "rows": 0, "lost_lease": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def put(self, job_id: int, owner: str, fields: Dict[str, Any], wait: bool = False) -> Optional[asyncio.Future]:
+        """Thêm cập nhật vào buffer, trả về Future (kết quả: worker còn giữ lease) nếu wait=True"""
+        pending = self._pending.get(job_id)
+        if pending is None or pending.owner != owner:
+            pending = self._pending[job_id] = _PendingUpdate(owner)
+        pending.fields.update(fields)
+        self._counters["updates"] += 1
+        future = None
+        if wait:
+            future = asyncio.get_running_loop().create_future()
+            pending.waiters.append(future)
+        # Có lời gọi đang chờ: ghi ngay khi lô trước xong (group commit),
+        # cập nhật đến trong lúc đang ghi được gom vào lô kế tiếp
+        if wait or len(self._pending) >= self.max_pending:
+            self._wake.set()
+        return future
+
+    async def take(self, job_id: int) -> Tuple[Dict[str, Any], List[asyncio.Future]]:
+        """
+        Lấy ra cập nhật đang chờ của job để ghi cùng một cập nhật đồng bộ.
+        Nếu job thuộc lô đang được ghi thì chờ lô đó xong để giữ đúng thứ tự.
+        """
+        if job_id in self._flushing:
+            async with self._flush_lock:
+                pass
+        pending = self._pending.pop(job_id, None)
+        if pending is None:
+            return {}, []
+        return pending.fields, pending.waiters
+
+    async def flush(self):
+        """Ghi tất cả cập nhật đang chờ trong một transaction"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            try:
+                results = {}
+                async with self.session_factory() as db:
+                    for job_id, pending in batch.items():
+                        result = await db.execute(
+                            update(Script)
+                            .where(Script.id == job_id, Script.lease_owner == pending.owner)
+                            .values(**pending.fields)
+                            .execution_options(synchronize_session=False)
+                        )
+                        results[job_id] = result.rowcount == 1
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi {len(batch)} cập nhật job: {e}")
+                for job_id, pending in batch.items():
+                    if pending.waiters:
+                        for future in pending.waiters:
+                            if not future.done():
+                                future.set_exception(e)
+                    else:
+                        # Ghi lại ở lần flush sau, cập nhật mới hơn được ưu tiên
+                        newer = self._pending.get(job_id)
+                        if newer is None or newer.owner == pending.owner:
+                            if newer is not None:
+                                pending.fields.update(newer.fields)
+                                pending.waiters.extend(newer.waiters)
+                            self._pending[job_id] = pending
+                return
+            finally:
+                self._flushing = {}
+
+        self._counters["flushes"] += 1
+        self._counters["rows"] += len(batch)
+        lost = [job_id for job_id, ok in results.items() if not ok]
+        if lost:
+            self._counters["lost_lease"] += len(lost)
+            logger.warning(f"Bỏ qua cập nhật của các job đã mất lease: {lost}")
+        for job_id, pending in batch.items():
+            for future in pending.waiters:
+                if not future.done():
+                    future.set_result(results[job_id])
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        """Khởi động vòng lặp flush trên event loop hiện tại"""
+        if self._task is None:
+            self._flush_lock = asyncio.Lock()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Dừng vòng lặp và ghi nốt các cập nhật còn lại"""
+        if self._task is None:
+            return
+        # Không hủy giữa chừng một lô đang được ghi
+        async with self._flush_lock:
+            self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._pending), **self._counters}
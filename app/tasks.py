@@ -1,177 +1,266 @@
 import os
 import shutil
-from typing import Dict
+import asyncio
+from typing import Dict, List
 import httpx
-from sqlalchemy.orm import Session
 from .utils.logging_config import logger
+from .utils.http_client import http_client
 from .services.voice_service import VoiceService
 from .services.video_service import VideoService
+from .services.scheduler_service import JobScheduler, JobPaused, ScriptJob
+from .services.endpoint_pool import CircuitOpenError, is_downstream_unavailable
+from .services.job_queue import JobQueue
+from .services.render_reconciler import RenderReconciler
+from .services.admission import AdmissionController
+from .models.script import ScriptStatus
 import time
 import uuid
+from datetime import datetime
 from .config.paths import (
     AUDIO_DIR, SRT_DIR, VIDEOS_DIR,
     get_channel_error_dir, get_channel_processed_dir,
     get_channel_dir, WF_DIR,
     get_channel_overlay1_dir, get_channel_overlay2_dir,
     get_channel_voice_dir, get_channel_final_dir,
-    ensure_channel_directories
+    ensure_channel_directories,
+    APP_API_URL, RENDER_CALLBACKS,
+    JOB_PAUSE_SECONDS, JOB_MAX_ATTEMPTS
 )
 
 # Khởi tạo các service với cấu hình
-voice_service = VoiceService(voice_api_url="http://localhost:5003")
-video_service = VideoService(video_api_url="http://localhost:5001")
+voice_service = VoiceService()
+video_service = VideoService()
 
 async def send_callback(callback_url: str, payload: Dict[str, any]):
     try:
-        async with httpx.AsyncClient() as client:
-            await client.post(callback_url, json=payload)
+        await http_client.post(callback_url, json=payload)
     except Exception as e:
         logger.error(f"Callback failed: {e}")
 
-async def process_script_task(
-    task_id: str, 
-    file_path: str, 
-    channel_name: str,
-    callback_url: str,
-    callback_id: str,
-    db: Session
-):
-    voice_response = None
+async def _pause_if_unavailable(job: ScriptJob, error: Exception, status: ScriptStatus):
+    """
+    Nếu lỗi do service downstream không khả dụng, tạm dừng job và trả về hàng
+    đợi (giữ nguyên checkpoint) thay vì đánh lỗi, rồi raise JobPaused.
+    Khi circuit đang mở, job chưa thực sự được chạy nên không tính vào số lần thử.
+    """
+    if job.script_id is None or not is_downstream_unavailable(error):
+        return
+    circuit_open = isinstance(error, CircuitOpenError)
+    if not circuit_open and job.attempts >= JOB_MAX_ATTEMPTS:
+        return
+    await job_queue.postpone(job.script_id, JOB_PAUSE_SECONDS, status=status, count_attempt=not circuit_open)
+    raise JobPaused(str(error))
+
+async def _fail_job(job: ScriptJob, stage: str, label: str, error: Exception,
+                    status: ScriptStatus = ScriptStatus.ERROR, extra: Dict[str, str] = None):
+    """
+    Di chuyển script lỗi vào thư mục error, ghi log và gửi callback lỗi
+    """
+    if job.script_id is not None:
+        await job_queue.fail(job.script_id, status, str(error))
+
+    # Di chuyển file lỗi vào thư mục error. Job đã được đánh dấu lỗi ở trên,
+    # lỗi khi di chuyển file chỉ được ghi log để callback lỗi vẫn được gửi
+    error_dir = get_channel_error_dir(job.channel_name)
+    error_file_path = os.path.join(error_dir, os.path.basename(job.file_path))
+    error_log_path = os.path.join(error_dir, f"{os.path.basename(job.file_path)}_error.log")
     try:
-        # Log bắt đầu xử lý task
-        logger.info(f"Starting processing for file: {file_path}")
-
-        # Bước 1: Xử lý Voice
-        logger.info("Processing voice...")
-        try:
-            voice_response = await voice_service.process_voice(
-                file_path=file_path, 
-                channel_name=channel_name
-            )
-            logger.info("Voice processing completed successfully.")
-
-            # Đổi tên file audio và SRT
-            script_name = os.path.splitext(os.path.basename(file_path))[0]
-            unique_id = uuid.uuid4().hex
-            audio_name = f"{script_name}_{unique_id}.wav"
-            srt_name = f"{script_name}_{unique_id}.srt"
-
-            # Di chuyển file audio và SRT đến thư mục assets
-            audio_path = voice_response['audio_path']
-            srt_path = voice_response['srt_path']
-            shutil.move(audio_path, os.path.join(AUDIO_DIR, audio_name))
-            shutil.move(srt_path, os.path.join(SRT_DIR, srt_name))
-            
-            voice_response['audio_path'] = os.path.join(AUDIO_DIR, audio_name)
-            voice_response['srt_path'] = os.path.join(SRT_DIR, srt_name)
-
-        except Exception as voice_error:
-            logger.error(f"Voice processing error: {voice_error}")
-            
-            # Di chuyển file lỗi vào thư mục error
-            error_dir = get_channel_error_dir(channel_name)
-            os.makedirs(error_dir, exist_ok=True)
-            error_file_path = os.path.join(error_dir, os.path.basename(file_path))
-            
-            # Ghi log chi tiết lỗi
-            error_log_path = os.path.join(error_dir, f"{os.path.basename(file_path)}_error.log")
-            with open(error_log_path, 'w') as log_file:
-                log_file.write(f"Voice Processing Error:\n{str(voice_error)}")
-            
-            # Di chuyển file gốc vào thư mục lỗi
-            shutil.move(file_path, error_file_path)
-            
-            # Gửi callback lỗi
-            await send_callback(
-                callback_url, 
-                {
-                    'task_id': task_id,
-                    'status': 'failed',
-                    'stage': 'voice_processing',
-                    'error': str(voice_error),
-                    'error_file': error_file_path,
-                    'error_log': error_log_path
-                }
-            )
-            return
-
-        # Bước 2: Xử lý Video
-        logger.info("Processing video...")
-        try:
-            video_response = await video_service.process_video(
-                audio_path=voice_response['audio_path'],
-                srt_path=voice_response['srt_path'],
-                channel_name=channel_name
+        os.makedirs(error_dir, exist_ok=True)
+
+        # Ghi log chi tiết lỗi
+        with open(error_log_path, 'w') as log_file:
+            log_file.write(f"{label}:\n{str(error)}")
+
+        # Di chuyển file gốc vào thư mục lỗi
+        shutil.move(job.file_path, error_file_path)
+    except Exception as move_error:
+        logger.error(f"Không thể di chuyển {job.file_path} vào thư mục error: {move_error}")
+
+    # Gửi callback lỗi
+    if job.callback_url:
+        await send_callback(
+            job.callback_url,
+            {
+                'task_id': job.task_id,
+                'status': 'failed',
+                'stage': stage,
+                'error': str(error),
+                'error_file': error_file_path,
+                'error_log': error_log_path,
+                **(extra or {})
+            }
+        )
+
+async def run_voice_stage(job: ScriptJob) -> bool:
+    """
+    Stage 1: Xử lý voice và di chuyển audio/SRT vào thư mục assets
+    """
+    logger.info(f"Processing voice for file: {job.file_path}")
+    try:
+        voice_response = await voice_service.process_voice(
+            file_path=job.file_path,
+            channel_name=job.channel_name
+        )
+        logger.info("Voice processing completed successfully.")
+
+        # Đổi tên file audio và SRT
+        script_name = os.path.splitext(os.path.basename(job.file_path))[0]
+        unique_id = uuid.uuid4().hex
+        audio_path = os.path.join(AUDIO_DIR, f"{script_name}_{unique_id}.wav")
+        srt_path = os.path.join(SRT_DIR, f"{script_name}_{unique_id}.srt")
+
+        # Di chuyển file audio và SRT đến thư mục assets
+        shutil.move(voice_response['audio_path'], audio_path)
+        shutil.move(voice_response['srt_path'], srt_path)
+
+        job.result.update({
+            'audio_path': audio_path,
+            'srt_path': srt_path
+        })
+
+        # Checkpoint: lần chạy sau sẽ bắt đầu từ stage video
+        if job.script_id is not None:
+            await job_queue.checkpoint(
+                job.script_id,
+                status=ScriptStatus.VOICE_DONE,
+                audio_path=audio_path,
+                srt_path=srt_path
             )
-            # Tạo tên video cuối cùng
-            final_video_name = f"{script_name}_{unique_id}.mp4"
-            final_video_path = os.path.join(VIDEOS_DIR, final_video_name)
-            # Di chuyển video đến đường dẫn mới
-            shutil.move(video_response['video_path'], final_video_path)
-            logger.info(f"Video đã được di chuyển tới: {final_video_path}")
-        except Exception as video_error:
-            logger.error(f"Video processing error: {video_error}")
-            
-            # Di chuyển file lỗi vào thư mục error
-            error_dir = get_channel_error_dir(channel_name)
-            os.makedirs(error_dir, exist_ok=True)
-            error_file_path = os.path.join(error_dir, os.path.basename(file_path))
-            
-            # Ghi log chi tiết lỗi
-            error_log_path = os.path.join(error_dir, f"{os.path.basename(file_path)}_error.log")
-            with open(error_log_path, 'w') as log_file:
-                log_file.write(f"Video Processing Error:\n{str(video_error)}")
-            
-            # Di chuyển file gốc vào thư mục lỗi
-            shutil.move(file_path, error_file_path)
-            
-            # Gửi callback lỗi - VẪN GIỮ NGUYÊN THÔNG TIN AUDIO VÀ SRT
-            await send_callback(
-                callback_url, 
-                {
-                    'task_id': task_id,
-                    'status': 'failed',
-                    'stage': 'video_processing',
-                    'error': str(video_error),
-                    'error_file': error_file_path,
-                    'error_log': error_log_path,
-                    'audio_path': voice_response['audio_path'],
-                    'srt_path': voice_response['srt_path']
-                }
+        return True
+
+    except Exception as voice_error:
+        await _pause_if_unavailable(job, voice_error, ScriptStatus.PROCESSING)
+        logger.error(f"Voice processing error: {voice_error}")
+        await _fail_job(job, 'voice_processing', "Voice Processing Error", voice_error,
+                        status=ScriptStatus.ERROR_VOICE)
+        return False
+
+async def run_video_stage(job: ScriptJob) -> bool:
+    """
+    Stage 2: Gửi yêu cầu render video. Trả về True khi render đã được submit,
+    việc chờ render kết thúc do render_reconciler đảm nhận
+    """
+    logger.info(f"Processing video for file: {job.file_path}")
+    try:
+        task_id = job.result.get('video_task_id')
+        if task_id:
+            # Render đã được gửi trước khi app khởi động lại, chỉ cần theo dõi tiếp
+            logger.info(f"Tiếp tục theo dõi render {task_id} cho file: {job.file_path}")
+            await video_service.attach_render(job.result.get('video_node_url'))
+            return True
+
+        render = await video_service.submit_render(
+            audio_path=job.result['audio_path'],
+            srt_path=job.result['srt_path'],
+            channel_name=job.channel_name,
+            # Video service gọi lại khi render xong, xem routes/file_routes.py
+            callback_url=f"{APP_API_URL}/task_callback/{job.task_id}" if RENDER_CALLBACKS else None
+        )
+        submitted_at = datetime.utcnow()
+        job.result.update({
+            'video_task_id': render['task_id'],
+            'video_node_url': render['node_url'],
+            'video_submitted_at': submitted_at,
+            'video_output_name': render['output_name'],
+            'overlay2_name': render['overlay2_name']
+        })
+        # Checkpoint: lưu task_id để có thể gắn lại vào render đang chạy
+        if job.script_id is not None:
+            await job_queue.checkpoint(
+                job.script_id,
+                video_task_id=render['task_id'],
+                video_node_url=render['node_url'],
+                video_submitted_at=submitted_at,
+                video_output_name=render['output_name'],
+                overlay2_name=render['overlay2_name']
             )
-            return
+        return True
+    except Exception as video_error:
+        await _pause_if_unavailable(job, video_error, ScriptStatus.VOICE_DONE)
+        await fail_video_stage(job, video_error)
+        return False
+
+async def fail_video_stage(job: ScriptJob, video_error: Exception):
+    """Xử lý lỗi của stage video"""
+    logger.error(f"Video processing error: {video_error}")
+    # VẪN GIỮ NGUYÊN THÔNG TIN AUDIO VÀ SRT trong callback lỗi
+    await _fail_job(
+        job, 'video_processing', "Video Processing Error", video_error,
+        status=ScriptStatus.ERROR_VIDEO,
+        extra={
+            'audio_path': job.result['audio_path'],
+            'srt_path': job.result['srt_path']
+        }
+    )
+
+async def finish_video_stage(job: ScriptJob) -> bool:
+    """
+    Hoàn tất job sau khi render xong: lấy video về, chuyển script vào thư mục
+    processed, cập nhật database và gửi callback
+    """
+    try:
+        video_path = await video_service.finalize_render(
+            job.channel_name, job.result['overlay2_name'], job.result['video_output_name']
+        )
+
+        # Tạo tên video cuối cùng theo tên file audio
+        final_video_name = f"{os.path.splitext(os.path.basename(job.result['audio_path']))[0]}.mp4"
+        final_video_path = os.path.join(VIDEOS_DIR, final_video_name)
+        # Di chuyển video đến đường dẫn mới
+        shutil.move(video_path, final_video_path)
+        logger.info(f"Video đã được di chuyển tới: {final_video_path}")
+    except Exception as video_error:
+        await fail_video_stage(job, video_error)
+        return False
 
-        # Xử lý thành công
-        # Di chuyển file đã xử lý vào thư mục processed
-        processed_dir = get_channel_processed_dir(channel_name)
+    # Xử lý thành công
+    # Di chuyển file đã xử lý vào thư mục processed. Video đã hoàn chỉnh nên job
+    # vẫn được đánh dấu hoàn thành nếu không di chuyển được file script
+    # (ingest_index tránh nhận lại file còn nằm trong thư mục channel)
+    processed_file_path = None
+    try:
+        processed_dir = get_channel_processed_dir(job.channel_name)
         os.makedirs(processed_dir, exist_ok=True)
-        processed_file_path = os.path.join(processed_dir, os.path.basename(file_path))
-        shutil.move(file_path, processed_file_path)
+        processed_file_path = os.path.join(processed_dir, os.path.basename(job.file_path))
+        shutil.move(job.file_path, processed_file_path)
         logger.info(f"File đã được di chuyển tới thư mục processed: {processed_file_path}")
-        
-        # Gửi callback thành công
+    except Exception as move_error:
+        processed_file_path = None
+        logger.error(f"Không thể di chuyển {job.file_path} vào thư mục processed: {move_error}")
+    job.result['final_video'] = final_video_path
+    if job.script_id is not None:
+        await job_queue.complete(job.script_id, video_path=final_video_path)
+
+    # Gửi callback thành công
+    if job.callback_url:
         await send_callback(
-            callback_url,
+            job.callback_url,
             {
-                'task_id': task_id,
+                'task_id': job.task_id,
                 'status': 'success',
                 'processed_file': processed_file_path,
                 'final_video': final_video_path
             }
         )
+    return True
 
-    except Exception as e:
-        logger.error(f"Unexpected processing error: {e}")
-        # Gửi callback lỗi
-        if callback_url:
-            await send_callback(
-                callback_url, 
-                {
-                    'task_id': task_id,
-                    'status': 'failed',
-                    'error': str(e)
-                }
-            )
+# Hàng đợi bền vững trên bảng scripts và scheduler dùng chung:
+# voice và video chạy trên hai worker pool riêng
+job_queue = JobQueue()
+# Một vòng lặp duy nhất theo dõi tất cả render đang chạy
+render_reconciler = RenderReconciler(
+    video_service,
+    complete_handler=finish_video_stage,
+    fail_handler=fail_video_stage
+)
+scheduler = JobScheduler(
+    voice_handler=run_voice_stage,
+    video_handler=run_video_stage,
+    job_queue=job_queue,
+    reconciler=render_reconciler
+)
+# Giới hạn backlog: file mới chỉ được đưa vào hàng đợi khi hệ thống còn chỗ
+admission = AdmissionController(scheduler)
 
 def setup_channel_directories(channel_name: str):
     """
@@ -186,8 +275,6 @@ async def process_script_file(file_path: str):
     Xử lý file script mới được thêm vào
     """
     try:
-        # Lấy tên file kịch bản mà không có phần mở rộng
-        script_name = os.path.splitext(os.path.basename(file_path))[0]
         channel_name = os.path.basename(os.path.dirname(file_path))
 
         # Kiểm tra xem thư mục kênh đã tồn tại hay chưa
@@ -196,15 +283,10 @@ async def process_script_file(file_path: str):
             # Nếu chưa có kênh, tạo cấu trúc thư mục cho channel
             setup_channel_directories(channel_name)
 
-        # Xử lý file
-        await process_script_task(
-            task_id=f"{script_name}_{int(time.time())}",
-            file_path=file_path,
-            channel_name=channel_name,
-            callback_url="",  # Có thể thêm callback URL nếu cần
-            callback_id="",   # Có thể thêm callback ID nếu cần
-            db=None          # Có thể thêm db session nếu cần
-        )
+        # Đưa file vào hàng đợi, các stage sẽ được xử lý bởi worker pool.
+        # Nếu backlog đã đầy, file được để lại trong thư mục và xử lý sau
+        # (truy cập database trong thread riêng để không chặn event loop)
+        await asyncio.to_thread(admission.admit_or_defer, file_path, channel_name)
 
     except Exception as e:
         logger.error(f"Lỗi xử lý file {file_path}: {str(e)}")
@@ -215,3 +297,50 @@ async def process_script_file(file_path: str):
         error_file_path = os.path.join(error_dir, os.path.basename(file_path))
         shutil.move(file_path, error_file_path)
         logger.error(f"File lỗi đã được di chuyển tới: {error_file_path}")
+
+async def process_new_channel(channel_name: str):
+    """
+    Channel mới được tạo khi app đang chạy: tạo cấu trúc thư mục và đưa các
+    file đã có sẵn trong thư mục (ví dụ copy cả thư mục channel) vào hàng đợi
+    """
+    try:
+        setup_channel_directories(channel_name)
+        await enqueue_backlog([channel_name])
+    except Exception as e:
+        logger.error(f"Lỗi khi khởi tạo channel mới {channel_name}: {str(e)}")
+
+def scan_channel_backlog(channel_dir: str, channel_name: str) -> List[Dict[str, str]]:
+    """
+    Liệt kê các file .txt đang chờ trong thư mục channel bằng os.scandir
+    (không stat lại từng file, không đi vào processed/error/completed)
+    """
+    backlog = []
+    with os.scandir(channel_dir) as entries:
+        for entry in entries:
+            if (entry.name.endswith('.txt') and not entry.name.startswith('error_')
+                    and entry.is_file()):
+                backlog.append({'file_path': entry.path, 'channel_name': channel_name})
+    return backlog
+
+async def enqueue_backlog(channels: List[str]):
+    """
+    Đưa các script còn tồn đọng của các channel vào hàng đợi.
+    Chỉ liệt kê và ghi vào database, việc xử lý do scheduler đảm nhận.
+    """
+    def _scan_and_enqueue():
+        backlog = []
+        for channel in channels:
+            try:
+                backlog.extend(scan_channel_backlog(get_channel_dir(channel), channel))
+            except OSError as e:
+                logger.error(f"Không thể liệt kê thư mục channel {channel}: {str(e)}")
+        return (len(backlog), *admission.admit_many(backlog))
+
+    try:
+        found, added, deferred = await asyncio.to_thread(_scan_and_enqueue)
+        logger.info(
+            f"Backlog khi khởi động: {found} file, {added} job mới được đưa vào hàng đợi, "
+            f"{deferred} file chờ tới khi hệ thống còn chỗ"
+        )
+    except Exception as e:
+        logger.error(f"Lỗi khi đưa backlog vào hàng đợi: {str(e)}")
@@ -0,0 +1,129 @@
+import re
+import mmap
+import wave
+import struct
+from typing import List, Tuple
+
+# Ranh giới câu: dấu kết thúc câu (có thể kèm dấu ngoặc/nháy) rồi tới khoảng trắng
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])\s+|(?<=[.!?…]["\'”’)\]])\s+')
+PARAGRAPH_BOUNDARY = re.compile(r'\n\s*\n')
+SRT_TIME = re.compile(r'(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)')
+
+
+def split_script(text: str, max_chars: int) -> List[Tuple[str, bool]]:
+    """
+    Chia script thành các chunk không quá max_chars ký tự.
+    Ưu tiên cắt ở ranh giới đoạn văn, đoạn quá dài được cắt ở ranh giới câu.
+    Trả về danh sách (nội dung chunk, chunk có kết thúc một đoạn văn hay không).
+    """
+    chunks: List[Tuple[str, bool]] = []
+    for paragraph in PARAGRAPH_BOUNDARY.split(text):
+        paragraph = ' '.join(paragraph.split())
+        if not paragraph:
+            continue
+        current = ''
+        for sentence in SENTENCE_BOUNDARY.split(paragraph):
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                chunks.append((current, False))
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            chunks.append((current, True))
+    return chunks
+
+
+def _find_data_chunk(mm: mmap.mmap) -> Tuple[int, int]:
+    """Tìm vị trí và kích thước của chunk 'data' trong file WAV (RIFF)"""
+    if mm[0:4] != b'RIFF' or mm[8:12] != b'WAVE':
+        raise ValueError("File không phải định dạng WAV")
+    offset = 12
+    while offset + 8 <= len(mm):
+        chunk_id = mm[offset:offset + 4]
+        (chunk_size,) = struct.unpack('<I', mm[offset + 4:offset + 8])
+        if chunk_id == b'data':
+            return offset + 8, min(chunk_size, len(mm) - offset - 8)
+        offset += 8 + chunk_size + (chunk_size & 1)
+    raise ValueError("Không tìm thấy dữ liệu audio trong file WAV")
+
+
+def stitch_wavs(parts: List[Tuple[str, int]], output_path: str) -> List[float]:
+    """
+    Nối các file WAV thành một file, chèn khoảng lặng sau mỗi phần.
+
+    parts: danh sách (đường dẫn WAV, số ms khoảng lặng chèn sau phần đó).
+    Dữ liệu audio được đọc qua mmap và ghi thẳng ra file đích, không nạp cả
+    file vào bộ nhớ. Trả về thời điểm bắt đầu (giây) của từng phần.
+    """
+    offsets: List[float] = []
+    params = None
+    elapsed_frames = 0
+    with wave.open(output_path, 'wb') as out:
+        for wav_path, silence_ms in parts:
+            with wave.open(wav_path, 'rb') as src:
+                part_params = (src.getnchannels(), src.getsampwidth(), src.getframerate())
+            if params is None:
+                params = part_params
+                out.setnchannels(params[0])
+                out.setsampwidth(params[1])
+                out.setframerate(params[2])
+            elif part_params != params:
+                raise ValueError(f"Định dạng audio không khớp: {wav_path} {part_params} != {params}")
+
+            nchannels, sampwidth, framerate = params
+            frame_size = nchannels * sampwidth
+            offsets.append(elapsed_frames / framerate)
+
+            with open(wav_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start, size = _find_data_chunk(mm)
+                size -= size % frame_size
+                view = memoryview(mm)
+                try:
+                    out.writeframesraw(view[start:start + size])
+                finally:
+                    view.release()
+            elapsed_frames += size // frame_size
+
+            silence_frames = int(framerate * silence_ms / 1000)
+            if silence_frames:
+                # PCM 8-bit là unsigned, khoảng lặng có giá trị 0x80
+                fill = b'\x80' if sampwidth == 1 else b'\x00'
+                out.writeframesraw(fill * (silence_frames * frame_size))
+                elapsed_frames += silence_frames
+    return offsets
+
+
+def _srt_ms(h: str, m: str, s: str, ms: str) -> int:
+    return ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms.ljust(3, '0')[:3])
+
+
+def _format_srt_time(total_ms: int) -> str:
+    h, rest = divmod(total_ms, 3600000)
+    m, rest = divmod(rest, 60000)
+    s, ms = divmod(rest, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+
+def merge_srts(parts: List[Tuple[str, float]], output_path: str):
+    """
+    Gộp các file SRT thành một, dời thời gian của mỗi phần theo offset (giây)
+    và đánh số lại các cue.
+    """
+    cues = []
+    for srt_path, offset in parts:
+        shift = int(round(offset * 1000))
+        with open(srt_path, 'r', encoding='utf-8-sig') as f:
+            blocks = re.split(r'\n\s*\n', f.read().replace('\r\n', '\n').strip())
+        for block in blocks:
+            lines = block.split('\n')
+            for i, line in enumerate(lines):
+                match = SRT_TIME.search(line)
+                if match:
+                    start = _srt_ms(*match.groups()[:4]) + shift
+                    end = _srt_ms(*match.groups()[4:]) + shift
+                    cues.append((start, end, '\n'.join(lines[i + 1:])))
+                    break
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for index, (start, end, text) in enumerate(cues, 1):
+            f.write(f"{index}\n{_format_srt_time(start)} --> {_format_srt_time(end)}\n{text}\n\n")
@@ -0,0 +1,94 @@
+import os
+import re
+import fnmatch
+from typing import Iterable, Optional, Tuple
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from ..config.paths import WATCH_INCLUDE, WATCH_EXCLUDE
+
+# Độ sâu của file script và thư mục channel so với thư mục scripts
+SCRIPT_DEPTH = 2
+CHANNEL_DEPTH = 1
+
+
+def _compile(patterns: Iterable[str]) -> Optional["re.Pattern"]:
+    """Gộp các glob thành một regex duy nhất"""
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(p)})' for p in patterns))
+
+
+class EventFilter:
+    """
+    Bộ lọc event của watchdog, chạy trước mọi logic của handler.
+
+    Path được xét theo đường dẫn tương đối với root (dạng a/b/c.txt):
+    - file chỉ được giữ lại nếu nằm đúng độ sâu file_depth, khớp một glob trong
+      include và không khớp glob nào trong exclude;
+    - thư mục chỉ được giữ lại (event tạo/xóa/đổi tên) nếu nằm ở độ sâu dir_depth,
+      dir_depth=None là bỏ qua mọi event thư mục;
+    - event đổi tên được xét theo đích, nên file được chuyển vào processed/,
+      error/, completed/ bị loại bỏ ngay.
+    Các glob được biên dịch một lần thành regex.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        include: Iterable[str] = WATCH_INCLUDE,
+        exclude: Iterable[str] = WATCH_EXCLUDE,
+        file_depth: Optional[int] = SCRIPT_DEPTH,
+        dir_depth: Optional[int] = CHANNEL_DEPTH,
+    ):
+        self.root = os.path.abspath(root)
+        self.file_depth = file_depth
+        self.dir_depth = dir_depth
+        self._include = _compile(include)
+        self._exclude = _compile(exclude)
+
+    def relative_parts(self, path: str) -> Tuple[str, ...]:
+        """Các thành phần của path tương đối với root, () nếu path nằm ngoài root"""
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel == os.curdir or rel.startswith(os.pardir):
+            return ()
+        return tuple(rel.split(os.sep))
+
+    def match_file(self, path: str) -> bool:
+        parts = self.relative_parts(path)
+        if not parts or (self.file_depth is not None and len(parts) != self.file_depth):
+            return False
+        rel = '/'.join(parts)
+        if self._include is not None and not self._include.match(rel):
+            return False
+        return self._exclude is None or not self._exclude.match(rel)
+
+    def match_dir(self, path: str) -> bool:
+        parts = self.relative_parts(path)
+        if not parts or self.dir_depth is None or len(parts) != self.dir_depth:
+            return False
+        return self._exclude is None or not self._exclude.match('/'.join(parts) + '/')
+
+    def accepts(self, event: FileSystemEvent) -> bool:
+        match = self.match_dir if event.is_directory else self.match_file
+        if event.is_directory and event.event_type == 'modified':
+            # Thư mục thay đổi mỗi khi có file được thêm/xóa, đã có event riêng của file
+            return False
+        if event.event_type == 'moved':
+            return match(event.dest_path) or (event.is_directory and match(event.src_path))
+        return match(event.src_path)
+
+    def channel_of(self, path: str) -> Optional[str]:
+        """Tên channel của file script, None nếu path không phải script của channel nào"""
+        if not self.match_file(path):
+            return None
+        return self.relative_parts(path)[0]
+
+
+class FilteredEventHandler(FileSystemEventHandler):
+    """Handler bỏ qua các event không qua được event_filter trước khi gọi on_*"""
+
+    event_filter: EventFilter
+
+    def dispatch(self, event: FileSystemEvent):
+        if self.event_filter.accepts(event):
+            super().dispatch(event)
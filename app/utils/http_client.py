@@ -0,0 +1,175 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import httpx
+from ..config.paths import (
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+    HTTP_MAX_KEEPALIVE_PER_HOST,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP2_ENABLED,
+)
+
+# HTTP/2 cần package h2 (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Số mẫu latency giữ lại cho mỗi host để tính percentile
+LATENCY_SAMPLES = 1024
+
+
+class _HostMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def stats(self) -> Dict:
+        samples = sorted(self.latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'latency_max_ms': round(samples[-1] * 1000, 1) if samples else None,
+        }
+
+
+class HttpClientManager:
+    """
+    Quản lý các httpx.AsyncClient dùng chung, mỗi host downstream một client.
+
+    Mỗi client giữ connection pool keep-alive riêng với giới hạn số kết nối
+    theo host, nên hàng trăm request kiểm tra trạng thái chỉ dùng lại một số
+    ít kết nối thay vì bắt tay TCP cho mỗi request. Timeout được tách thành
+    connect/read (theo request) và tổng thời gian (total_timeout).
+    """
+
+    def __init__(
+        self,
+        max_connections: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+        max_keepalive: int = HTTP_MAX_KEEPALIVE_PER_HOST,
+        keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        read_timeout: float = HTTP_READ_TIMEOUT,
+        http2: bool = HTTP2_ENABLED,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("HTTP2 được bật nhưng chưa cài package h2, dùng HTTP/1.1")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._metrics: Dict[str, _HostMetrics] = {}
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _timeout(self, read_timeout: Optional[float]) -> httpx.Timeout:
+        read = self.read_timeout if read_timeout is None else read_timeout
+        return httpx.Timeout(read, connect=self.connect_timeout, pool=read)
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        """Client dùng chung cho host của url"""
+        key = self._host_key(url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self._timeout(None),
+                http2=self.http2,
+            )
+            self._clients[key] = client
+            self._metrics.setdefault(key, _HostMetrics())
+        return client
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        read_timeout: Optional[float] = None,
+        total_timeout: Optional[float] = None,
+        **kwargs,
+    ) -> httpx.Response:
+        """
+        Gửi request qua client dùng chung của host.
+        read_timeout: thời gian chờ tối đa giữa hai lần nhận dữ liệu.
+        total_timeout: thời gian tối đa của cả request, vượt quá sẽ raise httpx.TimeoutException.
+        """
+        client = self.client(url)
+        metrics = self._metrics[self._host_key(url)]
+        metrics.requests += 1
+        metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            send = client.request(method, url, timeout=self._timeout(read_timeout), **kwargs)
+            if total_timeout is None:
+                return await send
+            try:
+                return await asyncio.wait_for(send, timeout=total_timeout)
+            except asyncio.TimeoutError:
+                raise httpx.TimeoutException(f"{method} {url} quá {total_timeout}s") from None
+        except Exception:
+            metrics.errors += 1
+            raise
+        finally:
+            metrics.in_flight -= 1
+            metrics.latencies.append(time.perf_counter() - start)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def aclose(self):
+        """Đóng tất cả kết nối (gọi khi app shutdown)"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Số kết nối trong pool và latency theo host"""
+        result = {}
+        for key, metrics in self._metrics.items():
+            stats = metrics.stats()
+            client = self._clients.get(key)
+            # Connection pool của httpcore, không phải API public nên đọc có kiểm tra
+            pool = getattr(getattr(client, '_transport', None), '_pool', None)
+            connections = list(getattr(pool, 'connections', None) or [])
+            stats['connections'] = len(connections)
+            stats['idle_connections'] = sum(1 for c in connections if c.is_idle())
+            result[key] = stats
+        return {
+            'http2': self.http2,
+            'max_connections_per_host': self.limits.max_connections,
+            'hosts': result,
+        }
+
+
+http_client = HttpClientManager()
@@ -1,15 +1,20 @@
 import os
+import time
+import queue
 import logging
+import threading
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from datetime import datetime
 import sys
 
 # Thêm đường dẫn của app vào PYTHONPATH
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from app.models.script import Script, ScriptStatus, Base
-from app.database import engine, SessionLocal
-from app.config.paths import SCRIPTS_DIR
+from app.models.script import Base
+from app.models.ingested_file import IngestedFile  # noqa: F401
+from app.database import engine, add_missing_columns, add_missing_indexes
+from app.services.job_queue import JobQueue
+from app.services.watcher_service import WriteDebouncer
+from app.utils.event_filter import EventFilter, FilteredEventHandler
+from app.config.paths import SCRIPTS_DIR, WATCH_BATCH_SIZE, WATCH_BATCH_SECONDS
 
 # Tạo thư mục logs nếu chưa tồn tại
 os.makedirs('logs', exist_ok=True)
@@ -25,64 +30,167 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class ScriptWatcher(FileSystemEventHandler):
-    def __init__(self, scripts_dir):
+class ScriptBatcher:
+    """
+    Gom các file được phát hiện và ghi vào database theo lô.
+
+    Thread của watchdog chỉ đưa file vào queue; một thread riêng lấy file ra và
+    ghi cả lô bằng JobQueue.enqueue_many (một session và một transaction cho
+    mỗi lô) khi đủ batch_size file hoặc khi file đầu tiên của lô đã chờ
+    batch_seconds giây.
+    """
+
+    def __init__(self, job_queue, batch_size=WATCH_BATCH_SIZE, batch_seconds=WATCH_BATCH_SECONDS):
+        self.job_queue = job_queue
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, file_path, channel_name):
+        self._queue.put({'file_path': file_path, 'channel_name': channel_name})
+
+    def _collect(self):
+        """Chờ file đầu tiên rồi gom thêm cho đến khi đủ batch_size hoặc hết batch_seconds"""
+        try:
+            item = self._queue.get(timeout=self.batch_seconds)
+        except queue.Empty:
+            return []
+        batch = {item['file_path']: item}
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch[item['file_path']] = item
+        return list(batch.values())
+
+    def flush(self, items):
+        """Ghi một lô file vào database"""
+        try:
+            # File đã được nhận (bởi watcher khác) sẽ bị bỏ qua
+            added = self.job_queue.enqueue_many(items)
+        except Exception as e:
+            logger.error(f"Lỗi ghi {len(items)} file vào database: {str(e)}")
+            return
+        skipped = len(items) - added
+        logger.info(
+            f"Đã thêm {added} file vào database"
+            + (f", bỏ qua {skipped} file đã được nhận trước đó" if skipped else "")
+        )
+
+    def _run(self):
+        while not self._stop.is_set():
+            items = self._collect()
+            if items:
+                self.flush(items)
+        # Ghi nốt các file còn trong queue
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(items), self.batch_size):
+            self.flush(items[i:i + self.batch_size])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="script-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def pending(self):
+        return self._queue.qsize()
+
+class ScriptWatcher(FilteredEventHandler):
+    def __init__(self, scripts_dir, batcher, debouncer):
         """
         Khởi tạo file watcher cho các channel
         
         :param scripts_dir: Thư mục chứa các channel
+        :param batcher: ScriptBatcher ghi các file phát hiện được vào database
+        :param debouncer: WriteDebouncer chờ file được ghi xong trước khi đưa vào batcher
         """
         self.scripts_dir = scripts_dir
-        self.db = SessionLocal()
+        # Chỉ nhận file script nằm trực tiếp trong thư mục channel,
+        # bỏ qua event của processed/, error/, completed/ và file tạm
+        self.event_filter = EventFilter(scripts_dir, dir_depth=None)
+        self.batcher = batcher
+        self.debouncer = debouncer
     
     def on_created(self, event):
         """
         Xử lý khi file mới được tạo
         """
-        if not event.is_directory and event.src_path.endswith('.txt'):
+        if not event.is_directory:
             logger.info(f"Phát hiện file mới: {event.src_path}")
-            self.process_file(event.src_path)
+            # File có thể chưa được ghi xong, debouncer sẽ chờ tới khi file ổn định
+            self.debouncer.touch(event.src_path, self.process_file)
+    
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.debouncer.touch(event.src_path, self.process_file)
+    
+    def on_closed(self, event):
+        # Chỉ có trên Linux (inotify IN_CLOSE_WRITE): file đã được ghi xong
+        if not event.is_directory:
+            self.debouncer.touch(event.src_path, self.process_file, ready=True)
+    
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        self.debouncer.discard(event.src_path)
+        # Ghi ra file tạm rồi đổi tên: file đích đã hoàn chỉnh
+        # (event_filter đã loại bỏ file chuyển vào processed/, error/...)
+        logger.info(f"Phát hiện file mới: {event.dest_path}")
+        self.debouncer.touch(event.dest_path, self.process_file, ready=True)
+    
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.debouncer.discard(event.src_path)
     
     def extract_channel_name(self, file_path):
         """
-        Trích xuất tên channel từ đường dẫn file
+        Trích xuất tên channel từ đường dẫn file (thư mục con trực tiếp của scripts_dir),
+        None nếu file không nằm trong thư mục channel
         """
-        parts = file_path.split(os.path.sep)
-        for part in parts:
-            if part.startswith('C') and part[1:].isdigit():
-                return part
-        return "C1"  # Mặc định
+        return self.event_filter.channel_of(file_path)
     
     def process_file(self, file_path):
         """
-        Xử lý file script bằng cách thêm vào database
+        Xử lý file script bằng cách đưa vào buffer, file được ghi vào database theo lô
         """
-        try:
-            # Tạo record mới trong database
-            script = Script(
-                file_path=file_path,
-                channel_name=self.extract_channel_name(file_path),
-                status=ScriptStatus.pending,
-                created_at=datetime.now()
-            )
-            
-            # Thêm vào database
-            self.db.add(script)
-            self.db.commit()
-            
-            logger.info(f"Đã thêm file {os.path.basename(file_path)} vào database với ID: {script.id}")
-            
-        except Exception as e:
-            logger.error(f"Lỗi xử lý file {file_path}: {str(e)}")
-            # Không di chuyển file, chỉ ghi log
+        channel_name = self.extract_channel_name(file_path)
+        if channel_name is None:
+            logger.warning(f"Bỏ qua file không thuộc channel nào: {file_path}")
+            return
+        self.batcher.add(file_path, channel_name)
 
 def start_watching(scripts_dir):
     """
     Bắt đầu giám sát thư mục scripts với các channel
     """
     try:
+        Base.metadata.create_all(bind=engine)
+        add_missing_columns(Base.metadata)
+        add_missing_indexes(Base.metadata)
+        
+        batcher = ScriptBatcher(JobQueue())
+        batcher.start()
+        debouncer = WriteDebouncer()
+        debouncer.start()
+        
         # Tạo và khởi động observer
-        event_handler = ScriptWatcher(scripts_dir)
+        event_handler = ScriptWatcher(scripts_dir, batcher, debouncer)
         observer = Observer()
         observer.schedule(event_handler, scripts_dir, recursive=True)
         observer.start()
@@ -91,13 +199,14 @@ def start_watching(scripts_dir):
         
         try:
             while True:
-                import time
                 time.sleep(1)
         except KeyboardInterrupt:
             observer.stop()
             logger.info("Dừng theo dõi thư mục")
         
         observer.join()
+        debouncer.stop()
+        batcher.stop()
         
     except Exception as e:
         logger.error(f"Lỗi khởi động watcher: {e}")
@@ -1,45 +1,100 @@
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 import os
+import sys
+import time
 import requests
 import logging
+import threading
 from time import sleep
+from typing import Dict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.utils.event_filter import EventFilter, FilteredEventHandler
 
 logger = logging.getLogger(__name__)
 
-class ScriptEventHandler(FileSystemEventHandler):
-    def __init__(self, api_url: str):
+# Used when a 429 response carries no usable Retry-After header
+DEFAULT_RETRY_AFTER = 30.0
+
+class ScriptEventHandler(FilteredEventHandler):
+    def __init__(self, api_url: str, watch_directory: str):
         self.api_url = api_url
+        # Only scripts directly inside a channel directory; moves into
+        # processed/, error/, completed/ and temp files are dropped up front
+        self.event_filter = EventFilter(watch_directory, dir_depth=None)
+        # Scripts rejected while the API backlog is full: path -> monotonic retry time
+        self._retry_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._retry_loop, name="script-retry", daemon=True).start()
 
     def on_created(self, event):
         if event.is_directory:
             return
-            
-        if not event.src_path.endswith('.txt'):
-            return
-            
+        self.notify(event.src_path)
+
+    def notify(self, file_path: str) -> bool:
+        """
+        Notify the API about a script. Returns False if the API rejected it
+        with 429 (backlog full); the script is then retried after Retry-After.
+        """
         try:
-            # Get channel name from parent directory
-            channel_name = os.path.basename(os.path.dirname(event.src_path))
+            # Channel is the directory directly under the watched root
+            channel_name = self.event_filter.channel_of(file_path)
             
             # Notify API about new script
             response = requests.post(
                 f"{self.api_url}/process_script",
                 json={
-                    "file_path": event.src_path,
+                    "file_path": file_path,
                     "channel_name": channel_name
                 }
             )
+            if response.status_code == 429:
+                self._schedule_retry(file_path, response.headers.get("Retry-After"))
+                return False
             response.raise_for_status()
-            logger.info(f"Successfully notified API about new script: {event.src_path}")
+            if response.json().get("status") == "duplicate":
+                logger.info(f"Script already ingested, skipped: {file_path}")
+                return True
+            logger.info(f"Successfully notified API about new script: {file_path}")
             
         except Exception as e:
-            logger.error(f"Error processing new script {event.src_path}: {str(e)}")
+            logger.error(f"Error processing new script {file_path}: {str(e)}")
+        return True
+
+    def _schedule_retry(self, file_path: str, retry_after: str = None):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = DEFAULT_RETRY_AFTER
+        with self._lock:
+            self._retry_at[file_path] = time.monotonic() + delay
+        logger.info(f"API backlog is full, retrying {file_path} in {delay:.0f}s")
+
+    def _retry_loop(self):
+        while True:
+            sleep(1)
+            now = time.monotonic()
+            with self._lock:
+                due = [path for path, at in self._retry_at.items() if at <= now]
+                for path in due:
+                    del self._retry_at[path]
+            for index, path in enumerate(due):
+                if not os.path.exists(path):
+                    continue
+                if not self.notify(path):
+                    # Still full: push the rest back with the first one instead of
+                    # sending requests that will be rejected as well
+                    with self._lock:
+                        retry_at = self._retry_at[path]
+                        for rest in due[index + 1:]:
+                            self._retry_at.setdefault(rest, retry_at)
+                    break
 
 class ScriptWatcher:
     def __init__(self, watch_directory: str, api_url: str):
         self.watch_directory = watch_directory
-        self.event_handler = ScriptEventHandler(api_url)
+        self.event_handler = ScriptEventHandler(api_url, watch_directory)
         self.observer = Observer()
 
     def start(self):
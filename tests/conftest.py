@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.config.paths tạo thư mục workspace và app.database tạo engine ngay khi
+# được import, nên biến môi trường phải được đặt trước mọi import từ app
+_TEST_ROOT = tempfile.mkdtemp(prefix='wf-tests-')
+os.environ['WF_ROOT'] = _TEST_ROOT
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_TEST_ROOT, 'workflow.db')}"
+# overlay1.png mẫu không có trong repo, tạo sẵn để initialize_workspace() bỏ qua bước copy
+for _channel in ('Channel_1', 'Channel_2'):
+    _overlay_dir = os.path.join(_TEST_ROOT, 'WF', 'assets', 'overlay1', _channel)
+    os.makedirs(_overlay_dir, exist_ok=True)
+    open(os.path.join(_overlay_dir, 'overlay1.png'), 'wb').close()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import NullPool  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker  # noqa: E402
+
+from app.database import _set_sqlite_pragmas  # noqa: E402
+from app.models.script import Base  # noqa: E402
+from app.models.ingested_file import IngestedFile  # noqa: E402,F401
+from app.services.ingest_index import ingest_index  # noqa: E402
+
+
+@pytest.fixture
+def session_factories(tmp_path):
+    """Database SQLite riêng cho mỗi test, trả về (sessionmaker, async_sessionmaker)"""
+    db_path = tmp_path / 'queue.db'
+    engine = create_engine(f"sqlite:///{db_path}")
+    # NullPool: mỗi test chạy coroutine bằng asyncio.run() trên event loop mới,
+    # kết nối aiosqlite không được dùng lại giữa các loop
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool)
+    for _engine in (engine, async_engine.sync_engine):
+        event.listen(_engine, 'connect', _set_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    yield (
+        sessionmaker(autocommit=False, autoflush=False, bind=engine),
+        async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False),
+    )
+    engine.dispose()
+
+
+@pytest.fixture(autouse=True)
+def clear_ingest_cache():
+    """ingest_index là singleton, cache của test trước không được ảnh hưởng test sau"""
+    ingest_index._cache.clear()
+    yield
+    ingest_index._cache.clear()
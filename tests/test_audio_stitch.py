@@ -0,0 +1,122 @@
+import wave
+
+import pytest
+
+from app.utils.audio_stitch import merge_srts, split_script, stitch_wavs
+
+FRAMERATE = 8000
+
+
+def _write_wav(path, frames: int, sampwidth: int = 2, value: bytes = b'\x01') -> str:
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(sampwidth)
+        wav.setframerate(FRAMERATE)
+        wav.writeframes(value * (frames * sampwidth))
+    return str(path)
+
+
+def test_split_script_prefers_paragraph_then_sentence_boundaries():
+    text = "Câu một. Câu hai!\n\nĐoạn hai câu một? Đoạn hai câu hai.\n  \nĐoạn ba."
+
+    assert split_script(text, max_chars=100) == [
+        ("Câu một. Câu hai!", True),
+        ("Đoạn hai câu một? Đoạn hai câu hai.", True),
+        ("Đoạn ba.", True),
+    ]
+    assert split_script(text, max_chars=20) == [
+        ("Câu một. Câu hai!", True),
+        ("Đoạn hai câu một?", False),
+        ("Đoạn hai câu hai.", True),
+        ("Đoạn ba.", True),
+    ]
+
+
+def test_split_script_keeps_chunks_within_limit():
+    text = " ".join(f"Câu số {i} của đoạn văn." for i in range(50))
+    chunks = split_script(text, max_chars=80)
+
+    assert all(len(chunk) <= 80 for chunk, _ in chunks)
+    assert [end for _, end in chunks] == [False] * (len(chunks) - 1) + [True]
+    assert " ".join(chunk for chunk, _ in chunks) == text
+
+
+def test_stitch_wavs_offsets_include_silence(tmp_path):
+    parts = [
+        (_write_wav(tmp_path / "a.wav", 800), 50),   # 0.1s + 50ms lặng
+        (_write_wav(tmp_path / "b.wav", 1600), 0),   # 0.2s
+        (_write_wav(tmp_path / "c.wav", 400), 250),  # 0.05s + 250ms lặng
+    ]
+    output = str(tmp_path / "out.wav")
+
+    offsets = stitch_wavs(parts, output)
+
+    assert offsets == pytest.approx([0.0, 0.15, 0.35])
+    with wave.open(output, 'rb') as wav:
+        assert wav.getframerate() == FRAMERATE
+        assert wav.getnframes() == 800 + 400 + 1600 + 400 + 2000
+        data = wav.readframes(wav.getnframes())
+    # Khoảng lặng nằm đúng sau phần đầu tiên
+    assert data[800 * 2:1200 * 2] == b'\x00' * 800
+    assert data[1200 * 2:1201 * 2] == b'\x01\x01'
+
+
+def test_stitch_wavs_8bit_silence_is_unsigned_midpoint(tmp_path):
+    parts = [(_write_wav(tmp_path / "a.wav", 80, sampwidth=1, value=b'\x10'), 10)]
+    output = str(tmp_path / "out.wav")
+
+    stitch_wavs(parts, output)
+
+    with wave.open(output, 'rb') as wav:
+        data = wav.readframes(wav.getnframes())
+    assert data == b'\x10' * 80 + b'\x80' * 80
+
+
+def test_stitch_wavs_rejects_mismatched_format(tmp_path):
+    parts = [
+        (_write_wav(tmp_path / "a.wav", 80, sampwidth=2), 0),
+        (_write_wav(tmp_path / "b.wav", 80, sampwidth=1), 0),
+    ]
+    with pytest.raises(ValueError):
+        stitch_wavs(parts, str(tmp_path / "out.wav"))
+
+
+def test_merge_srts_shifts_and_renumbers_cues(tmp_path):
+    first = tmp_path / "a.srt"
+    first.write_text(
+        "1\n00:00:00,000 --> 00:00:01,500\nXin chào\n\n"
+        "2\n00:00:01,500 --> 00:00:02,250\nDòng một\nDòng hai\n",
+        encoding='utf-8',
+    )
+    second = tmp_path / "b.srt"
+    # BOM, CRLF và dấu chấm thay cho dấu phẩy đều được chấp nhận
+    second.write_bytes(
+        "\ufeff1\r\n00:00:00.100 --> 00:00:00.900\r\nTạm biệt\r\n".encode('utf-8')
+    )
+    output = tmp_path / "out.srt"
+
+    merge_srts([(str(first), 0.0), (str(second), 3661.35)], str(output))
+
+    assert output.read_text(encoding='utf-8') == (
+        "1\n00:00:00,000 --> 00:00:01,500\nXin chào\n\n"
+        "2\n00:00:01,500 --> 00:00:02,250\nDòng một\nDòng hai\n\n"
+        "3\n01:01:01,450 --> 01:01:02,250\nTạm biệt\n\n"
+    )
+
+
+def test_stitch_offsets_line_up_merged_subtitles(tmp_path):
+    parts = [
+        (_write_wav(tmp_path / "a.wav", 4000), 500),  # 0.5s + 0.5s lặng
+        (_write_wav(tmp_path / "b.wav", 4000), 0),
+    ]
+    offsets = stitch_wavs(parts, str(tmp_path / "out.wav"))
+    srts = []
+    for i, offset in enumerate(offsets):
+        srt = tmp_path / f"{i}.srt"
+        srt.write_text(f"1\n00:00:00,000 --> 00:00:00,500\nPhần {i}\n", encoding='utf-8')
+        srts.append((str(srt), offset))
+    output = tmp_path / "out.srt"
+
+    merge_srts(srts, str(output))
+
+    assert "2\n00:00:01,000 --> 00:00:01,500\nPhần 1\n" in output.read_text(encoding='utf-8')
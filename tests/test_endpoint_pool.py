@@ -0,0 +1,113 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.services.endpoint_pool import (
+    CIRCUIT_CLOSED,
+    CIRCUIT_HALF_OPEN,
+    CIRCUIT_OPEN,
+    CircuitOpenError,
+    Endpoint,
+    EndpointPool,
+)
+
+URL = "http://voice-1:8000"
+
+
+def _error() -> Exception:
+    return httpx.ConnectError("connection refused")
+
+
+async def _open_circuit(pool: EndpointPool, endpoint: Endpoint):
+    for _ in range(pool.failure_threshold):
+        await pool.release(await pool.acquire(), _error())
+    assert endpoint.state == CIRCUIT_OPEN
+
+
+def test_failures_open_circuit_after_threshold():
+    async def scenario():
+        pool = EndpointPool("voice", [URL], max_outstanding=2, failure_threshold=3)
+        endpoint = pool.endpoints[0]
+
+        for _ in range(2):
+            await pool.release(await pool.acquire(), _error())
+        assert endpoint.state == CIRCUIT_CLOSED
+        # Request thành công xóa chuỗi lỗi liên tiếp
+        await pool.release(await pool.acquire())
+        assert endpoint.consecutive_failures == 0
+
+        await _open_circuit(pool, endpoint)
+        assert endpoint.opened_at is not None
+        assert pool.all_open
+        with pytest.raises(CircuitOpenError):
+            await pool.acquire()
+
+    asyncio.run(scenario())
+
+
+def test_half_open_admits_a_single_probe():
+    async def scenario():
+        pool = EndpointPool("voice", [URL], max_outstanding=4, failure_threshold=1)
+        endpoint = pool.endpoints[0]
+        await _open_circuit(pool, endpoint)
+
+        await pool._half_open(endpoint)
+        assert endpoint.state == CIRCUIT_HALF_OPEN
+        probe = await pool.acquire()
+        assert endpoint.probe_in_flight
+
+        # Request thứ hai chờ tới khi request thử có kết quả
+        waiting = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        await pool.release(probe)
+        assert endpoint.state == CIRCUIT_CLOSED
+        assert endpoint.opened_at is None
+        assert not endpoint.probe_in_flight
+        assert await asyncio.wait_for(waiting, 1) is endpoint
+
+    asyncio.run(scenario())
+
+
+def test_failed_probe_reopens_circuit():
+    async def scenario():
+        pool = EndpointPool("voice", [URL], max_outstanding=4, failure_threshold=3)
+        endpoint = pool.endpoints[0]
+        await _open_circuit(pool, endpoint)
+
+        await pool._half_open(endpoint)
+        # Một lỗi của request thử là đủ để mở lại, không chờ failure_threshold
+        await pool.release(await pool.acquire(), _error())
+        assert endpoint.state == CIRCUIT_OPEN
+        assert not endpoint.probe_in_flight
+        with pytest.raises(CircuitOpenError):
+            await pool.acquire()
+
+    asyncio.run(scenario())
+
+
+def test_requests_route_around_open_endpoint():
+    async def scenario():
+        pool = EndpointPool("voice", [URL, "http://voice-2:8000"], max_outstanding=2, failure_threshold=1)
+        broken, healthy = pool.endpoints
+        await pool.release(await pool.acquire(), _error())
+        assert {broken.state, healthy.state} == {CIRCUIT_OPEN, CIRCUIT_CLOSED}
+        broken, healthy = sorted(pool.endpoints, key=lambda e: e.state != CIRCUIT_OPEN)
+
+        assert not pool.all_open
+        leased = [await pool.acquire() for _ in range(2)]
+        assert all(endpoint is healthy for endpoint in leased)
+
+    asyncio.run(scenario())
+
+
+def test_adaptive_limit_starts_at_cap_and_decreases_on_error():
+    endpoint = Endpoint(URL, max_outstanding=8, adaptive=True, min_limit=1, initial_limit=None)
+    assert endpoint.limit == 8.0
+    assert Endpoint(URL, max_outstanding=8, adaptive=True, initial_limit=2).limit == 2.0
+
+    endpoint.record_result(_error(), latency=None, latency_target=None)
+    assert endpoint.limit == pytest.approx(8 * endpoint.decrease_factor)
+    assert endpoint.limit_history[-1]['from'] == 8
@@ -0,0 +1,160 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, update
+
+from app.models.script import Script, ScriptStatus
+from app.services.ingest_index import ingest_index
+from app.services.job_queue import JobQueue
+
+
+@pytest.fixture
+def make_queue(session_factories):
+    """Tạo JobQueue dùng chung database của test, mỗi instance là một worker riêng"""
+    session_factory, async_session_factory = session_factories
+
+    def factory(lease_seconds: int = 300) -> JobQueue:
+        return JobQueue(
+            session_factory=session_factory,
+            async_session_factory=async_session_factory,
+            lease_seconds=lease_seconds,
+            write_behind=False,
+        )
+    return factory
+
+
+def _write_script(directory, name: str, text: str = "Nội dung script.") -> str:
+    path = directory / name
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def _job(session_factories, job_id: int) -> Script:
+    session_factory, _ = session_factories
+    with session_factory() as db:
+        return db.execute(select(Script).where(Script.id == job_id)).scalar_one()
+
+
+def test_claim_is_atomic_across_queue_instances(make_queue, tmp_path):
+    first, second = make_queue(), make_queue()
+    job_ids = [
+        first.enqueue(_write_script(tmp_path, f"script_{i}.txt"), "channel")
+        for i in range(20)
+    ]
+
+    async def claim_concurrently():
+        return await asyncio.gather(first.claim(15), second.claim(15))
+
+    claimed_first, claimed_second = asyncio.run(claim_concurrently())
+    ids_first = {row['id'] for row in claimed_first}
+    ids_second = {row['id'] for row in claimed_second}
+
+    assert not ids_first & ids_second
+    assert ids_first | ids_second == set(job_ids)
+    assert all(row['attempts'] == 1 for row in claimed_first + claimed_second)
+
+
+def test_expired_lease_is_reclaimed(make_queue, session_factories, tmp_path):
+    crashed, survivor = make_queue(), make_queue()
+    job_id = crashed.enqueue(_write_script(tmp_path, "script.txt"), "channel")
+
+    assert [row['id'] for row in asyncio.run(crashed.claim())] == [job_id]
+    # Lease còn hạn: worker khác không claim được
+    assert asyncio.run(survivor.claim()) == []
+
+    session_factory, _ = session_factories
+    with session_factory() as db:
+        db.execute(
+            update(Script)
+            .where(Script.id == job_id)
+            .values(lease_expires_at=datetime.utcnow() - timedelta(seconds=1))
+        )
+        db.commit()
+
+    reclaimed = asyncio.run(survivor.claim())
+    assert [row['id'] for row in reclaimed] == [job_id]
+    assert reclaimed[0]['attempts'] == 2
+    assert _job(session_factories, job_id).lease_owner == survivor.worker_id
+
+    # Worker đã mất lease không ghi đè kết quả của worker mới
+    assert asyncio.run(crashed.complete(job_id)) is False
+    assert asyncio.run(survivor.heartbeat([job_id])) == [job_id]
+    assert asyncio.run(survivor.complete(job_id)) is True
+    assert _job(session_factories, job_id).status == ScriptStatus.COMPLETED
+
+
+def test_release_without_counting_attempt(make_queue, session_factories, tmp_path):
+    queue = make_queue()
+    job_id = queue.enqueue(_write_script(tmp_path, "script.txt"), "channel")
+
+    asyncio.run(queue.claim())
+    assert _job(session_factories, job_id).attempts == 1
+
+    # status=None giữ nguyên trạng thái, lần claim không được tính
+    assert asyncio.run(queue.release(job_id, status=None, count_attempt=False)) is True
+    job = _job(session_factories, job_id)
+    assert job.attempts == 0
+    assert job.status == ScriptStatus.PROCESSING
+    assert job.lease_owner is None
+    assert job.lease_expires_at is None
+
+    # Job được claim lại ngay, attempts không bao giờ âm
+    assert [row['id'] for row in asyncio.run(queue.claim())] == [job_id]
+    assert asyncio.run(queue.release(job_id)) is True
+    job = _job(session_factories, job_id)
+    assert job.attempts == 1
+    assert job.status == ScriptStatus.PENDING
+
+
+def test_enqueue_dedup(make_queue, tmp_path):
+    queue = make_queue()
+    path = _write_script(tmp_path, "script.txt")
+
+    job_id = queue.enqueue(path, "channel")
+    assert job_id is not None
+    # File đã có job chưa kết thúc: trả về job đó
+    assert queue.enqueue(path, "channel") == job_id
+
+    asyncio.run(queue.claim())
+    assert asyncio.run(queue.complete(job_id)) is True
+    # File đã được nhận: bỏ qua, kể cả khi cache trong bộ nhớ bị xóa (process khác)
+    assert queue.enqueue(path, "channel") is None
+    ingest_index._cache.clear()
+    assert queue.enqueue(path, "channel") is None
+
+    # Cùng đường dẫn nhưng nội dung mới: job mới
+    _write_script(tmp_path, "script.txt", "Nội dung đã được sửa, dài hơn.")
+    retry_id = queue.enqueue(path, "channel")
+    assert retry_id not in (None, job_id)
+
+    # Job lỗi được xóa khỏi chỉ mục, file chuyển lại vào channel sẽ chạy lại
+    asyncio.run(queue.claim())
+    assert asyncio.run(queue.fail(retry_id, ScriptStatus.ERROR, "lỗi")) is True
+    assert queue.enqueue(path, "channel") not in (None, job_id, retry_id)
+
+
+def test_enqueue_batch_statuses(make_queue, tmp_path):
+    queue = make_queue()
+    active = _write_script(tmp_path, "active.txt")
+    done = _write_script(tmp_path, "done.txt")
+    fresh = _write_script(tmp_path, "fresh.txt")
+
+    active_id = queue.enqueue(active, "channel")
+    done_id = queue.enqueue(done, "channel")
+    claimed = asyncio.run(queue.claim(2))
+    assert {row['id'] for row in claimed} == {active_id, done_id}
+    asyncio.run(queue.complete(done_id))
+
+    results = queue.enqueue_batch([
+        {'file_path': active, 'channel_name': "channel"},
+        {'file_path': done, 'channel_name': "channel"},
+        {'file_path': fresh, 'channel_name': "channel"},
+        {'file_path': fresh, 'channel_name': "channel"},
+    ])
+
+    assert [r['status'] for r in results] == ['active', 'duplicate', 'queued', 'active']
+    assert results[0]['script_id'] == active_id
+    assert results[1]['script_id'] is None
+    assert results[2]['script_id'] is not None
+    assert results[3]['script_id'] == results[2]['script_id']